@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cost per sample of the flow rate and stability estimates, see run.py
+
+   FlowEstimator updates in constant time, compared with refitting the
+   window of samples at each one like the consumers of scale.weight did.
+   At 10 notifications per second and more, both must stay far below
+   the time between two samples.
+"""
+
+from collections import deque
+
+from pyacaia.analytics import FlowEstimator
+
+# Samples per second, and seconds in the window
+_RATE = 50.0
+_WINDOW = 2.0
+
+_estimator = FlowEstimator(_WINDOW)
+_naive = deque(maxlen=int(_RATE*_WINDOW))
+_t = [1000.0]
+
+
+def _refit(samples):
+    n=len(samples)
+    mean_t=sum(t for t,w in samples)/n
+    mean_w=sum(w for t,w in samples)/n
+    stt=stw=sww=0.0
+    for t,w in samples:
+        stt+=(t-mean_t)**2
+        stw+=(t-mean_t)*(w-mean_w)
+        sww+=(w-mean_w)**2
+    flow=stw/stt if stt else 0.0
+    return flow,sww/(n-1) if n>1 else 0.0
+
+
+def time_flow_estimator_add():
+    t=_t[0]=_t[0]+1.0/_RATE
+    _estimator.add(t,2.0*t)
+    _estimator.flow
+    _estimator.stable
+
+
+def time_flow_refit_window():
+    """The O(window) way, for comparison"""
+    t=_t[0]=_t[0]+1.0/_RATE
+    _naive.append((t,2.0*t))
+    _refit(_naive)
+
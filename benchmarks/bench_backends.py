@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""The backends head to head through AcaiaScale, see run.py
+
+   The in-memory backends always run: sim, and replay of a capture of
+   the simulated scale.  To compare real ones, name them with the MAC
+   address of a scale that is on:
+
+       PYACAIA_BENCH_BACKENDS=bluepy=00:1C:97:17:FD:97,pygatt=00:1C:97:17:FD:97
+
+   Replay does not answer commands, it has no command round trip.
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+import time
+
+from pyacaia import AcaiaScale, encodeHeartbeat
+
+_WRITES = 1000
+_TARES = 20
+
+_directory = tempfile.mkdtemp()
+atexit.register(shutil.rmtree,_directory,True)
+_capture = None
+
+
+def _replay_capture():
+    global _capture
+    if _capture is None:
+        path=os.path.join(_directory,'sim.acap')
+        scale=AcaiaScale('00:00:00:00:00:04',backend='sim')
+        scale.record(path)
+        scale.connect()
+        time.sleep(0.5)
+        scale.stop_recording()
+        scale.disconnect()
+        _capture=path
+    return _capture
+
+
+def _backends():
+    backends=[('sim','00:00:00:00:00:04',{}),
+              ('replay','00:00:00:00:00:04',{'capture': _replay_capture(),'replay_speed': None})]
+    for entry in os.environ.get('PYACAIA_BENCH_BACKENDS','').split(','):
+        if '=' in entry:
+            name,mac=entry.split('=',1)
+            backends.append((name,mac,{}))
+    return backends
+
+
+def _each(measure):
+    results={}
+    for name,mac,options in _backends():
+        scale=AcaiaScale(mac,backend=name,**options)
+        scale.connect(timeout=30)
+        try:
+            value=measure(name,scale)
+        finally:
+            scale.disconnect()
+        if value is not None:
+            results[name]=value
+    return results
+
+
+def track_backend_connect():
+    """Milliseconds from connect() to the first weight"""
+    return _each(lambda name,scale: scale.connect_timings['total']*1e3)
+track_backend_connect.unit = 'ms'
+
+
+def track_backend_write():
+    """Microseconds per write to the command characteristic"""
+    def measure(name,scale):
+        packet=encodeHeartbeat()
+        start=time.perf_counter()
+        for i in range(_WRITES):
+            scale.transport.write(packet)
+        return (time.perf_counter()-start)/_WRITES*1e6
+    return _each(measure)
+track_backend_write.unit = 'us'
+
+
+def track_backend_tare_round_trip():
+    """Milliseconds from queueing a tare to its acknowledgement, median"""
+    def measure(name,scale):
+        if name=='replay':
+            return None
+        latencies=[]
+        for i in range(_TARES):
+            start=time.perf_counter()
+            scale.tare().result(5)
+            latencies.append(time.perf_counter()-start)
+        latencies.sort()
+        return latencies[len(latencies)//2]*1e3
+    return _each(measure)
+track_backend_tare_round_trip.unit = 'ms'
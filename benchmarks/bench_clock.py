@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Alignment of the weight samples with the timer, see run.py
+
+   A synthetic shot of 60 seconds: the scale measures a weight every 0.1
+   second and reports its timer, truncated to tenths, every 0.5 second.
+   Each notification waits for the next connection event of a 45 ms
+   connection interval, and for another one when it is retransmitted, 5%
+   of the time.  The error is the timer given to each sample minus the
+   timer when the scale measured it.  The jitter of each weight
+   notification remains, they carry no time.  'fixed' is the previous
+   method, re-anchoring the timer on each report with a fixed 0.2 second
+   delay.
+"""
+
+import math
+import random
+import time
+
+from pyacaia.clock import ClockSync
+
+_DURATION = 60.0
+# BLE connection interval
+_INTERVAL = 0.045
+
+_clock = ClockSync()
+_clock.observe(time.monotonic(),0.0)
+
+
+def _delay(rnd):
+    delay=0.005+rnd.uniform(0,_INTERVAL)
+    if rnd.random()<0.05:
+        delay+=_INTERVAL
+    return delay
+
+
+def _shot(seed=1):
+    """Receive time and true timer of the samples and of the reports,
+       and the heartbeat round trips, in receive order
+    """
+    rnd=random.Random(seed)
+    start=100.0
+    events=[]
+    for i in range(int(_DURATION*10)):
+        t=i*0.1
+        events.append((start+t+_delay(rnd),'weight',t))
+        if i%5==0:
+            events.append((start+t+_delay(rnd),'report',math.floor(t*10)/10))
+            events.append((start+t+_delay(rnd),'round_trip',_delay(rnd)+_delay(rnd)))
+    events.sort()
+    return start,events
+
+
+def _percentiles(errors):
+    errors=sorted(abs(e) for e in errors)
+    n=len(errors)
+    return errors[n//2]*1e3,errors[min(n-1,n*99//100)]*1e3
+
+
+def track_timer_alignment():
+    """Milliseconds between the timer of a sample and when it was measured"""
+    start,events=_shot()
+    clock=ClockSync()
+    clock.start(start+_delay(random.Random(0)),0.0)
+    fixed_start=None
+    errors=[]
+    fixed_errors=[]
+    for now,kind,value in events:
+        if kind=='report':
+            clock.observe(now,value)
+            fixed_start=now-value
+        elif kind=='round_trip':
+            clock.round_trip(now,value)
+        elif now-start>5.0:
+            # After the first seconds, once both have reports
+            errors.append(clock.scale_time(now)-value)
+            fixed_errors.append(now-fixed_start+0.2-value)
+    p50,p99=_percentiles(errors)
+    fixed_p50,fixed_p99=_percentiles(fixed_errors)
+    return {'p50': p50,'p99': p99,'fixed_p50': fixed_p50,'fixed_p99': fixed_p99}
+track_timer_alignment.unit = 'ms'
+
+
+def time_clock_observe():
+    _clock.observe(time.monotonic(),1.0)
+
+def time_clock_scale_time():
+    _clock.scale_time(time.monotonic())
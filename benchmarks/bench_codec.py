@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Encoding and decoding throughput, see run.py
+
+   The decode benchmarks feed a Framer the way callback_queue() does:
+   one frame per notification, several frames coalesced in one
+   notification, and one frame fragmented over two notifications.
+"""
+
+from pyacaia import (AcaiaScale, Framer, Queue, decode, decode_frame, encode,
+                     encodeEventData, encodeHeartbeat, encodeId,
+                     encodeNotificationRequest, encodeStartTimer, encodeTare)
+
+_WEIGHT = bytes(encodeEventData([5,0x64,0,0,0,1,0]))
+_TIMER = bytes(encodeEventData([7,1,2,3]))
+_BUTTON = bytes(encodeEventData([8,10,7,0,5,1,0,0x64,0,0,0,1,0]))
+_SETTINGS = bytes(encode(8,[12,80,2,0,6,0,1,0,0,0,0,0]))
+_COALESCED = _WEIGHT+_TIMER+_WEIGHT
+_CUT = len(_WEIGHT)//2
+
+
+# Encoding, per command type
+
+def time_encode_heartbeat():
+    encodeHeartbeat()
+
+def time_encode_tare():
+    encodeTare()
+
+def time_encode_start_timer():
+    encodeStartTimer()
+
+def time_encode_id():
+    encodeId()
+
+def time_encode_notification_request():
+    encodeNotificationRequest()
+
+def time_encode_generic():
+    encode(13,[0,0])
+
+def time_encode_event_data():
+    encodeEventData([5,0x64,0,0,0,1,0])
+
+
+# Decoding
+
+_framer = Framer()
+
+def time_decode_single():
+    _framer.feed(_WEIGHT)
+    for frame in _framer:
+        decode_frame(frame)
+
+def time_decode_settings():
+    _framer.feed(_SETTINGS)
+    for frame in _framer:
+        decode_frame(frame)
+
+def time_decode_coalesced():
+    """Three frames in one notification"""
+    _framer.feed(_COALESCED)
+    for frame in _framer:
+        decode_frame(frame)
+
+def time_decode_fragmented():
+    """One frame split over two notifications"""
+    _framer.feed(_WEIGHT[:_CUT])
+    for frame in _framer:
+        decode_frame(frame)
+    _framer.feed(_WEIGHT[_CUT:])
+    for frame in _framer:
+        decode_frame(frame)
+
+def time_decode_compat():
+    """decode(), which makes a Framer per call"""
+    decode(_WEIGHT)
+
+
+# Whole notification handling, decoding and updating the scale
+
+_scale = AcaiaScale('00:00:00:00:00:00',backend='sim')
+_scale.queue = Queue(_scale.callback_queue)
+
+def time_notification_weight():
+    _scale.handleNotification(0x0e,_WEIGHT)
+
+def time_notification_button():
+    _scale.handleNotification(0x0e,_BUTTON)
+
+_decimated = AcaiaScale('00:00:00:00:00:00',backend='sim',max_rate=1)
+_decimated.queue = Queue(_decimated.callback_queue)
+
+def time_notification_weight_decimated():
+    """A weight dropped by max_rate, without decoding it"""
+    _decimated.handleNotification(0x0e,_WEIGHT)
+
+_profiled = AcaiaScale('00:00:00:00:00:00',backend='sim')
+_profiled.queue = Queue(_profiled.callback_queue)
+_profiled.enable_metrics()
+
+def time_notification_weight_profiled():
+    """With enable_metrics(): stage timings"""
+    _profiled.handleNotification(0x0e,_WEIGHT)
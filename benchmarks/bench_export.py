@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Logging the weights of a shot to CSV, see run.py
+
+   The Exporter sink against the loop our scripts used: one csv
+   writerow() and flush() per sample, in the thread that receives the
+   samples.  'sink' is the time the I/O thread spends per sample, 'cpu'
+   the CPU of the whole process per sample, writer thread included.
+"""
+
+import csv
+import os
+import tempfile
+import time
+
+from pyacaia import AcaiaScale, Message, encodeEventData
+from pyacaia.export import Exporter
+
+_SAMPLES = 20000
+
+_scale = AcaiaScale('00:00:00:00:00:03',backend='sim')
+_weight = Message(5,encodeEventData([5,0x64,0,0,0,1,0])[5:])
+
+
+def _naive(directory):
+    with open(os.path.join(directory,'naive.csv'),'w',newline='') as f:
+        writer=csv.writer(f)
+        start=time.perf_counter()
+        for i in range(_SAMPLES):
+            writer.writerow((time.monotonic(),_weight.value,_scale.get_elapsed_time(),0,''))
+            f.flush()
+        return time.perf_counter()-start
+
+
+def track_export_per_sample():
+    """Microseconds per sample"""
+    with tempfile.TemporaryDirectory() as directory:
+        naive=_naive(directory)
+        exporter=Exporter(_scale,directory).start()
+        cpu=time.process_time()
+        start=time.perf_counter()
+        for i in range(_SAMPLES):
+            exporter(_weight,time.monotonic())
+        sink=time.perf_counter()-start
+        exporter.close()
+        cpu=time.process_time()-cpu
+    if exporter.rows!=_SAMPLES:
+        raise Exception('Exported %d of %d samples' % (exporter.rows,_SAMPLES))
+    return {'naive': naive/_SAMPLES*1e6,'sink': sink/_SAMPLES*1e6,'cpu': cpu/_SAMPLES*1e6}
+track_export_per_sample.unit = 'us'
+
+
+def track_export_flush_latency():
+    """Milliseconds from handing a batch to the writer to having written it"""
+    with tempfile.TemporaryDirectory() as directory:
+        exporter=Exporter(_scale,directory).start()
+        for i in range(_SAMPLES):
+            exporter(_weight,time.monotonic())
+            if i%256==255:
+                time.sleep(0.001)
+        exporter.close()
+    latency=exporter.flush_latency.as_dict()
+    return {'mean': latency['mean']*1e3,'max': latency['max']*1e3}
+track_export_flush_latency.unit = 'ms'
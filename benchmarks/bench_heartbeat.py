@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Keep-alive writes per minute of the heartbeat policies, see run.py
+
+   A minute of the I/O loop is played on a simulated clock against each
+   HeartbeatPolicy, with a weight notification every 0.1 s as the scale
+   sends by default.  'fixed' is the former policy: a heartbeat every
+   interval whatever the traffic, plus an ident with each heartbeat of
+   the Pyxis.  The stall of each write is in AcaiaScale.io_stats().
+"""
+
+from pyacaia import HeartbeatPolicy, HEARTBEAT_INTERVALS
+
+_STEP = 0.01
+_NOTIFICATION_INTERVAL = 0.1
+
+
+def _writes(policy,notifications=True,idents_with_heartbeat=False):
+    """Writes in a minute, following AcaiaScale.send_keepalive()"""
+    policy.reset(0.0)
+    writes=0
+    every=int(round(_NOTIFICATION_INTERVAL/_STEP))
+    for i in range(1,int(60/_STEP)+1):
+        now=i*_STEP
+        if notifications and i%every==0:
+            policy.last_receive=now
+        if now<policy.next_deadline():
+            continue
+        if policy.ident_due(now):
+            policy.last_ident=now
+        elif not policy.heartbeat_due(now):
+            continue
+        writes+=2 if idents_with_heartbeat else 1
+        policy.last_write=now
+    return writes
+
+
+def track_heartbeat_writes_per_minute():
+    classic=HEARTBEAT_INTERVALS['classic']
+    return {
+        'pyxis_fixed': _writes(HeartbeatPolicy(1.0,max_silence=1.0),
+                               idents_with_heartbeat=True),
+        'pyxis': _writes(HeartbeatPolicy.for_model('pyxis')),
+        'classic_fixed': _writes(HeartbeatPolicy(classic,max_silence=classic)),
+        'classic': _writes(HeartbeatPolicy.for_model('classic')),
+        'classic_idle': _writes(HeartbeatPolicy.for_model('classic'),notifications=False),
+    }
+track_heartbeat_writes_per_minute.unit = 'writes'
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""CPU usage and thread count as the number of scales grows, with one
+   I/O thread per scale and with all the scales on an AcaiaHub.
+
+   The scales are AcaiaScale objects whose device is replaced by
+   FakePeripheral, which delivers notifications through a pipe like
+   bluepy-helper does, so no Bluetooth adapter or bluepy is needed.
+
+       python benchmarks/bench_hub.py --scales 1 5 10 25 50 --rate 10
+"""
+
+import argparse
+import os
+import select
+import threading
+import time
+
+from pyacaia import AcaiaScale, Queue, encodeEventData
+
+
+class _Helper(object):
+    pass
+
+
+class FakePeripheral(object):
+    """bluepy Peripheral stand-in: notifications are pushed with notify()
+       and read back through a pipe by waitForNotifications()
+    """
+
+    def __init__(self,delegate):
+        r,w=os.pipe()
+        self._helper=_Helper()
+        self._helper.stdout=os.fdopen(r,'rb',0)
+        self.w=w
+        self.delegate=delegate
+        self.pending=[]
+        self.lock=threading.Lock()
+        self.writes=0
+
+    def notify(self,data):
+        with self.lock:
+            self.pending.append(data)
+        os.write(self.w,b'n')
+
+    def waitForNotifications(self,timeout):
+        if not select.select([self._helper.stdout],[],[],timeout)[0]:
+            return False
+        os.read(self._helper.stdout.fileno(),1)
+        with self.lock:
+            data=self.pending.pop(0)
+        self.delegate.handleNotification(0x0e,data)
+        return True
+
+    def writeCharacteristic(self,handle,data,withResponse=False):
+        self.writes+=1
+
+    def disconnect(self):
+        os.close(self.w)
+
+
+def fake_connect(scale):
+    device=FakePeripheral(scale)
+    scale.device=device
+    scale.char_handle=0x0d
+    scale.queue=Queue(scale.callback_queue)
+    scale.notificationsReady()
+    return device
+
+
+def run(n,rate,duration,use_hub):
+    from pyacaia.hub import AcaiaHub
+
+    hub=None
+    if use_hub:
+        hub=AcaiaHub()
+        hub.start()
+    scales=[]
+    devices=[]
+    for i in range(n):
+        scale=AcaiaScale('00:00:00:00:00:%02x' % i,backend='sim')
+        if hub:
+            hub.attach(scale)
+        devices.append(fake_connect(scale))
+        scales.append(scale)
+
+    sample=bytes(encodeEventData([5,0x64,0,0,0,1,0]))
+    threads=threading.active_count()
+    cpu=time.process_time()
+    start=time.monotonic()
+    ticks=0
+    while time.monotonic()-start<duration:
+        for device in devices:
+            device.notify(sample)
+        ticks+=1
+        time.sleep(max(0,start+ticks/float(rate)-time.monotonic()))
+    elapsed=time.monotonic()-start
+    cpu=time.process_time()-cpu
+
+    received=sum(scale.series.count for scale in scales)
+    for scale in scales:
+        scale.disconnect()
+    if hub:
+        hub.stop()
+        hub.join()
+    return {
+        'scales': n,
+        'mode': 'hub' if use_hub else 'threads',
+        'threads': threads,
+        'cpu_percent': 100.0*cpu/elapsed,
+        'samples_per_s': received/elapsed,
+    }
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scales',type=int,nargs='+',default=[1,5,10,25,50])
+    parser.add_argument('--rate',type=float,default=10,help='notifications per second per scale')
+    parser.add_argument('--duration',type=float,default=3)
+    args=parser.parse_args()
+
+    print('%6s %8s %8s %8s %10s' % ('scales','mode','threads','cpu %','samples/s'))
+    for n in args.scales:
+        for use_hub in (False,True):
+            r=run(n,args.rate,args.duration,use_hub)
+            print('%6d %8s %8d %8.1f %10.1f' % (r['scales'],r['mode'],r['threads'],
+                                                r['cpu_percent'],r['samples_per_s']))
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Notification and command latencies with a simulated scale, see run.py
+
+   The scale is connected to pyacaia.sim with its own I/O thread, so the
+   latencies include the pipe and the thread wakeup, as with bluepy.
+"""
+
+import time
+from threading import Event
+
+from pyacaia import AcaiaScale, Queue, encodeEventData, encodeHeartbeat
+from pyacaia.sim import NOTIFY_HANDLE
+
+_SAMPLES = 200
+
+
+def _weight(i):
+    value=i%1000
+    return bytes(encodeEventData([5,value & 0xff,value>>8,0,0,1,0]))
+
+
+def _percentiles(latencies):
+    """In microseconds.  Histogram buckets are too coarse for these"""
+    latencies=sorted(latencies)
+    n=len(latencies)
+    return {
+        'p50': latencies[n//2]*1e6,
+        'p99': latencies[min(n-1,n*99//100)]*1e6,
+        'mean': sum(latencies)/n*1e6,
+    }
+
+
+def _connect():
+    # A slow weight stream, the benchmarks send their own notifications
+    scale=AcaiaScale('00:00:00:00:00:00',backend='sim',sim_options={'rate':1})
+    scale.connect(timeout=5)
+    return scale
+
+
+def track_notification_to_weight():
+    """handleNotification() until scale.weight is updated"""
+    scale=AcaiaScale('00:00:00:00:00:00',backend='sim')
+    scale.queue=Queue(scale.callback_queue)
+    latencies=[]
+    for i in range(_SAMPLES*10):
+        data=_weight(i)
+        start=time.perf_counter()
+        scale.handleNotification(NOTIFY_HANDLE,data)
+        latencies.append(time.perf_counter()-start)
+    return _percentiles(latencies)
+track_notification_to_weight.unit = 'us'
+
+
+def track_notification_to_weight_io():
+    """Notification sent by the peripheral until scale.weight is updated
+       by the I/O thread
+    """
+    scale=_connect()
+    received=Event()
+    def sink(msg,now):
+        if getattr(msg,'msgType',None)==5:
+            sink.time=time.perf_counter()
+            received.set()
+    scale.sinks.append(sink)
+    latencies=[]
+    try:
+        for i in range(_SAMPLES):
+            data=_weight(i)
+            received.clear()
+            start=time.perf_counter()
+            scale.device.send([data])
+            if received.wait(1):
+                latencies.append(sink.time-start)
+            time.sleep(0.002)
+    finally:
+        scale.disconnect()
+    return _percentiles(latencies)
+track_notification_to_weight_io.unit = 'us'
+
+
+def track_command_enqueue_to_write():
+    """send_command() until the I/O thread writes the packet"""
+    scale=_connect()
+    latencies=[]
+    packet=encodeHeartbeat()
+    try:
+        for i in range(_SAMPLES):
+            scale.send_command(packet)
+            # One command at a time, as tare() and the timer commands
+            time.sleep(0.002)
+            while scale.command_queue.latencies:
+                latencies.append(scale.command_queue.latencies.popleft()[1])
+    finally:
+        scale.disconnect()
+    return _percentiles(latencies)
+track_command_enqueue_to_write.unit = 'us'
+
+
+def track_trigger_latency():
+    """Notification sent by the peripheral until a when_weight() callback
+       is called, the reaction time of a stop-at-weight
+    """
+    scale=_connect()
+    fired=Event()
+    def callback(event):
+        callback.time=time.perf_counter()
+        fired.set()
+    latencies=[]
+    try:
+        for i in range(_SAMPLES):
+            scale.when_weight(50.0,callback,lead=0)
+            scale.device.send([_weight(0)])
+            time.sleep(0.002)
+            fired.clear()
+            start=time.perf_counter()
+            scale.device.send([_weight(999)])
+            if fired.wait(1):
+                latencies.append(callback.time-start)
+    finally:
+        scale.disconnect()
+    return _percentiles(latencies)
+track_trigger_latency.unit = 'us'
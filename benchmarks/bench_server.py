@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""ScaleServer load test on the loopback, see run.py
+
+   Weight samples are fed to the server sink at 1000 per second, as the
+   I/O thread would, and streamed to 1, 10 and 50 TCP clients in a
+   child process.  The CPU time of the server process per sample should
+   barely grow with the number of clients, since each batch is encoded
+   once and handed to every client socket with one write.
+"""
+
+import asyncio
+import json
+import multiprocessing
+import time
+
+from pyacaia import AcaiaScale, Message, encodeEventData
+from pyacaia.server import ScaleServer
+
+_SAMPLES = 2000
+_RATE = 1000
+
+_weight = Message(5,encodeEventData([5,0x64,0,0,0,1,0])[5:])
+
+
+def _subscribers(port,n,samples,ready,done):
+    async def subscriber(connected):
+        reader,writer=await asyncio.open_connection('127.0.0.1',port)
+        connected()
+        received=0
+        while received<samples:
+            line=await reader.readline()
+            if not line:
+                break
+            message=json.loads(line)
+            if message['type']=='weight':
+                received+=len(message['samples'])
+        writer.close()
+        return received
+    async def main():
+        count=[0]
+        def connected():
+            count[0]+=1
+            if count[0]==n:
+                ready.set()
+        return await asyncio.gather(*(subscriber(connected) for i in range(n)))
+    done.put(min(asyncio.run(main())))
+
+
+def _cpu_per_sample(clients):
+    scale=AcaiaScale('00:00:00:00:00:02',backend='sim')
+    server=ScaleServer(scale,port=0,batch_interval=0.02).start()
+    context=multiprocessing.get_context('fork')
+    ready=context.Event()
+    done=context.Queue()
+    process=context.Process(target=_subscribers,args=(server.port,clients,_SAMPLES,ready,done))
+    process.start()
+    try:
+        ready.wait(10)
+        while len(server.clients)<clients:
+            time.sleep(0.01)
+        cpu=time.process_time()
+        for i in range(_SAMPLES):
+            server(_weight,time.monotonic())
+            if i%10==9:
+                time.sleep(10.0/_RATE)
+        received=done.get(timeout=30)
+        cpu=time.process_time()-cpu
+    finally:
+        server.stop()
+        process.join(5)
+    if received<_SAMPLES:
+        raise Exception('Clients received %d of %d samples' % (received,_SAMPLES))
+    return cpu/_SAMPLES*1e6
+
+
+def track_server_cpu_per_sample():
+    """Microseconds of server CPU per sample, by number of clients"""
+    return dict(('clients_%d' % n,_cpu_per_sample(n)) for n in (1,10,50))
+track_server_cpu_per_sample.unit = 'us'
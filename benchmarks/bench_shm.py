@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Reading the state of a scale from another process, see run.py
+
+   Shared memory (pyacaia.shm) against asking the process that owns the
+   scale over a Unix socket for its state as JSON, the way our
+   processes did.  The socket server is a child process, so the round
+   trip includes the wakeup of both processes.
+"""
+
+import atexit
+import json
+import multiprocessing
+import socket
+import time
+
+from pyacaia import AcaiaScale, Message, encodeEventData
+from pyacaia.shm import StatePublisher, StateReader
+
+_READS = 2000
+
+_scale = AcaiaScale('00:00:00:00:00:01',backend='sim')
+_scale.weight = 12.3
+_scale.battery = 80
+_scale.units = 'grams'
+_publisher = StatePublisher(_scale,window=1024,name='pyacaia_bench')
+_reader = StateReader(name='pyacaia_bench')
+atexit.register(_publisher.close)
+atexit.register(_reader.close)
+_weight = Message(5,encodeEventData([5,0x64,0,0,0,1,0])[5:])
+
+
+def time_state_publish():
+    """A weight sample through the StatePublisher sink"""
+    _publisher(_weight,time.monotonic())
+
+def time_state_read():
+    _reader.read()
+
+def time_state_last_100():
+    _reader.last(100)
+
+
+def _serve(sock):
+    state={'weight': 12.3,'battery': 80,'units': 'grams','timer_running': False,
+           'elapsed': 0.0,'connected': True,'time': 0.0}
+    while sock.recv(1):
+        state['time']=time.monotonic()
+        sock.sendall(json.dumps(state).encode()+b'\n')
+
+
+def _percentiles(latencies):
+    latencies=sorted(latencies)
+    n=len(latencies)
+    return latencies[n//2]*1e6,latencies[min(n-1,n*99//100)]*1e6
+
+
+def track_state_read_latency():
+    """Microseconds to get the current state from another process"""
+    ours,theirs=socket.socketpair()
+    server=multiprocessing.get_context('fork').Process(target=_serve,args=(theirs,))
+    server.daemon=True
+    server.start()
+    theirs.close()
+    reader=ours.makefile('rb')
+    socket_latencies=[]
+    shm_latencies=[]
+    try:
+        for i in range(_READS):
+            start=time.perf_counter()
+            ours.sendall(b'?')
+            json.loads(reader.readline())
+            socket_latencies.append(time.perf_counter()-start)
+            start=time.perf_counter()
+            _reader.read()
+            shm_latencies.append(time.perf_counter()-start)
+    finally:
+        reader.close()
+        ours.close()
+        server.join(5)
+    socket_p50,socket_p99=_percentiles(socket_latencies)
+    shm_p50,shm_p99=_percentiles(shm_latencies)
+    return {'socket_p50': socket_p50,'socket_p99': socket_p99,
+            'shm_p50': shm_p50,'shm_p99': shm_p99}
+track_state_read_latency.unit = 'us'
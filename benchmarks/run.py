@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Run the benchmark suites and compare the results with a baseline.
+
+   The suites are the benchmarks/bench_*.py modules.  Like asv, their
+   time_* functions are timed, in seconds per call, and their track_*
+   functions return a value, or a dict of values, in the unit of their
+   `unit` attribute.  Lower is better for both.
+
+       python benchmarks/run.py                           # print the results
+       python benchmarks/run.py --save baselines/new.json # record a baseline
+       python benchmarks/run.py --compare baselines/baseline.json
+
+   --compare exits with status 1 when a result is more than --threshold
+   times its baseline.  Baselines record the machine and Python they were
+   made on: compare results from the same machine only.
+"""
+
+import argparse
+import glob
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def suites(pattern=None):
+    sys.path.insert(0,HERE)
+    sys.path.insert(1,os.path.dirname(HERE))
+    for path in sorted(glob.glob(os.path.join(HERE,'bench_*.py'))):
+        module=importlib.import_module(os.path.basename(path)[:-3])
+        for name in sorted(dir(module)):
+            if not name.startswith(('time_','track_')):
+                continue
+            full=module.__name__+'.'+name
+            if pattern and pattern not in full:
+                continue
+            yield full,getattr(module,name)
+
+
+def run_time(func,repeat):
+    """Best of repeat runs of at least 0.2 s each, per call"""
+    timer=timeit.Timer(func)
+    number,_=timer.autorange()
+    return min(timer.repeat(repeat,number))/number
+
+
+def run_suites(pattern=None,repeat=5):
+    results={}
+    for name,func in suites(pattern):
+        start=time.monotonic()
+        if name.split('.')[-1].startswith('time_'):
+            results[name]={'value': run_time(func,repeat),'unit': 's'}
+        else:
+            value=func()
+            unit=getattr(func,'unit','')
+            if isinstance(value,dict):
+                for key,v in value.items():
+                    results[name+'.'+key]={'value': v,'unit': unit}
+            else:
+                results[name]={'value': value,'unit': unit}
+        sys.stderr.write('%-60s %.1f s\n' % (name,time.monotonic()-start))
+    return results
+
+
+def environment():
+    try:
+        commit=subprocess.check_output(['git','rev-parse','--short','HEAD'],cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit=None
+    return {
+        'commit': commit,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'machine': platform.machine()+' '+(platform.processor() or ''),
+        'cpus': os.cpu_count(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+    }
+
+
+def format_value(value,unit):
+    if unit=='s':
+        for scale,name in ((1e-9,'ns'),(1e-6,'us'),(1e-3,'ms')):
+            if value<scale*1000:
+                return '%.1f %s' % (value/scale,name)
+        return '%.2f s' % value
+    return '%.1f %s' % (value,unit)
+
+
+def compare(results,baseline,threshold):
+    """Print the results next to the baseline, return the regressions"""
+    regressions=[]
+    old=baseline['results']
+    print('%-60s %12s %12s %7s' % ('benchmark','baseline','now','ratio'))
+    for name,result in sorted(results.items()):
+        now=format_value(result['value'],result['unit'])
+        if name not in old:
+            print('%-60s %12s %12s' % (name,'-',now))
+            continue
+        before=old[name]['value']
+        ratio=result['value']/before if before else float('inf')
+        flag=''
+        if ratio>threshold:
+            flag=' slower'
+            regressions.append(name)
+        elif ratio<1.0/threshold:
+            flag=' faster'
+        print('%-60s %12s %12s %6.2fx%s' % (name,format_value(before,old[name]['unit']),
+                                             now,ratio,flag))
+    return regressions
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--bench',help='only run the benchmarks whose name contains this')
+    parser.add_argument('--repeat',type=int,default=5)
+    parser.add_argument('--save',help='write the results to this JSON file')
+    parser.add_argument('--compare',help='baseline JSON file to compare with')
+    parser.add_argument('--threshold',type=float,default=1.25,
+                        help='ratio to the baseline reported as a regression')
+    args=parser.parse_args()
+
+    env=environment()
+    results=run_suites(args.bench,args.repeat)
+    if args.save:
+        with open(args.save,'w') as f:
+            json.dump({'environment': env,'results': results},f,indent=1,sort_keys=True)
+
+    if not args.compare:
+        for name,result in sorted(results.items()):
+            print('%-60s %12s' % (name,format_value(result['value'],result['unit'])))
+        return 0
+
+    with open(args.compare) as f:
+        baseline=json.load(f)
+    for key in ('machine','cpus','python'):
+        if baseline['environment'].get(key)!=env[key]:
+            print('Warning: baseline %s is %s, running on %s'
+                  % (key,baseline['environment'].get(key),env[key]))
+    regressions=compare(results,baseline,args.threshold)
+    if regressions:
+        print('%d regressions against %s (commit %s)'
+              % (len(regressions),args.compare,baseline['environment'].get('commit')))
+        return 1
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -7,9 +7,26 @@
 
 __version__ = "0.4.0"
 
+import fcntl
+import json
 import logging
+import os
+import random
+import select
+import struct
 import time
-from threading import Thread, Timer, Lock
+from array import array
+from bisect import bisect_left
+from collections import deque, namedtuple
+from concurrent.futures import Future
+from threading import Thread, Lock, Condition, Event, current_thread
+
+from .analytics import FlowEstimator, RateMeter
+from .backends import BACKENDS, Backend, register_backend, get_backend
+from .clock import ClockSync
+from .dispatch import (Dispatcher, Subscription, WeightSample, ButtonEvent,
+                       DROP_OLDEST, COALESCE_LATEST, BLOCK, WEIGHT, BUTTON, SETTINGS,
+                       DISCONNECT)
 
 root = logging.getLogger()
 root.setLevel(logging.INFO)
@@ -18,62 +35,160 @@ logging.getLogger('pygatt').setLevel(logging.WARNING)
 
 HEADER1 = 0xef
 HEADER2 = 0xdd
+HEADER = bytes(bytearray([HEADER1,HEADER2]))
 
-def find_acaia_devices(timeout=3,backend='bluepy'):
+# First and longest delay between connection attempts, in seconds
+_CONNECT_BACKOFF = 0.1
+_CONNECT_BACKOFF_MAX = 2.0
 
-    addresses=[]
-    print('Looking for ACAIA devices...')
+# Seconds to wait for the settings and a weight with the handles of the
+# profile cache, before discovering them again
+_CACHED_PROFILE_WAIT = 2.0
 
-    devices_start_names = [
-        'ACAIA',
-        'PYXIS',
-        'LUNAR',
-        'PROCH'
-    ]
+# Advertised names of the Acaia scales start with one of these
+DEVICE_NAMES = (
+    'ACAIA',
+    'PYXIS',
+    'LUNAR',
+    'PROCH'
+)
 
-    if backend=='pygatt':
-        try:
-            from pygatt import GATTToolBackend
-            adapter = GATTToolBackend('hci0')
-            adapter.reset()
-            adapter.start(False)
-            devices=adapter.scan(timeout=timeout,run_as_root=True)
-            addresses=[]
-            for d in devices:
-                if (d['name'] 
-                    and any(d['name'].startswith(name) for name in devices_start_names)):
-                    print (d['name'],d['address'])
-                    addresses.append(d['address'])
-            adapter.stop()
-        except:
-            raise Exception('pygatt is not installed')
-
-
-    elif backend=='bluepy':
+AcaiaDevice = namedtuple('AcaiaDevice','name address rssi last_seen')
 
-        try:
-            from bluepy.btle import Scanner, DefaultDelegate
 
-            class ScanDelegate(DefaultDelegate):
-                def __init__(self):
-                    DefaultDelegate.__init__(self)
+class AcaiaScanner(object):
+    """Scans for Acaia scales and remembers the ones seen in the last
+       ttl seconds.  scan() returns as soon as a scale is seen, and uses
+       the scales seen recently without scanning at all.  start() keeps
+       scanning in a background thread until stop().
 
-            scanner = Scanner().withDelegate(ScanDelegate())
-            devices = scanner.scan(timeout)
+       The time from the start of a scan to the first scale found is
+       recorded in time_to_first_device (a Histogram).
+    """
 
-            addresses=[]
-            for dev in devices:
-                for (adtype, desc, value) in dev.getScanData():
-                    if (desc=='Complete Local Name' 
-                        and any(value.startswith(name) for name in devices_start_names)):
+    def __init__(self,backend='bluepy',iface='hci0',ttl=30):
+        get_backend(backend)
+        self.backend=backend
+        self.iface=iface
+        self.ttl=ttl
+        self.devices={}
+        self.condition=Condition()
+        # Backend doing the scans, created by the first one
+        self.transport=None
+        self.thread=None
+        self.running=False
+        self.scan_start=None
+        self.time_to_first_device=Histogram()
 
-                        print(value, dev.addr)
-                        addresses.append(dev.addr)
+    def seen(self,max_age=None):
+        """Scales seen in the last max_age (default ttl) seconds,
+           strongest signal first
+        """
+        now=time.monotonic()
+        expired=now-self.ttl
+        oldest=expired if max_age is None else now-max_age
+        with self.condition:
+            for address in [a for a,d in self.devices.items() if d.last_seen<expired]:
+                del self.devices[address]
+            devices=[d for d in self.devices.values() if d.last_seen>=oldest]
+        devices.sort(key=lambda d: -d.rssi if d.rssi is not None else float('inf'))
+        return devices
+
+    def scan(self,timeout=3,first=True,max_age=None):
+        """Return the scales seen, strongest signal first.  With first,
+           return as soon as one is known, otherwise scan for timeout.
+           Scales seen in the last max_age seconds (default ttl) are
+           known without scanning, with max_age=0 only the scales seen
+           by this scan are returned
+        """
+        if max_age is None:
+            max_age=self.ttl
+        start=time.monotonic()
+        if first and max_age:
+            devices=self.seen(max_age)
+            if devices:
+                return devices
+        def found():
+            # Seen since the start of this scan, or known before
+            return bool(self.seen(time.monotonic()-start+max_age))
+        deadline=start+timeout
+        if self.running:
+            with self.condition:
+                while time.monotonic()<deadline:
+                    if first and found():
+                        break
+                    self.condition.wait(deadline-time.monotonic())
+        else:
+            self._scan(deadline,lambda: first and found())
+        return self.seen(time.monotonic()-start+max_age)
 
-        except:
-            raise Exception('bluepy is not installed')
+    def start(self):
+        """Keep scanning in a background thread"""
+        if self.running:
+            return
+        self.running=True
+        self.thread=Thread(target=self._run,name='AcaiaScanner')
+        self.thread.daemon=True
+        self.thread.start()
 
-    return addresses
+    def stop(self):
+        self.running=False
+        if self.thread and self.thread is not current_thread():
+            self.thread.join()
+        self.thread=None
+
+    def _run(self):
+        while self.running:
+            try:
+                self._scan(time.monotonic()+1,lambda: False,False)
+            except Exception as e:
+                logging.debug('Scan failed '+str(e))
+                time.sleep(1)
+
+    def _found(self,name,address,rssi):
+        if not name or not name.startswith(DEVICE_NAMES):
+            return
+        now=time.monotonic()
+        with self.condition:
+            if self.scan_start is not None:
+                self.time_to_first_device.add(now-self.scan_start)
+                self.scan_start=None
+            self.devices[address]=AcaiaDevice(name,address,rssi,now)
+            self.condition.notify_all()
+
+    def _scan(self,deadline,done,timed=True):
+        if timed:
+            self.scan_start=time.monotonic()
+        if self.transport is None:
+            self.transport=get_backend(self.backend)(iface=self.iface)
+        self.transport.scan(deadline,self._found,done)
+        self.scan_start=None
+
+_scanners = {}
+
+def get_scanner(backend='bluepy',iface='hci0'):
+    """Return the shared AcaiaScanner of an adapter"""
+    key=(backend,iface)
+    if key not in _scanners:
+        _scanners[key]=AcaiaScanner(backend,iface)
+    return _scanners[key]
+
+
+def find_acaia_devices(timeout=3,backend='bluepy',first=False,max_age=0,iface='hci0'):
+    """Return the addresses of the scales in range, strongest signal
+       first.  With first, return as soon as one is found.  By default
+       only the scales seen by a fresh scan, max_age also returns the
+       ones seen by earlier scans in the last max_age seconds, see
+       AcaiaScanner.scan()
+    """
+
+    print('Looking for ACAIA devices...')
+
+    devices=get_scanner(backend,iface).scan(timeout,first,max_age)
+    for d in devices:
+        print(d.name,d.address)
+
+    return [d.address for d in devices]
 
 class Queue(object):
 
@@ -81,10 +196,14 @@ class Queue(object):
         self.queue=[]
         self.callback=callback
         self.running=False
+        # Most notifications waiting at once
+        self.max_depth=0
 
     def add(self,data):
 
         self.queue.append(data)
+        if len(self.queue)>self.max_depth:
+            self.max_depth=len(self.queue)
 
         if not self.running:
             self.dequeue()
@@ -109,137 +228,543 @@ class Queue(object):
         return dequeue(self)
 
 class CommandQueue(object):
-    
-    def __init__(self):
-        self.queue=[]
-        self.mutex=Lock()
+    """Commands waiting to be written by the I/O thread.
+
+       Adding a command wakes the I/O thread through a self-pipe whose
+       read end, fileno(), is polled together with the notification
+       socket.  Threads without a socket to poll can wait() instead.
+       The enqueue-to-write latency of every command is kept in latencies,
+       and in the wait Histogram.
+    """
 
-    def add(self,packet):
-        self.mutex.acquire()
-        self.queue.append(packet)
-        self.mutex.release()
+    def __init__(self):
+        self.queue=deque()
+        self.condition=Condition()
+        self.wake_r=None
+        self.wake_w=None
+        # (packet, seconds from add() to the write) of the last commands
+        self.latencies=deque(maxlen=100)
+        self.wait_time=Histogram()
+        # Most commands waiting at once
+        self.max_depth=0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def fileno(self):
+        if self.wake_r is None:
+            self.wake_r,self.wake_w=os.pipe()
+            for fd in (self.wake_r,self.wake_w):
+                fcntl.fcntl(fd,fcntl.F_SETFL,fcntl.fcntl(fd,fcntl.F_GETFL)|os.O_NONBLOCK)
+        return self.wake_r
+
+    def close(self):
+        if self.wake_r is not None:
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+            self.wake_r=self.wake_w=None
+
+    def add(self,packet,command=None):
+        with self.condition:
+            self.queue.append((packet,time.monotonic(),command))
+            if len(self.queue)>self.max_depth:
+                self.max_depth=len(self.queue)
+            self.condition.notify()
+        wake_w=self.wake_w
+        if wake_w is not None:
+            try:
+                os.write(wake_w,b'\0')
+            except OSError:
+                # Pipe is full, the I/O thread has a wakeup pending anyway
+                pass
+
+    def wait(self,timeout=None):
+        """Wait until a command is queued, return True if there is one"""
+        with self.condition:
+            if not self.queue:
+                self.condition.wait(timeout)
+            return bool(self.queue)
+
+    def clear_wakeup(self):
+        """Consume pending wakeups, call before draining the queue"""
+        if self.wake_r is not None:
+            try:
+                while os.read(self.wake_r,512):
+                    pass
+            except OSError:
+                pass
+
+    def pop(self):
+        """Return (packet, time it was queued, PendingCommand or None),
+           or None if the queue is empty
+        """
+        with self.condition:
+            if self.queue:
+                return self.queue.popleft()
+        return None
 
     def dequeue(self):
-        packet = None
-        self.mutex.acquire()
-        if self.queue:
-            packet=self.queue.pop(0)
-        self.mutex.release()
-        return packet
+        entry=self.pop()
+        if entry:
+            return entry[0]
+        return None
+
+    def written(self,packet,queued_time):
+        """Record that a packet returned by pop() was written"""
+        latency=time.monotonic()-queued_time
+        self.latencies.append((packet,latency))
+        self.wait_time.add(latency)
+        if root.isEnabledFor(logging.DEBUG):
+            logging.debug('command '+bytes(packet).hex()+' written after %.1f ms' % (latency*1000))
+
+class Histogram(object):
+    """Counts of values in fixed buckets, cheap enough to update
+       for every command or sample.  The default buckets are meant
+       for latencies in seconds.
+    """
+
+    BOUNDS = (0.001,0.002,0.005,0.01,0.02,0.05,0.1,0.2,0.5,1.0,2.0,5.0)
+
+    def __init__(self,bounds=BOUNDS):
+        self.bounds=bounds
+        self.counts=[0]*(len(bounds)+1)
+        self.count=0
+        self.total=0.0
+        self.max=0.0
+
+    def add(self,value):
+        self.counts[bisect_left(self.bounds,value)]+=1
+        self.count+=1
+        self.total+=value
+        if value>self.max:
+            self.max=value
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total/self.count
+
+    def percentile(self,p):
+        """Upper bound of the bucket holding the p-th percentile (0-100)"""
+        if not self.count:
+            return None
+        rank=self.count*p/100.0
+        seen=0
+        for bound,count in zip(self.bounds,self.counts):
+            seen+=count
+            if seen>=rank:
+                return bound
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.mean(),
+            'max': self.max,
+            'sum': self.total,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'buckets': list(zip(self.bounds+(float('inf'),),self.counts)),
+        }
+
+
+# Weights within this of zero acknowledge a tare
+_TARE_TOLERANCE = 0.1
+
+
+def _tare_done(command,msg):
+    if msg.button=='tare':
+        return True
+    # A weight that went to zero after the write, an empty scale
+    # already weighing zero has to echo the button
+    return (msg.msgType==5 and abs(msg.value)<=_TARE_TOLERANCE and
+            command.weight is not None and abs(command.weight)>_TARE_TOLERANCE)
+
+# Events received after the write that show the scale applied a command,
+# ack(command,msg)
+_COMMAND_ACKS = {
+    'tare': _tare_done,
+    'start': lambda command,msg: msg.button=='start',
+    'stop': lambda command,msg: msg.button=='stop',
+    'reset': lambda command,msg: msg.button=='reset',
+}
+
+
+class PendingCommand(object):
+    """A command written to the scale and the future that is resolved
+       with the Message that acknowledges it
+    """
+
+    __slots__ = ('name','packet','future','queued','sent','deadline','retries','weight')
+
+    def __init__(self,name,packet,retries):
+        self.name=name
+        self.packet=packet
+        self.future=Future()
+        self.queued=time.monotonic()
+        self.sent=None
+        self.deadline=None
+        self.retries=retries
+        # Last weight known since the write
+        self.weight=None
+
+
+class CommandTracker(object):
+    """Commands waiting for their acknowledgement.  Commands that are not
+       acknowledged within timeout seconds of being written are sent
+       again, up to retries times, then their future fails with
+       TimeoutError.  Only messages received after the last write of a
+       command acknowledge it.  The write-to-acknowledgement time of each command
+       is kept in a Histogram per command name in latency.
+    """
+
+    def __init__(self,timeout=1.0,retries=2):
+        self.timeout=timeout
+        self.retries=retries
+        self.pending=[]
+        self.lock=Lock()
+        self.latency={}
+
+    def add(self,name,packet):
+        command=PendingCommand(name,packet,self.retries)
+        with self.lock:
+            self.pending.append(command)
+        return command
+
+    def sent(self,command,weight=None):
+        """command was written, when the last weight was weight"""
+        command.sent=time.monotonic()
+        command.deadline=command.sent+self.timeout
+        command.weight=weight
+
+    def acknowledge(self,msg,received=None):
+        """Resolve the commands acknowledged by msg, received at the
+           monotonic time received, now by default.  Return them
+        """
+        now=time.monotonic()
+        if received is None:
+            received=now
+        done=[]
+        with self.lock:
+            for command in self.pending:
+                sent=command.sent
+                if sent is None or received<sent:
+                    continue
+                if _COMMAND_ACKS[command.name](command,msg):
+                    done.append(command)
+                elif msg.msgType==5:
+                    command.weight=msg.value
+            for command in done:
+                self.pending.remove(command)
+        for command in done:
+            latency=now-command.sent
+            histogram=self.latency.get(command.name)
+            if histogram is None:
+                histogram=self.latency[command.name]=Histogram()
+            histogram.add(latency)
+            if root.isEnabledFor(logging.DEBUG):
+                logging.debug(command.name+' acknowledged after %.1f ms' % (latency*1000))
+            if not command.future.cancelled():
+                command.future.set_result(msg)
+        return done
+
+    def next_deadline(self):
+        deadlines=[command.deadline for command in self.pending if command.deadline]
+        if deadlines:
+            return min(deadlines)
+        return None
+
+    def expire(self):
+        """Return the timed out commands that should be sent again,
+           failing those that have no retries left
+        """
+        now=time.monotonic()
+        retry=[]
+        failed=[]
+        with self.lock:
+            for command in list(self.pending):
+                if command.future.cancelled():
+                    self.pending.remove(command)
+                elif command.deadline and command.deadline<=now:
+                    if command.retries>0:
+                        command.retries-=1
+                        command.sent=command.deadline=None
+                        retry.append(command)
+                    else:
+                        self.pending.remove(command)
+                        failed.append(command)
+        for command in failed:
+            logging.debug(command.name+' was not acknowledged by the scale')
+            command.future.set_exception(
+                TimeoutError(command.name+' was not acknowledged by the scale'))
+        return retry
+
+    def cancel_all(self):
+        with self.lock:
+            pending=self.pending
+            self.pending=[]
+        for command in pending:
+            if not command.future.done():
+                command.future.set_exception(Exception('Scale disconnected'))
+
+
+# Divisor for the unit byte of a weight payload
+_WEIGHT_DIVISORS = (None, 10.0, 100.0, 1000.0, 10000.0)
+
+# little-endian value, 2 unknown bytes, unit, flags (0x02 is the sign)
+_WEIGHT = struct.Struct('<HxxBB')
+
+# minutes, seconds, tenths of a second
+_TIME = struct.Struct('BBB')
+
+# (payload[0], payload[1]) of a msgType 8 message:
+# (button name, whether a time precedes the weight)
+_BUTTONS = {
+    (0,5): ('tare',False),
+    (8,5): ('start',False),
+    (10,7): ('stop',True),
+    (9,7): ('reset',True),
+}
+
+_UNITS = {2:'grams', 5:'ounces'}
+_UNIT_CODES = dict((units,code) for code,units in _UNITS.items())
+
 
 class Message(object):
 
+    __slots__ = ('msgType','payload','value','button','time')
+
     def __init__(self,msgType,payload):
         self.msgType=msgType
-        self.payload=payload
+        # A copy, payload may be a view of the Framer buffer, which the
+        # next notification overwrites
+        self.payload=bytes(payload)
         self.value=None
         self.button=None
         self.time=None
 
-        if self.msgType==5:
-            self.value=self._decode_weight(payload)
-
-        elif self.msgType==11:
-            if payload[2]==5:
-                self.value=self._decode_weight(payload[3:])
-            elif payload[2]==7:
-                self.time=self._decode_time(payload[3:])
+        decoder=_MESSAGE_DECODERS.get(msgType)
+        if decoder:
+            decoder(self,payload)
+        elif root.isEnabledFor(logging.DEBUG):
+            logging.debug('message '+str(msgType)+': %s' %list(payload))
+
+    def _decode_weight_message(self,payload):
+        self.value=self._decode_weight(payload)
+
+    def _decode_heartbeat_message(self,payload):
+        if payload[2]==5:
+            self.value=self._decode_weight(payload[3:])
+        elif payload[2]==7:
+            self.time=self._decode_time(payload[3:])
+        if root.isEnabledFor(logging.DEBUG):
             logging.debug('heartbeat response (weight: '+str(self.value)+' time: '+str(self.time))
 
-        elif self.msgType==7:
-            self.time = self._decode_time(payload)
+    def _decode_timer_message(self,payload):
+        self.time=self._decode_time(payload)
+        if root.isEnabledFor(logging.DEBUG):
             logging.debug('timer: '+str(self.time))
 
-        elif self.msgType==8:
-            if payload[0]==0 and payload[1]==5:
-                self.button='tare'
-                self.value=self._decode_weight(payload[2:])
-                logging.debug('tare (weight: '+str(self.value)+')')
-            elif payload[0]==8 and payload[1]==5:
-                self.button='start'
-                self.value=self._decode_weight(payload[2:])
-                logging.debug('start (weight: '+str(self.value)+')')
-            elif payload[0]==10 and payload[1]==7:
-                self.button='stop'
-                self.time = self._decode_time(payload[2:])
-                self.value = self._decode_weight(payload[6:])
-                logging.debug('stop time: '+str(self.time)+' weight: '+str(self.value))
-            elif payload[0]==9 and payload[1]==7:
-                self.button='reset'
-                self.time = self._decode_time(payload[2:])
-                self.value = self._decode_weight(payload[6:])
-                logging.debug('reset time: '+str(self.time)+' weight: '+str(self.value))
-            else:
-                self.button='unknownbutton'
-                logging.debug('unknownbutton '+str(payload))
-
-
-        else: 
-            logging.debug('message '+str(msgType)+': %s' %payload)
+    def _decode_button_message(self,payload):
+        button=_BUTTONS.get((payload[0],payload[1]))
+        if button is None:
+            self.button='unknownbutton'
+            if root.isEnabledFor(logging.DEBUG):
+                logging.debug('unknownbutton '+str(list(payload)))
+            return
+        self.button,has_time=button
+        if has_time:
+            self.time=self._decode_time(payload[2:])
+            self.value=self._decode_weight(payload[6:])
+        else:
+            self.value=self._decode_weight(payload[2:])
+        if root.isEnabledFor(logging.DEBUG):
+            logging.debug(self.button+' time: '+str(self.time)+' weight: '+str(self.value))
 
     def _decode_weight(self,weight_payload):
-        value= ((weight_payload[1] & 0xff) << 8) + (weight_payload[0] & 0xff)
-        unit=  weight_payload[4] & 0xFF;
-        if (unit == 1): value /= 10.0
-        elif (unit == 2): value /= 100.0
-        elif (unit == 3): value /= 1000.0
-        elif (unit == 4): value /= 10000.0
-        else: raise Exception('unit value not in range %d:' % unit)
-
-        if ((weight_payload[5] & 0x02) == 0x02):
-            value *= -1
+        value,unit,flags=_WEIGHT.unpack_from(weight_payload)
+        if not 1<=unit<=4:
+            raise Exception('unit value not in range %d:' % unit)
+        value/=_WEIGHT_DIVISORS[unit]
+        if flags & 0x02:
+            value = -value
         return value
 
     def _decode_time(self,time_payload):
-        value = (time_payload[0] & 0xff) * 60
-        value = value + (time_payload[1])
-        value = value + (time_payload[2] / 10.0)
-        return value
+        minutes,seconds,tenths=_TIME.unpack_from(time_payload)
+        return minutes*60+seconds+tenths/10.0
+
+_MESSAGE_DECODERS = {
+    5: Message._decode_weight_message,
+    7: Message._decode_timer_message,
+    8: Message._decode_button_message,
+    11: Message._decode_heartbeat_message,
+}
+
 
 class Settings(object):
-    
+
+    __slots__ = ('battery','units','auto_off','beep_on')
+
     def __init__(self,payload):
         # payload[0] is unknown
         self.battery = payload[1] & 0x7F
-        if payload[2]==2:
-            self.units = 'grams'
-        elif payload[2]==5:
-            self.units = 'ounces'
-        else:
-            self.units = None
+        self.units = _UNITS.get(payload[2])
         # payload[2 and 3] is unknown
         self.auto_off = payload[4] * 5
         # payload[5] is unknown
         self.beep_on = payload[6]==1
         # payload[7-9] unknown
-        logging.debug('settings: battery='+str(self.battery)+' '+str(self.units)
-                +' auto_off='+str(self.auto_off)+' beep='+str(self.beep_on))
-        logging.debug('unknown settings: '+str([payload[0],payload[1]&0x80,payload[3],
-                      payload[5],payload[7],payload[8], payload[9]]))
+        if root.isEnabledFor(logging.DEBUG):
+            logging.debug('settings: battery='+str(self.battery)+' '+str(self.units)
+                    +' auto_off='+str(self.auto_off)+' beep='+str(self.beep_on))
+            logging.debug('unknown settings: '+str([payload[0],payload[1]&0x80,payload[3],
+                          payload[5],payload[7],payload[8], payload[9]]))
+
+
+def encodeSettings(battery,units,auto_off,beep_on):
+    """Settings notification as the scale sends it, see Settings"""
+    payload=[0]*12
+    # Length, read as the unknown payload[0] by Settings
+    payload[0]=len(payload)
+    payload[1]=battery & 0x7f
+    payload[2]=_UNIT_CODES.get(units,2)
+    payload[4]=auto_off//5
+    payload[6]=1 if beep_on else 0
+    return encode(8,payload)
 
 
 def encode(msgType,payload):
-    bytes=bytearray(5+len(payload))
+    try:
+        payload=bytearray(payload)
+    except ValueError:
+        payload=bytearray(val & 0xff for val in payload)
 
-    bytes[0] = HEADER1
-    bytes[1] = HEADER2
-    bytes[2] = msgType
-    cksum1 = 0
-    cksum2 = 0
+    bytes=bytearray((HEADER1,HEADER2,msgType))
+    bytes+=payload
+    bytes.append(sum(payload[0::2]) & 0xFF)
+    bytes.append(sum(payload[1::2]) & 0xFF)
 
+    return bytes
 
-    for i in range(len(payload)):
-        val = payload[i] & 0xff
-        bytes[3+i] = val
-        if (i % 2 == 0):
-            cksum1 += val
-        else:
-            cksum2 += val
 
-    bytes[len(payload) + 3] = (cksum1 & 0xFF)
-    bytes[len(payload) + 4] = (cksum2 & 0xFF)
+class Framer(object):
+    """Incremental frame extractor for the notification byte stream.
+
+       Notifications are copied once into a reusable buffer and complete
+       frames are returned as memoryview slices of that buffer, so no
+       per-frame copies are made.  The scan position is kept between
+       calls, so bytes that were already searched are not scanned again.
+       Bytes skipped while looking for a header are counted in garbage.
+       A frame that turns out to be corrupt is given back with reject(),
+       the search for a header resumes right after its own.
+
+       A returned frame is only valid until the next call to feed().
+    """
+
+    def __init__(self,size=1024):
+        self.buffer=bytearray(size)
+        self.view=memoryview(self.buffer)
+        # self.buffer[start:end] holds the bytes not yet framed
+        self.start=0
+        self.end=0
+        # Start of the last frame returned, see reject()
+        self.last=0
+        self.frames=0
+        self.garbage=0
+
+    def __len__(self):
+        return self.end-self.start
+
+    def __iter__(self):
+        frame=self.next_frame()
+        while frame is not None:
+            yield frame
+            frame=self.next_frame()
+
+    def feed(self,data):
+        """Append a notification to the buffer"""
+        n=len(data)
+        if self.start==self.end:
+            self.start=self.end=0
+        if self.end+n>len(self.buffer):
+            pending=self.end-self.start
+            if pending+n>len(self.buffer):
+                # Grow into a new buffer rather than resizing in place:
+                # frames handed out earlier keep a view on the old one
+                buffer=bytearray(max(2*len(self.buffer),pending+n))
+                buffer[0:pending]=self.view[self.start:self.end]
+                self.buffer=buffer
+                self.view=memoryview(buffer)
+            elif pending:
+                self.view[0:pending]=self.view[self.start:self.end]
+            self.start=0
+            self.end=pending
+        self.view[self.end:self.end+n]=data
+        self.end+=n
+
+    def next_frame(self):
+        """Return the next complete frame, or None if there is none yet.
+           The frame includes the header and the two checksum bytes.
+        """
+        buffer=self.buffer
+        start=self.start
+        end=self.end
+        i=buffer.find(HEADER,start,end)
+        if i<0:
+            # Keep a trailing HEADER1, the rest of the header may follow
+            if end>start and buffer[end-1]==HEADER1:
+                end-=1
+            self.garbage+=end-start
+            self.start=end
+            return None
+        if i>start:
+            if root.isEnabledFor(logging.DEBUG):
+                logging.debug("Ignoring "+str(i-start)+" bytes before header")
+            self.garbage+=i-start
+            self.start=i
+        if end-i<6:
+            return None
+        frameEnd=i+buffer[i+3]+5
+        if frameEnd>end:
+            return None
+        self.start=frameEnd
+        self.last=i
+        self.frames+=1
+        return self.view[i:frameEnd]
+
+    def reject(self):
+        """The last frame returned is corrupt, its header was probably
+           a match in the payload of a damaged frame or its length byte
+           is wrong: count its first byte as garbage and look for the
+           next header from the byte after it.  Call before feed()
+        """
+        self.frames-=1
+        self.garbage+=1
+        self.start=self.last+1
 
-    return bytes
+
+def checksum_ok(frame):
+    """True if the two last bytes of a complete frame are the checksum
+       of its payload, see encode()
+    """
+    payload=frame[3:-2]
+    return (sum(payload[0::2]) & 0xFF)==frame[-2] and (sum(payload[1::2]) & 0xFF)==frame[-1]
+
+
+def decode_frame(frame):
+    """Return the Message or Settings encoded in a complete frame,
+       or None for frames that are not events or settings
+    """
+    cmd=frame[2]
+    if cmd==12:
+        return Message(frame[4],frame[5:])
+    if cmd==8:
+        return Settings(frame[3:])
+
+    logging.debug("Non event notification message command "+str(cmd)+' '
+                +str(bytes(frame)))
+    return None
 
 
 def decode(bytes):
@@ -255,50 +780,29 @@ def decode(bytes):
        payload of length-1 bytes
        checksum byte1
        checksum byte2
-       
-    """
-    messageStart = -1
-   
-    for i in range(len(bytes)-1):
-        if bytes[i]==HEADER1 and bytes[i+1]==HEADER2:
-            messageStart=i
-            break
-    if messageStart<0 or len(bytes)-messageStart<6:
-        return (None,bytes)
-
-    messageEnd  = messageStart+bytes[messageStart+3]+5
 
-    if messageEnd>len(bytes):
+       This is a compatibility wrapper around Framer, which should be
+       used instead when decoding a stream of notifications.
+    """
+    framer=Framer(max(len(bytes),1))
+    framer.feed(bytes)
+    frame=framer.next_frame()
+    if frame is None:
         return (None,bytes)
-
-    if messageStart>0:
-        logging.debug("Ignoring "+str(i)+" bytes before header")
-
-    cmd = bytes[messageStart+2]
-    if cmd==12:
-        msgType = bytes[messageStart+4]
-        payloadIn = bytes[messageStart+5:messageEnd]
-        return (Message(msgType,payloadIn),bytes[messageEnd:])
-    if cmd==8:
-        return (Settings(bytes[messageStart+3:]),bytes[messageEnd:])
-
-    logging.debug("Non event notification message command "+str(cmd)+' '
-                +str(bytes[messageStart:messageEnd]))
-    return (None,bytes[messageEnd:])
+    return (decode_frame(frame),bytes[framer.start:])
 
 
 def encodeEventData(payload):
-    bytes= bytearray(len(payload)+1)
-    bytes[0] = len(payload) + 1
+    try:
+        payload=bytearray(payload)
+    except ValueError:
+        payload=bytearray(val & 0xff for val in payload)
+    return encode(12,bytearray([len(payload)+1])+payload)
 
-    for i in range(len(payload)):
-        bytes[i+1]=payload[i] & 0xff
 
-    return encode(12,bytes)
-
-
-def encodeNotificationRequest():
-    payload=[
+# Commands without arguments are encoded once, the encode*() functions
+# below return these immutable frames
+_NOTIFICATION_REQUEST = bytes(encodeEventData([
     	0,  # weight
     	1,  # weight argument
     	1,  # battery
@@ -307,117 +811,454 @@ def encodeNotificationRequest():
     	5,  # timer argument (number heartbeats between timer messages)
     	3,  # key
     	4   # setting
-    ]
-    return encodeEventData(payload)
+    ]))
+_ID = bytes(encode(11,bytearray([0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d])))
+_PYXIS_ID = bytes(encode(11,bytearray([0x30,0x31,0x32,0x33,0x34,0x35,0x36,0x37,0x38,0x39,0x30,0x31,0x32,0x33,0x34])))
+_HEARTBEAT = bytes(encode(0,[2,0]))
+_TARE = bytes(encode(4,[0]))
+_GET_SETTINGS = bytes(encode(6,[0]*16))
+_START_TIMER = bytes(encode(13,[0,0]))
+_STOP_TIMER = bytes(encode(13,[0,2]))
+_RESET_TIMER = bytes(encode(13,[0,1]))
+
+
+_NOTIFICATION_REQUESTS = {(1,2,5,4,None): _NOTIFICATION_REQUEST}
+
+def encodeNotificationRequest(weight=1,battery=2,timer=5,key=4,setting=None):
+    """Ask the scale to send events.  The arguments are the intervals
+       the scale sends each event at, larger is less often: the timer
+       interval is a number of heartbeats.  None leaves an event out.
+    """
+    arguments=(weight,battery,timer,key,setting)
+    request=_NOTIFICATION_REQUESTS.get(arguments)
+    if request is None:
+        payload=[]
+        for event,argument in enumerate(arguments):
+            if argument is not None:
+                payload+=[event,argument]
+        request=_NOTIFICATION_REQUESTS[arguments]=bytes(encodeEventData(payload))
+    return request
 
 
 def encodeId(isPyxisStyle=False):
     if isPyxisStyle:
-        payload = bytearray([0x30,0x31,0x32,0x33,0x34,0x35,0x36,0x37,0x38,0x39,0x30,0x31,0x32,0x33,0x34])
-    else:
-        payload = bytearray([0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d,0x2d])
-    return encode(11,payload)
+        return _PYXIS_ID
+    return _ID
 
 
 def encodeHeartbeat():
-    payload = [2,0]
-    return encode(0, payload)
+    return _HEARTBEAT
 
 
 def encodeTare():
-    payload = [0];
-    return encode(4, payload)
+    return _TARE
 
 def encodeGetSettings():
     """Settings are returned as a notification"""
-    payload = [0]*16
-    return encode(6,payload)
+    return _GET_SETTINGS
 
 def encodeStartTimer():
-    payload = [0,0]
-    return encode(13, payload)
+    return _START_TIMER
 
 def encodeStopTimer():
-    payload = [0,2]
-    return encode(13, payload)
+    return _STOP_TIMER
 
 def encodeResetTimer():
-    payload = [0,1]
-    return encode(13, payload)
+    return _RESET_TIMER
+
+class WeightSeries(object):
+    """Bounded series of timestamped weight samples in preallocated arrays.
+
+       Each sample is a monotonic receive time, the weight and the
+       elapsed timer.  Once capacity samples are stored, appending
+       overwrites the oldest one.  Every sample is written twice, at
+       position i and i+capacity, so the last n samples are always one
+       contiguous slice and can be returned without copying.
+
+       Readers do not lock: count is incremented after each sample, and
+       a read that raced with enough appends to overwrite it is retried.
+    """
+
+    def __init__(self,capacity=4096):
+        self.capacity=capacity
+        # One spare slot for the sample being written while reading
+        self.size=size=capacity+1
+        self.times=array('d',bytes(16*size))
+        self.weights=array('d',bytes(16*size))
+        self.timers=array('d',bytes(16*size))
+        # Number of samples appended so far
+        self.count=0
+
+    def __len__(self):
+        return min(self.count,self.capacity)
+
+    def append(self,t,weight,timer):
+        i=self.count%self.size
+        j=i+self.size
+        self.times[i]=self.times[j]=t
+        self.weights[i]=self.weights[j]=weight
+        self.timers[i]=self.timers[j]=timer
+        self.count+=1
+
+    def clear(self):
+        self.count=0
+
+    def _slice(self,count,n):
+        stop=count%self.size+self.size
+        return slice(stop-n,stop)
+
+    def last(self,n=None,copy=True):
+        """Return (times, weights, timers) of the last n samples, oldest
+           first, as arrays.  With copy=False they are memoryviews of the
+           storage, which stay valid for capacity-n more samples.
+        """
+        while True:
+            count=self.count
+            if n is None or n>min(count,self.capacity):
+                n=min(count,self.capacity)
+            window=self._slice(count,n)
+            if copy:
+                result=(self.times[window],self.weights[window],self.timers[window])
+            else:
+                result=(memoryview(self.times)[window],memoryview(self.weights)[window],
+                        memoryview(self.timers)[window])
+            if not copy or self.count-count<self.size-n:
+                return result
+
+    def since(self,t,copy=True):
+        """Return (times, weights, timers) of the samples received at
+           or after monotonic time t
+        """
+        count=self.count
+        n=min(count,self.capacity)
+        window=self._slice(count,n)
+        index=bisect_left(memoryview(self.times)[window],t)
+        return self.last(n-index+self.count-count,copy)
 
-class setInterval(Thread):
+    def numpy(self,n=None):
+        """Return the last n samples as NumPy arrays sharing the storage"""
+        import numpy
+        return tuple(numpy.frombuffer(column,dtype=numpy.float64)
+                     for column in self.last(n,copy=False))
 
-    def __init__(self,func,interval):
+
+class Clock(object):
+    """Time source of the Scheduler"""
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def wait(self,event,timeout):
+        """Wait for event for up to timeout seconds, return event.is_set()"""
+        return event.wait(timeout)
+
+
+class FakeClock(Clock):
+    """Clock for tests, time only moves when the scheduler waits"""
+
+    def __init__(self,now=0.0):
+        self.now=now
+
+    def monotonic(self):
+        return self.now
+
+    def wait(self,event,timeout):
+        if not event.is_set():
+            self.now+=timeout
+        return event.is_set()
+
+
+class Scheduler(Thread):
+    """Calls func every interval seconds until stop() is called or func
+       returns False.  Deadlines are planned on the monotonic clock and the
+       thread sleeps until the next one, so it does not drift and uses no
+       CPU in between.  How late each call was is recorded in jitter.
+
+       With an interval of 0, func is called back to back and is
+       expected to block itself, like the bluepy heartbeat().
+    """
+
+    def __init__(self,func,interval,clock=None):
 
         Thread.__init__(self)
-        self.keep_going=False
         self.func=func
         self.interval=interval
-        self.timer=None
+        self.clock=clock or Clock()
+        self.stopped=Event()
+        self.calls=0
+        # seconds between the planned and the actual time of each call
+        self.jitter=Histogram()
+
+    @property
+    def keep_going(self):
+        return self.is_alive() and not self.stopped.is_set()
 
     def stop(self):
-        self.keep_going=False
+        self.stopped.set()
 
     def run(self):
 
-        self.keep_going=True
-
-        while self.keep_going:
-            if self.interval==0:
-                if not self.func():
+        clock=self.clock
+        deadline=clock.monotonic()+self.interval
+        while not self.stopped.is_set():
+            if self.interval:
+                delay=deadline-clock.monotonic()
+                if delay>0 and clock.wait(self.stopped,delay):
                     break
-                    return
-            elif not self.timer or not self.timer.isAlive():
-                self.timer=Timer(self.interval,self.func)
-                self.timer.start()
+                now=clock.monotonic()
+                self.jitter.add(max(0.0,now-deadline))
+                deadline+=self.interval
+                if deadline<=now:
+                    # Missed whole intervals, do not try to catch up
+                    deadline=now+self.interval
+            self.calls+=1
+            result=self.func()
+            if result is False or (not self.interval and not result):
+                break
+
+# Former name of Scheduler
+setInterval = Scheduler
+
+
+# Seconds between heartbeats of each scale model, see AcaiaScale.model.
+# The official app sends the Pyxis a heartbeat every second, but the
+# Pyxis works just fine with one every 5 seconds as the earlier scales
+HEARTBEAT_INTERVALS = {'pyxis': 5.0, 'classic': 1.0}
+
+# Seconds between the ident refreshes of each model, None for never.
+# The official app sends the Pyxis an ident with every heartbeat
+IDENT_INTERVALS = {'pyxis': 30.0, 'classic': None}
+
+# Longest time without a write to the scale, even while notifications
+# show that the link is alive
+_MAX_SILENCE = 5.0
+
+
+class HeartbeatPolicy(object):
+    """Decides when the heartbeat and the ident refresh are sent.
+
+       The heartbeat is due interval seconds after the last write or
+       notification, whichever is later, so commands and a live weight
+       stream postpone it, but never more than max_silence seconds after
+       the last write.  The ident refresh is due ident_interval seconds
+       after the last ident, unless the scale has sent its settings,
+       which answer the ident, since then.  Every write counts as a
+       heartbeat, the ident refresh too.
+    """
+
+    def __init__(self,interval=1.0,max_silence=_MAX_SILENCE,ident_interval=None):
+        self.interval=interval
+        self.max_silence=max(interval,max_silence)
+        self.ident_interval=ident_interval
+        # Monotonic times, last_receive is set by AcaiaScale.callback_queue
+        self.last_write=0.0
+        self.last_receive=0.0
+        self.last_ident=0.0
+
+    @classmethod
+    def for_model(cls,model,interval=None,ident_interval=None,**kwargs):
+        """Policy with the intervals of model, unless given"""
+        if interval is None:
+            interval=HEARTBEAT_INTERVALS[model]
+        if ident_interval is None:
+            ident_interval=IDENT_INTERVALS[model]
+        return cls(interval,ident_interval=ident_interval,**kwargs)
+
+    def reset(self,now):
+        self.last_write=self.last_receive=self.last_ident=now
+
+    def heartbeat_due(self,now):
+        last=self.last_write if self.last_write>self.last_receive else self.last_receive
+        return now>=last+self.interval or now>=self.last_write+self.max_silence
+
+    def ident_due(self,now):
+        return self.ident_interval is not None and now>=self.last_ident+self.ident_interval
+
+    def next_deadline(self):
+        last=self.last_write if self.last_write>self.last_receive else self.last_receive
+        deadline=min(last+self.interval,self.last_write+self.max_silence)
+        if self.ident_interval is not None:
+            deadline=min(deadline,self.last_ident+self.ident_interval)
+        return deadline
+
+
+class WriteMeter(object):
+    """Writes to the scale: the count of each kind, the number in the
+       last minute, and how long each one held the writing thread
+    """
+
+    # A write without response takes tens of microseconds with bluepy,
+    # one with a response a connection interval or more
+    BOUNDS = (0.00001,0.00002,0.00005,0.0001,0.0002,0.0005,0.001,0.002,0.005,
+              0.01,0.02,0.05,0.1,0.2,0.5)
+
+    def __init__(self):
+        self.counts={}
+        self.recent=deque()
+        self.stall=Histogram(self.BOUNDS)
+
+    def add(self,kind,now,stall):
+        self.counts[kind]=self.counts.get(kind,0)+1
+        recent=self.recent
+        recent.append(now)
+        while recent[0]<now-60:
+            recent.popleft()
+        self.stall.add(stall)
+
+    def per_minute(self,now):
+        recent=self.recent
+        while recent and recent[0]<now-60:
+            recent.popleft()
+        return len(recent)
+
+    def as_dict(self,now):
+        return {
+            'writes': dict(self.counts),
+            'writes_per_minute': self.per_minute(now),
+            'stall': self.stall.as_dict(),
+        }
+
+
+class ProfileCache(object):
+    """GATT handles of the scales seen before, keyed by MAC address,
+       so that reconnecting can subscribe without discovering the
+       characteristics again.  Kept in memory, and in a JSON file if
+       a path is given.
+    """
+
+    def __init__(self,path=None):
+        self.path=path
+        self.lock=Lock()
+        self.profiles={}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.profiles=json.load(f)
+            except (OSError,ValueError) as e:
+                logging.debug('Ignoring profile cache '+path+': '+str(e))
+
+    def get(self,mac):
+        return self.profiles.get(mac.upper())
+
+    def put(self,mac,profile):
+        with self.lock:
+            self.profiles[mac.upper()]=profile
+            self._save()
+
+    def invalidate(self,mac):
+        with self.lock:
+            if self.profiles.pop(mac.upper(),None) is not None:
+                self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp=self.path+'.tmp'
+        with open(tmp,'w') as f:
+            json.dump(self.profiles,f,indent=1)
+        os.replace(tmp,self.path)
+
+default_profile_cache = ProfileCache()
+
+
 class AcaiaScale(object):
 
-    def __init__(self,mac,char_uuid=None,backend='bluepy',iface='hci0',weight_uuid=None):
+    def __init__(self,mac,char_uuid=None,backend='bluepy',iface='hci0',weight_uuid=None,
+                 history=4096,profile_cache=None,capture=None,replay_speed=1.0,
+                 sim_options=None,flow_window=1.0,notifications=None,max_rate=None,
+                 heartbeat_options=None,clock_options=None):
         """For Pyxis-style devices, the UUIDs can be overridden.  char_uuid
            is the command UUID, and weight_uuid is where the notify comes
            from.  Old-style scales only specify char_uuid
+           history is the number of weight samples kept in series
+           profile_cache is the ProfileCache of the GATT handles,
+           default_profile_cache by default
+           With backend='replay', the notifications of the capture file
+           made with record() are replayed at replay_speed times the
+           recorded rate, or as fast as possible if it is None
+           With backend='sim', a simulated scale is connected instead,
+           sim_options are the arguments of pyacaia.sim.SimPeripheral
+           The backends are in pyacaia.backends.BACKENDS
+           flow_window is the number of seconds of weights that flow_rate
+           and is_stable are computed over
+           notifications are the arguments of encodeNotificationRequest()
+           sent when connecting, see set_notifications()
+           max_rate is the number of weights per second to keep, the
+           others are dropped before decoding.  None keeps them all
+           heartbeat_options are the arguments of HeartbeatPolicy.for_model()
+           used once the model of the scale is known.  By default the
+           intervals of the model are used, with the heartbeat_options
+           of the backend
+           clock_options are the arguments of pyacaia.clock.ClockSync,
+           which aligns the timer of the scale with time.monotonic()
         """
 
-        if backend=='pygatt':
-            try:
-                from pygatt import GATTToolBackend
-            except:
-                raise Exception('pygatt is not installed')
-            self.backend_class=GATTToolBackend
-
-        elif backend=='bluepy':
-            try:
-                from bluepy import btle
-            except:
-                raise Exception('bluepy is not installed')
-            self.backend_class=btle
-
-        else:
-            raise Exception('Backend not supported')
-
         self.backend=backend
         self.iface=iface
         self.mac=mac
-        self.adapter=None
-        self.device = None
+        self.capture=capture
+        self.replay_speed=replay_speed
+        self.sim_options=sim_options or {}
+        # Backend of the link to the scale, see pyacaia.backends
+        self.transport=get_backend(backend)(self,iface)
+        # CaptureWriter while recording, see record()
+        self.recorder=None
         self.connected = False
 
         self.char_uuid=char_uuid
         self.weight_uuid=weight_uuid
         self.isPyxisStyle=(char_uuid and weight_uuid)
         self.char=None
-        self.handle=None
+        # bluepy handles of the command characteristic and of the
+        # descriptor that enables the weight notifications
+        self.char_handle=None
+        self.notify_handle=None
+        self.profile_cache=profile_cache if profile_cache is not None else default_profile_cache
+        # Seconds of discovery skipped thanks to the profile cache
+        self.profile_time_saved=None
 
         self.queue = None
         self.command_queue = CommandQueue()
-        self.packet=None
+        # Commands waiting for the scale to acknowledge them
+        self.commands = CommandTracker()
+        self.framer=Framer()
         self.set_interval_thread=None
+        # Set to drive the I/O from an event loop instead of a thread,
+        # see notificationsReady()
+        self.io_driver=None
         self.last_heartbeat = 0
-        self.timer_start_time = 0
-        self.paused_time = 0
-        # Number of seconds of delay in transmitting 
-        # the time from the scale
-        self.transit_delay = 0.2
+        if heartbeat_options is None:
+            heartbeat_options = self.transport.heartbeat_options
+        self.heartbeat_options = heartbeat_options
+        # HeartbeatPolicy of the model, replaced when connecting
+        self.keepalive = HeartbeatPolicy.for_model('classic',**heartbeat_options)
+        # How late each heartbeat was sent
+        self.heartbeat_jitter = Histogram()
+        # Writes to the scale and the time they blocked the thread
+        self.write_meter = WriteMeter()
+        # Times the I/O thread woke up
+        self.io_wakeups = 0
+        # Notifications received, see stats()
+        self.notifications_received = 0
+        self.bytes_received = 0
+        # (time, notifications, bytes) when created, the default start
+        # of the rates of stats()
+        self.stats_mark = (time.monotonic(),0,0)
+        # Frames of commands decode_frame() does not know
+        self.unknown_frames = 0
+        # Frames dropped for a wrong checksum, and frames that could not
+        # be decoded in spite of a right one
+        self.checksum_failures = 0
+        self.decode_errors = 0
+        self.connects = 0
+        self.connect_failures = 0
+        # pyacaia.metrics.Profiler of the pipeline, see enable_metrics()
+        self.profiler = None
+        # Timer of the scale on time.monotonic(), with the Bluetooth
+        # delay, see get_elapsed_time() and transit_delay
+        self.clock = ClockSync(**(clock_options or {}))
+        # time.monotonic() of the heartbeat waiting for its response
+        self.heartbeat_sent = None
 
         # weight in the units given
         self.weight = None
@@ -429,210 +1270,427 @@ class AcaiaScale(object):
         self.auto_off = None
         # if true, the scale will beep 
         self.beep_on = None
-        # if true, timer is running
-        self.timer_running = False
-
+        # (receive time, weight, elapsed timer) of the last weight samples
+        self.series = WeightSeries(history)
+        # Flow rate and stability, see flow_rate and is_stable
+        self.analytics = FlowEstimator(flow_window)
+        self.notifications = dict(notifications or {})
+        self.max_rate = max_rate
+        self.next_sample = 0.0
+        # Weights received from the scale, and kept after max_rate
+        self.weight_meter = RateMeter()
+        self.sample_meter = RateMeter()
+        self.decimated = 0
+        # Set once the scale has sent its settings and a first weight
+        self.ready = Event()
+        self.settings_received = False
+        self.weight_received = False
+        # Seconds spent in each phase of the last connect()
+        self.connect_timings = {}
+        # Callables sink(msg,receive_time) called with every decoded Message
+        # and Settings, in the thread that reads the notifications
+        self.sinks = []
+        # Dispatcher of the on_weight() and other subscriptions
+        self.dispatcher = None
+        # TriggerEngine of when_weight() and when()
+        self.triggers = None
+        # pyacaia.shm.StatePublisher of publish_state()
+        self.publisher = None
+
+
+    @property
+    def device(self):
+        """Peripheral of the backend"""
+        return self.transport.device
+
+    @device.setter
+    def device(self,device):
+        self.transport.device=device
+
+    @property
+    def model(self):
+        """'pyxis' or 'classic', the key of HEARTBEAT_INTERVALS"""
+        return 'pyxis' if self.isPyxisStyle else 'classic'
+
+    @property
+    def heartbeat_interval(self):
+        return self.keepalive.interval
+
+    @property
+    def timer_running(self):
+        return self.clock.running
+
+    @property
+    def transit_delay(self):
+        """Seconds from the scale to the host, estimated from the round
+           trips of the heartbeats, also part of the lead of triggers
+        """
+        return self.clock.delay
+
+    @transit_delay.setter
+    def transit_delay(self,delay):
+        self.clock.delay=delay
+
+    @property
+    def flow_rate(self):
+        """Weight units per second over the last flow_window seconds"""
+        return self.analytics.flow
+
+    @property
+    def weight_rate(self):
+        """Weights per second received from the scale"""
+        return self.weight_meter.rate(time.monotonic())
+
+    @property
+    def sample_rate(self):
+        """Weights per second kept, after max_rate"""
+        return self.sample_meter.rate(time.monotonic())
+
+    @property
+    def is_stable(self):
+        """True when the weight has settled over the last flow_window
+           seconds
+        """
+        return self.analytics.stable
 
     def get_elapsed_time(self):
         """Return the time displayed on the timer, in seconds"""
-        if self.timer_running:
-            return time.time()-self.timer_start_time+self.transit_delay
-        else:
-            return self.paused_time
-
-
-    def addBuffer(self,buffer2):
-
-        packet_len=0
-
-        if self.packet:
-            packet_len=len(self.packet)
-
-        result= bytearray(packet_len+len(buffer2))
+        return self.clock.elapsed()
 
-        for i in range(packet_len):
-            result[i]=self.packet[i]
+    def get_scale_time(self,now):
+        """Return the timer when the scale measured a weight received at
+           now, the timer column of series
+        """
+        return self.clock.scale_time(now)
 
-        for i in range(len(buffer2)):
-            result[i+packet_len]=buffer2[i]
 
-        self.packet=result
+    def addBuffer(self,buffer2):
+        self.framer.feed(buffer2)
 
 
     def characteristicValueChanged(self,handle,value):
         #print handle,value
+        # Read once, stop_recording() may run in another thread
+        recorder=self.recorder
+        if recorder:
+            recorder.notification(handle,value)
         self.queue.add(value)
 
     def handleDiscovery(self, scanEntry, isNewDev, isNewData):
         pass #DBG("Discovered device", scanEntry.addr)
 
     def handleNotification(self,handle,value):
+        recorder=self.recorder
+        if recorder:
+            recorder.notification(handle,value)
         self.queue.add(value)
 
     def callback_queue(self,payload):
         #print('This is the queue')
-        self.addBuffer(payload)
-
-        while True:
-            (msg,self.packet) = decode(self.packet)
-            if not msg:
-                return
+        now=time.monotonic()
+        # A notification shows the link is alive, see HeartbeatPolicy
+        self.keepalive.last_receive=now
+        self.notifications_received+=1
+        self.bytes_received+=len(payload)
+        profiler=self.profiler
+        if profiler is not None:
+            t=time.perf_counter()
+        self.framer.feed(payload)
+        if profiler is not None:
+            t=profiler.lap('feed',t)
+
+        framer=self.framer
+        for frame in framer:
+            if not checksum_ok(frame):
+                # Corrupted on the way, decoding it could raise
+                self.checksum_failures+=1
+                if root.isEnabledFor(logging.DEBUG):
+                    logging.debug('Wrong checksum '+bytes(frame).hex())
+                framer.reject()
+                continue
+            if frame[2]==12 and frame[4]==5:
+                # Weight event, decimated before decoding
+                self.weight_meter.add(now)
+                if self.max_rate:
+                    if now<self.next_sample:
+                        self.decimated+=1
+                        if profiler is not None:
+                            t=time.perf_counter()
+                        continue
+                    period=1.0/self.max_rate
+                    self.next_sample+=period
+                    if self.next_sample<now:
+                        # First sample or late, start a new grid with
+                        # some slack for the jitter of the notifications
+                        self.next_sample=now+0.75*period
+                self.sample_meter.add(now)
+            try:
+                msg=decode_frame(frame)
+            except Exception as e:
+                # A bad frame is dropped, it does not take the link down
+                self.decode_errors+=1
+                logging.debug('Could not decode '+bytes(frame).hex()+': '+str(e))
+                if profiler is not None:
+                    t=time.perf_counter()
+                continue
+            if profiler is not None:
+                t=profiler.lap('decode',t)
+            if msg is None:
+                self.unknown_frames+=1
+                continue
             if isinstance(msg,Settings):
                 self.battery = msg.battery
+                if msg.units!=self.units:
+                    self.analytics.reset()
                 self.units = msg.units
                 self.auto_off = msg.auto_off
                 self.beep_on = msg.beep_on
+                # Settings answer the ident, no refresh is needed
+                self.keepalive.last_ident=now
+                if not self.settings_received:
+                    self.settings_received=True
+                    if self.weight_received:
+                        self.ready.set()
             elif isinstance(msg,Message):
                 if msg.msgType==5:
                     self.weight=msg.value
-                    logging.debug('weight: ' + str(msg.value)+' '+str(time.time()))
+                    self.series.append(now,msg.value,self.clock.scale_time(now))
+                    self.analytics.add(now,msg.value)
+                    if not self.weight_received:
+                        self.weight_received=True
+                        if self.settings_received:
+                            self.ready.set()
+                    if root.isEnabledFor(logging.DEBUG):
+                        logging.debug('weight: ' + str(msg.value)+' '+str(time.time()))
                 elif msg.msgType==7:
-                    self.timer_start_time=time.time()-msg.time
-                    self.timer_running=True
+                    self.clock.observe(now,msg.time)
+                elif msg.msgType==11:
+                    if self.heartbeat_sent is not None:
+                        self.clock.round_trip(now,now-self.heartbeat_sent)
+                        self.heartbeat_sent=None
+                    if msg.time is not None and self.clock.running:
+                        self.clock.observe(now,msg.time)
+                elif msg.msgType==8 and msg.button=='tare':
+                    self.analytics.reset()
                 elif msg.msgType==8 and msg.button=='start':
-                    self.timer_start_time=time.time()-self.paused_time+self.transit_delay
-                    self.timer_running=True
+                    self.clock.start(now)
                 elif msg.msgType==8 and msg.button=='stop':
-                    self.paused_time = msg.time
-                    self.timer_running=False
+                    self.clock.stop(msg.time)
                 elif msg.msgType==8 and msg.button=='reset':
-                    self.paused_time = 0
-                    self.timer_running=False
-
-
-    def connect(self):
+                    self.clock.reset()
+                if self.commands.pending:
+                    for command in self.commands.acknowledge(msg,now):
+                        if command.name=='tare':
+                            # Weights from before the tare would show
+                            # as a flow
+                            self.analytics.reset()
+            if profiler is not None:
+                t=profiler.lap('update',t)
+            for sink in self.sinks:
+                sink(msg,now)
+            if profiler is not None:
+                t=profiler.lap('sinks',t)
+
+
+    def connect(self,timeout=10):
+        """Connect and return once the scale has sent its settings and
+           a first weight, raise TimeoutError if that takes more than
+           timeout seconds.  The duration of each phase, 'link', 'mtu',
+           'discovery', 'subscribe', 'ident' and 'first_sample', and the
+           'total' are stored in connect_timings.
+        """
 
         if self.connected:
             return
 
+        deadline=time.monotonic()+timeout
+        timings=self.connect_timings={}
+        connect_start=time.monotonic()
+        def phase(name):
+            now=time.monotonic()
+            timings[name]=now-phase.start
+            phase.start=now
+        phase.start=connect_start
+
         self.queue= Queue(self.callback_queue)
 
-        if self.backend=='bluepy':
-            start_connection_time = time.time()
-            while not self.device:
+        while True:
+            self.ready.clear()
+            self.settings_received=False
+            self.weight_received=False
+
+            self._open(timeout,deadline,phase)
+
+            self.notificationsReady()
+            phase('ident')
+
+            cached=self.transport.cached
+            wait=max(0,deadline-time.monotonic())
+            if cached:
+                wait=min(wait,_CACHED_PROFILE_WAIT)
+            if self.ready.wait(wait):
+                break
+            missing=[name for name,received in (('settings',self.settings_received),
+                                                ('weight',self.weight_received))
+                     if not received]
+            self.disconnect()
+            if cached and time.monotonic()<deadline:
+                # The cached handles can be wrong and still writable,
+                # after a firmware update, discover them again
+                logging.debug('No %s with the cached GATT profile, discovering'
+                              % ' or '.join(missing))
+                self.profile_cache.invalidate(self.mac)
+                self.profile_time_saved=None
+                continue
+            raise TimeoutError('Connected to %s but no %s received in %g seconds'
+                               % (self.mac,' or '.join(missing),timeout))
+        phase('first_sample')
+        timings['total']=time.monotonic()-connect_start
+        self.connects+=1
+        logging.debug('Connected in %.0f ms: ' % (timings['total']*1000)
+                      +', '.join('%s %.0f ms' % (k,v*1000) for k,v in timings.items()))
+
+    def _open(self,timeout,deadline,phase):
+        """Open the link and enable the notifications, trying again
+           with backoff until deadline
+        """
+        transport=self.transport
+        steps=(('link',transport.connect),('mtu',transport.exchange_mtu),
+               ('discovery',transport.discover),('subscribe',transport.subscribe))
+        attempt=0
+        while True:
+            try:
+                for step,func in steps:
+                    func()
+                    phase(step)
+                return
+            except Exception as e:
+                self.connect_failures+=1
                 try:
-                    self.device=self.backend_class.Peripheral(self.mac, addrType=self.backend_class.ADDR_TYPE_PUBLIC)
-                    # MTU of 247 required by Pyxis for long notification payloads,
-                    # not sure if it is needed for older scales
-                    self.device.setMTU(247)
-                except Exception as e:
-                    self.device = None
-                    logging.debug("Failed connection attempt "+str(e))
-                    # GIve up after 10 seconds, probably the scale is not on
-                    if time.time()-start_connection_time > 10:
-                        raise e
-            self.device=self.device.withDelegate(self)
-            foundCommandChar=False
-            foundWeightChar=False
-            pyxisWeightChar=None
-
-            if self.char_uuid:
-                self.char=self.device.getCharacteristics(uuid=self.char_uuid)[0]
-                foundCommandChar=True
-                self.isPyxisStyle=False
-                if self.weight_uuid:
-                    pyxisWeightChar=self.device.getCharacteristics(uuid=self.weight_uuid)[0]
-                    self.isPyxisStyle=True
-                logging.debug("Overriding characteristic UUIDs from constructor")
-                foundWeightChar=True
-            else:
-                from bluepy.btle import UUID
-                # Get all the characteristics to decide if we 
-                # are connecting to an older scale or or a new Pyxis
-                characteristics = self.device.getCharacteristics()
-                pyxisWeightChar = None
-                for char in characteristics:
-                    if char.uuid==UUID('49535343-8841-43f4-a8d4-ecbe34729bb3'):
-                        logging.debug("Has Pyxis-style command char")
-                        self.char = char
-                        self.char_uuid = str(self.char.uuid)
-                        self.isPyxisStyle=True
-                        foundCommandChar=True
-                    elif char.uuid==UUID('49535343-1e4d-4bd9-ba61-23c647249616'):
-                        logging.debug("Has Pyxis-style weight char")
-                        pyxisWeightChar = char
-                        self.weight_uuid = str(pyxisWeightChar.uuid)
-                        foundWeightChar=True
-                    elif char.uuid==UUID('00002a80-0000-1000-8000-00805f9b34fb'):
-                        logging.debug("Has old-style char")
-                        self.char = char
-                        self.char_uuid = str(self.char.uuid)
-                        # command and weight in the same characteristic
-                        self.isPyxisStyle=False
-                        foundCommandChar=True
-                        foundWeightChar=True
-
-            if not foundCommandChar:
-                raise Exception("Could not find command characteristic")
-
-            # Subscribe to notifications
-            if self.isPyxisStyle:
-                notifyDescriptors = pyxisWeightChar.getDescriptors(forUUID='2902',
-                        hndEnd=pyxisWeightChar.valHandle+3)
-                if notifyDescriptors:
-                    self.device.writeCharacteristic(
-                         notifyDescriptors[0].handle,
-                         bytearray([0x01,0x00]),True)
-                    foundWeightChar=True
-            else:
-                # Old-style scale: Hardcoded write to client config descriptor
-                # which uses the same characteristic as the command
-                # characteristic.  Instead of hardcoding,
-                # this could probably be done like the Pyxis style
-                self.device.writeCharacteristic(14,bytearray([0x01,0x00]))
-                foundWeightChar=True
-
-            if not foundWeightChar:
-                raise Exception("Could not find weight characteristic");
-
-        elif self.backend=='pygatt':
-            # Only old-style supported with pygatt now
-            if not self.char_uuid:
-                self.char_uuid='00002a80-0000-1000-8000-00805f9b34fb'
-            self.adapter = self.backend_class(self.iface)
-            self.adapter.reset()
-            self.adapter.start(False)
-            self.device = self.adapter.connect(self.mac)
-            self.device.subscribe(self.char_uuid, self.characteristicValueChanged)
-            self.handle=self.device.get_handle(self.char_uuid)
-
-        self.notificationsReady()
-        time.sleep(0.5)
+                    transport.close()
+                except Exception:
+                    pass
+                # Give up at the deadline, probably the scale is not on
+                if time.monotonic() >= deadline:
+                    raise TimeoutError('Could not connect to %s in %g seconds, %s failed: %s'
+                                       % (self.mac,timeout,step,e))
+                # Exponential backoff with jitter between attempts
+                delay=min(_CONNECT_BACKOFF_MAX,_CONNECT_BACKOFF*2**attempt)
+                delay=min(delay*random.uniform(0.5,1.0),deadline-time.monotonic())
+                attempt+=1
+                logging.debug("Failed connection attempt %d at %s, retrying in %.2f s: %s"
+                              % (attempt,step,delay,e))
+                time.sleep(max(0,delay))
+
+    def connect_async(self,timeout=10):
+        """Connect in a background thread.  Return a
+           concurrent.futures.Future of connect_timings
+        """
+        future=Future()
+        def run():
+            try:
+                self.connect(timeout)
+                future.set_result(self.connect_timings)
+            except Exception as e:
+                future.set_exception(e)
+        thread=Thread(target=run,name='AcaiaConnect')
+        thread.daemon=True
+        thread.start()
+        return future
+
+    def write(self,packet,withResponse=False,kind='command'):
+        """Write to the command characteristic.  kind is what the write
+           is counted as in write_meter
+        """
+        recorder=self.recorder
+        if recorder:
+            recorder.command(self.char_handle,packet)
+        start=time.perf_counter()
+        self.transport.write(packet,withResponse)
+        now=time.monotonic()
+        self.write_meter.add(kind,now,time.perf_counter()-start)
+        self.keepalive.last_write=now
+
+    def record(self,path):
+        """Append every notification and command to the capture file
+           path, until stop_recording().  See pyacaia.capture
+        """
+        from .capture import CaptureWriter
+        self.stop_recording()
+        recorder=CaptureWriter(path)
+        if self.settings_received:
+            # The scale sent its settings before the capture starts,
+            # a replay needs them to connect
+            recorder.notification(self.notify_handle,
+                                  encodeSettings(self.battery or 0,self.units,
+                                                 self.auto_off or 0,self.beep_on))
+        self.recorder=recorder
+
+    def stop_recording(self):
+        recorder=self.recorder
+        self.recorder=None
+        if recorder:
+            recorder.close()
+
+    def replay(self,path):
+        """Feed the notifications of a capture file through
+           handleNotification() as fast as possible.  Return the number
+           of notifications and the seconds it took.  The scale must
+           not be connected, its I/O thread handles the notifications
+        """
+        from .capture import CaptureReader, NOTIFICATION
+        if self.connected:
+            raise Exception('Can not replay on a connected scale')
+        if self.queue is None:
+            self.queue=Queue(self.callback_queue)
+        reader=CaptureReader(path)
+        count=0
+        start=time.monotonic()
+        try:
+            for timestamp,kind,handle,data in reader.records(NOTIFICATION):
+                self.handleNotification(handle,data)
+                count+=1
+        finally:
+            reader.close()
+        return count,time.monotonic()-start
 
     def auto_connect(self):
         if self.connected:
             return
         logging.info('Trying to find an ACAIA scale...')
-        addresses=find_acaia_devices()
+        # A scale seen by the scanner in the last ttl seconds is used
+        # without scanning again
+        addresses=find_acaia_devices(backend=self.backend,first=True,iface=self.iface,
+                                     max_age=get_scanner(self.backend,self.iface).ttl)
 
         #This will connect to the first discovered
         if addresses:
             device_address=addresses[0]
             logging.info('Connecting to:%s' % device_address)
+            self.mac=device_address
             self.connect()
         else:
             logging.info('No ACAIA scale found')
 
     def notificationsReady(self):
+        self.keepalive=HeartbeatPolicy.for_model(self.model,**self.heartbeat_options)
         self.ident()
-        self.last_heartbeat = time.time()
+        self.last_heartbeat = time.monotonic()
+        self.keepalive.reset(self.last_heartbeat)
         logging.info('Scale Ready!')
         self.connected = True
-        if self.backend=='bluepy':
-            # For bluepy, use waitForNotifications() instead of Timer,
-            # see notes in heartbeat()
-            self.set_interval_thread=setInterval(self.heartbeat,0)
-        elif self.backend=='pygatt':
-            self.set_interval_thread=setInterval(self.heartbeat,5)
+        if self.io_driver:
+            # An event loop or hub does the I/O for this scale
+            self.io_driver.add(self)
+            return
+        # Wait for notifications instead of sleeping, see notes in
+        # heartbeat()
+        self.set_interval_thread=Scheduler(self.heartbeat,0)
         self.set_interval_thread.start()
 
     def ident(self):
-        if self.backend=='bluepy':
-            self.char.write(encodeId(self.isPyxisStyle), withResponse=False)
-            self.char.write(encodeNotificationRequest(), withResponse=False)
-        elif self.backend=='pygatt':
-            self.device.char_write(self.char_uuid,encodeId(self.isPyxisStyle),wait_for_response=False)
-            self.device.char_write(self.char_uuid,encodeNotificationRequest(),wait_for_response=False)
+        self.write(encodeId(self.isPyxisStyle),kind='ident')
+        self.write(encodeNotificationRequest(**self.notifications),kind='notifications')
 
         return True
 
@@ -642,38 +1700,15 @@ class AcaiaScale(object):
             return False
 
         try:
-            if self.backend=='bluepy':
-                # for bluepy, instead of waking up for a heartbeat, we 
-                # do a waitForNotifications so that notifications from heartbeat
-                # and notifications from waitForNotifications happen in the same
-                # thread.  setInterval object calls heartbeat() without any 
-                # timer delay
-                self.device.waitForNotifications(1)
-                while True:
-                    # Send queued up commands in this heartbeat thread
-                    packet = self.command_queue.dequeue()
-                    if packet: 
-                        self.char.write(packet,withResponse=False)
-                    else:
-                        break
-                if time.time() >= self.last_heartbeat+1:
-                    # The official app sends a more complex heartbeat to Pyxis, once per
-                    # second.  Not sure if this complex heartbeat is sent to
-                    # older scales.  The Pyxis heartbeat has 3 messages:
-                    # encodeId(True), encodeHeartbeat(), encodeGetSettings()
-                    # But the Pyxis seems to work just fine with the single encodeHearbeat()
-                    # once every 5 seconds as in the earlier scales.
-                    self.last_heartbeat=time.time()
-                    if self.isPyxisStyle:
-                        self.char.write(encodeId(self.isPyxisStyle))
-                    self.char.write(encodeHeartbeat(), withResponse=False)
-                    # We get settings with the encodeId(), so commenting ths out for now
-                    #if self.isPyxisStyle:
-                    #    self.char.write(encodeGetSettings(), withResponse=False)
-                    logging.debug('Heartbeat success')
-            elif self.backend=='pygatt':
-                self.device.char_write_handle(self.handle,encodeHeartbeat(),wait_for_response=False)
-                logging.debug('Heartbeat success')
+            # Instead of waking up for a heartbeat, we wait for
+            # notifications so that notifications from heartbeat and
+            # notifications from waitForNotifications happen in the same
+            # thread.  Scheduler object calls heartbeat() without any
+            # timer delay.  Queued commands wake the wait up, so they
+            # are written right away, with every backend.
+            self.wait_io(max(0,self.next_deadline()-time.monotonic()))
+            self.io_wakeups+=1
+            self.service()
 
             return True
         except Exception as e:
@@ -683,62 +1718,316 @@ class AcaiaScale(object):
             except:
                 return False
 
+    def send_keepalive(self,now):
+        """Send the ident refresh and the heartbeat if they are due,
+           see HeartbeatPolicy
+        """
+        keepalive=self.keepalive
+        deadline=keepalive.next_deadline()
+        if now<deadline:
+            return
+        self.heartbeat_jitter.add(now-deadline)
+        # The official app sends a more complex heartbeat to Pyxis, once per
+        # second: encodeId(True), encodeHeartbeat(), encodeGetSettings()
+        # The ident is only refreshed every ident_interval here, without
+        # response, and counts as the heartbeat.  We get settings with the
+        # encodeId(), so encodeGetSettings() is not sent
+        if keepalive.ident_due(now):
+            self.write(encodeId(self.isPyxisStyle),kind='ident')
+            keepalive.last_ident=now
+        elif keepalive.heartbeat_due(now):
+            self.send_heartbeat()
+        self.last_heartbeat=now
+
+    def send_heartbeat(self):
+        self.write(encodeHeartbeat(),kind='heartbeat')
+        # Its response measures the round trip, see ClockSync
+        self.heartbeat_sent=time.monotonic()
+        logging.debug('Heartbeat success')
+
+    def next_deadline(self):
+        """Monotonic time at which service() has work to do"""
+        deadline=self.keepalive.next_deadline()
+        command_deadline=self.commands.next_deadline()
+        if command_deadline is not None and command_deadline<deadline:
+            return command_deadline
+        return deadline
+
+    def service(self):
+        """Resend unacknowledged commands, write the queued ones and
+           send the heartbeat if it is due.  Called from the I/O thread,
+           or by an io_driver when the command queue or next_deadline()
+           wakes it up.
+        """
+        self.resend_commands()
+        self.flush_commands()
+        self.send_keepalive(time.monotonic())
+
+    def notification_fd(self):
+        """File descriptor that is readable when notifications are
+           pending, or None if the backend does not provide one
+        """
+        return self.transport.fileno()
+
+    def wait_io(self,timeout):
+        """Wait up to timeout seconds for notifications or queued
+           commands, handling the notifications that arrived
+        """
+        fd=self.notification_fd()
+        if fd is None:
+            self.transport.wait(timeout,self.command_queue)
+            return
+        readable,_,_=select.select([fd,self.command_queue.fileno()],[],[],timeout)
+        if fd in readable:
+            self.read_notifications()
+
+    def read_notifications(self):
+        """Handle the notifications that are pending, without blocking"""
+        self.transport.poll()
+
+    def flush_commands(self):
+        """Write the queued commands, from the I/O thread"""
+        self.command_queue.clear_wakeup()
+        while True:
+            entry=self.command_queue.pop()
+            if not entry:
+                break
+            packet,queued_time,command=entry
+            self.write(packet)
+            self.command_queue.written(packet,queued_time)
+            if command:
+                self.commands.sent(command,self.weight)
+
+    def resend_commands(self):
+        """Send again the commands that were not acknowledged in time"""
+        for command in self.commands.expire():
+            logging.debug('Retrying '+command.name)
+            self.send_command(command.packet,command)
+
+    def send_command(self,packet,command=None):
+        """Queue packet, the I/O thread writes it"""
+        self.command_queue.add(packet,command)
+
+    def command(self,name,packet):
+        """Send a command, return a concurrent.futures.Future resolved
+           with the Message that shows the scale applied it
+        """
+        command=self.commands.add(name,packet)
+        self.send_command(packet,command)
+        return command.future
 
     def tare(self):
         if not self.connected:
             return False
-        if self.backend=='bluepy':
-            self.command_queue.add(encodeTare())
-        elif self.backend=='pygatt':
-            self.device.char_write(self.char_uuid,encodeTare(),wait_for_response=False)
-
-        return True
+        return self.command('tare',encodeTare())
 
     def startTimer(self):
         if not self.connected:
             return False
-        if self.backend=='bluepy':
-            self.command_queue.add(encodeStartTimer())
-        elif self.backend=='pygatt':
-            self.device.char_write(self.char_uuid,encodeStartTimer(),wait_for_response=False)
-        self.timer_start_time = time.time()
-        self.timer_running=True
+        future=self.command('start',encodeStartTimer())
+        # Until the scale acknowledges it, a round trip from now
+        self.clock.start(time.monotonic()+2*self.clock.delay)
+        return future
 
     def stopTimer(self):
         if not self.connected:
             return False
-        if self.backend=='bluepy':
-            self.command_queue.add(encodeStopTimer())
-        elif self.backend=='pygatt':
-            self.device.char_write(self.char_uuid,encodeStopTimer(),wait_for_response=False)
-
-        self.paused_time = time.time()-self.timer_start_time
-        self.timer_running=False
+        future=self.command('stop',encodeStopTimer())
+        self.clock.stop()
+        return future
 
     def resetTimer(self):
         if not self.connected:
             return False
-        if self.backend=='bluepy':
-            self.command_queue.add(encodeResetTimer())
-        elif self.backend=='pygatt':
-            self.device.char_write(self.char_uuid,encodeResetTimer(),wait_for_response=False)
-        self.paused_time=0
-        self.timer_running=False
+        future=self.command('reset',encodeResetTimer())
+        self.clock.reset()
+        return future
+
+    def set_notifications(self,**notifications):
+        """Change the arguments of encodeNotificationRequest(), for
+           instance set_notifications(weight=2), now if connected and
+           at the next connections
+        """
+        self.notifications.update(notifications)
+        if self.connected:
+            self.send_command(encodeNotificationRequest(**self.notifications))
 
-    def disconnect(self):
+    def subscribe(self,kind,handler,maxlen=256,overflow=DROP_OLDEST,block_timeout=1.0):
+        """Call handler from its own thread for every item of kind, see
+           pyacaia.dispatch.  Return the Subscription, close() it to stop
+        """
+        if self.dispatcher is None:
+            self.dispatcher=Dispatcher(self)
+            self.sinks.append(self.dispatcher)
+        return self.dispatcher.subscribe(kind,handler,maxlen=maxlen,overflow=overflow,
+                                         block_timeout=block_timeout)
+
+    def on_weight(self,handler,**kwargs):
+        """handler(WeightSample(time, weight, timer)) for every weight"""
+        return self.subscribe(WEIGHT,handler,**kwargs)
+
+    def on_button(self,handler,**kwargs):
+        """handler(ButtonEvent(time, button, weight, timer)) for the
+           tare and timer buttons, pressed or sent as commands
+        """
+        return self.subscribe(BUTTON,handler,**kwargs)
+
+    def on_settings(self,handler,**kwargs):
+        """handler(Settings) every time the scale sends them"""
+        return self.subscribe(SETTINGS,handler,**kwargs)
+
+    def on_disconnect(self,handler,**kwargs):
+        """handler(time) when the scale is disconnected"""
+        return self.subscribe(DISCONNECT,handler,**kwargs)
+
+    def trigger_engine(self):
+        if self.triggers is None:
+            from .trigger import TriggerEngine
+            self.triggers=TriggerEngine(self)
+            # Before the other sinks, to react as soon as possible
+            self.sinks.insert(0,self.triggers)
+        return self.triggers
+
+    def when_weight(self,target,callback,rising=True,lead=None,once=True):
+        """Call callback(TriggerEvent) in the I/O thread when the weight
+           reaches target, lead seconds early at the current flow rate.
+           lead defaults to the measured latency, see pyacaia.trigger.
+           With once, a trigger that has not fired is removed when the
+           shot ends.  Return the Trigger, cancel() it to remove it
+        """
+        return self.trigger_engine().add(callback,target=target,rising=rising,lead=lead,
+                                         once=once)
 
-        self.connected=False
-        if self.device:
+    def when(self,predicate,callback,once=True):
+        """Call callback(TriggerEvent) in the I/O thread when
+           predicate(weight, flow) becomes true
+        """
+        return self.trigger_engine().add(callback,predicate=predicate,once=once)
 
-            if self.backend=='pygatt':
-                self.device.disconnect()
-                self.adapter.stop()
+    def io_stats(self):
+        """Writes per kind and per minute, the time each write blocked
+           the I/O thread, its wakeups and the heartbeat jitter
+        """
+        stats=self.write_meter.as_dict(time.monotonic())
+        stats['wakeups']=self.io_wakeups
+        stats['heartbeat_interval']=self.keepalive.interval
+        stats['heartbeat_jitter']=self.heartbeat_jitter.as_dict()
+        return stats
+
+    def stats(self,since=None):
+        """Counters and histograms of the notification pipeline, the
+           command queue and the I/O, see pyacaia.metrics.  The rates of
+           notifications and bytes are since the 'mark' of an earlier
+           stats(), or since the scale was created, so that callers
+           do not reset each other's rates:
+
+               stats=scale.stats(stats['mark'])
+
+           The time spent in each stage is only there after
+           enable_metrics()
+        """
+        now=time.monotonic()
+        notifications=self.notifications_received
+        received=self.bytes_received
+        # Counters cost less than meters in the I/O thread
+        mark,mark_notifications,mark_bytes=since or self.stats_mark
+        elapsed=now-mark
+        io=self.io_stats()
+        stats={
+            'notifications': notifications,
+            'notifications_per_s': (notifications-mark_notifications)/elapsed if elapsed else 0.0,
+            'bytes': received,
+            'bytes_per_s': (received-mark_bytes)/elapsed if elapsed else 0.0,
+            'frames': self.framer.frames,
+            'garbage_bytes': self.framer.garbage,
+            'unknown_frames': self.unknown_frames,
+            'checksum_failures': self.checksum_failures,
+            'decode_errors': self.decode_errors,
+            'weights': self.weight_meter.count,
+            'weights_per_s': self.weight_rate,
+            'decimated': self.decimated,
+            'notification_queue_max': self.queue.max_depth if self.queue else 0,
+            'command_queue': {
+                'depth': len(self.command_queue),
+                'max_depth': self.command_queue.max_depth,
+                'wait': self.command_queue.wait_time.as_dict(),
+            },
+            'command_latency': dict((name,histogram.as_dict())
+                                    for name,histogram in self.commands.latency.items()),
+            'heartbeat_interval': io['heartbeat_interval'],
+            'heartbeat_jitter': io['heartbeat_jitter'],
+            'writes': io['writes'],
+            'writes_per_minute': io['writes_per_minute'],
+            'write_stall': io['stall'],
+            'wakeups': io['wakeups'],
+            'connects': self.connects,
+            'reconnects': max(0,self.connects-1),
+            'connect_failures': self.connect_failures,
+            'clock': self.clock.as_dict(),
+            'mark': (now,notifications,received),
+        }
+        if self.profiler is not None:
+            stats['stages']=self.profiler.as_dict()
+        return stats
+
+    def enable_metrics(self,hooks=()):
+        """Time the stages of the notification pipeline, calling
+           hook(stage, seconds) for each measurement.
+           Return the pyacaia.metrics.Profiler
+        """
+        from .metrics import Profiler
+        self.profiler=Profiler(hooks)
+        return self.profiler
+
+    def disable_metrics(self):
+        self.profiler=None
+
+    def publish_state(self,window=1024):
+        """Publish the state of the scale and its last window weight
+           samples in shared memory, for pyacaia.shm.StateReader
+        """
+        if self.publisher is None:
+            from .shm import StatePublisher
+            self.publisher=StatePublisher(self,window)
+            self.sinks.append(self.publisher)
+        return self.publisher
+
+    def stop_publishing(self):
+        publisher=self.publisher
+        self.publisher=None
+        if publisher:
+            self.sinks.remove(publisher)
+            publisher.close()
+
+    def subscriptions(self):
+        """Queue depth, lag and drop counters of every subscription"""
+        if self.dispatcher is None:
+            return []
+        return self.dispatcher.stats()
 
-            elif self.backend=='bluepy':
-                self.device.disconnect()
-        self.set_interval_thread.stop()
-        self.set_interval_thread.join()
+    def disconnect(self):
 
+        was_connected=self.connected
+        self.connected=False
+        self.transport.close()
+        if self.io_driver:
+            self.io_driver.remove(self)
+        if self.set_interval_thread:
+            self.set_interval_thread.stop()
+            # disconnect() is also called from the heartbeat thread itself
+            if self.set_interval_thread is not current_thread():
+                self.set_interval_thread.join()
+        self.command_queue.close()
+        self.commands.cancel_all()
+        if self.dispatcher and was_connected:
+            self.dispatcher.disconnected(time.monotonic())
+        if self.publisher:
+            self.publisher.update(time.monotonic())
+
+
+
+from .aio import AsyncAcaiaScale
+from .hub import AcaiaHub
 
 
 def main():
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Luca Pinello
+# Released under GPLv3
+
+"""asyncio interface to the Acaia scales.
+
+   AsyncAcaiaScale drives an AcaiaScale from the event loop instead of a
+   thread: the notification and command queue file descriptors are
+   registered with loop.add_reader() and the heartbeat is scheduled on
+   the loop, so one loop can drive several scales.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+from . import AcaiaScale, Message, Settings
+from .dispatch import WeightSample, DROP_OLDEST, COALESCE_LATEST
+
+
+class Stream(object):
+    """Bounded buffer read with async for.
+
+       When maxlen items are buffered, DROP_OLDEST discards the oldest
+       one and COALESCE_LATEST replaces the newest one, so a slow reader
+       still sees the latest value.  The number of items discarded or
+       replaced is counted in dropped.
+    """
+
+    def __init__(self,owner,maxlen,overflow):
+        if overflow not in (DROP_OLDEST,COALESCE_LATEST):
+            raise Exception('Unknown overflow policy %s' % overflow)
+        self.owner=owner
+        self.maxlen=maxlen
+        self.overflow=overflow
+        self.buffer=deque()
+        self.dropped=0
+        self.closed=False
+        self.waiter=None
+
+    def put(self,item):
+        if len(self.buffer)>=self.maxlen:
+            self.dropped+=1
+            if self.overflow==DROP_OLDEST:
+                self.buffer.popleft()
+            else:
+                self.buffer[-1]=item
+                return
+        self.buffer.append(item)
+        self._wakeup()
+
+    def close(self):
+        self.closed=True
+        self.owner._remove_stream(self)
+        self._wakeup()
+
+    def _wakeup(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.buffer:
+            if self.closed:
+                raise StopAsyncIteration
+            self.waiter=asyncio.get_running_loop().create_future()
+            await self.waiter
+        return self.buffer.popleft()
+
+
+class AsyncAcaiaScale(object):
+    """AcaiaScale with awaitable commands and async streams of weight
+       samples and events.  The arguments are the ones of AcaiaScale,
+       and its attributes (weight, battery, units...) can be read here.
+
+           scale=AsyncAcaiaScale(mac='00:1C:97:17:FD:97')
+           await scale.connect()
+           await scale.tare()
+           async for sample in scale.weights():
+               print(sample.time, sample.weight)
+    """
+
+    def __init__(self,*args,**kwargs):
+        self.scale=AcaiaScale(*args,**kwargs)
+        self.scale.io_driver=self
+        self.scale.sinks.append(self._on_message)
+        self.loop=None
+        self.loop_thread=None
+        self.timer=None
+        self.deadline=None
+        self.weight_streams=[]
+        self.event_streams=[]
+
+    def __getattr__(self,name):
+        return getattr(self.scale,name)
+
+    async def connect(self,timeout=10):
+        self.loop=asyncio.get_running_loop()
+        self.loop_thread=threading.get_ident()
+        await self.loop.run_in_executor(None,self.scale.connect,timeout)
+
+    async def disconnect(self):
+        self.remove(self.scale)
+        await self.loop.run_in_executor(None,self.scale.disconnect)
+        for stream in self.weight_streams+self.event_streams:
+            stream.closed=True
+            stream._wakeup()
+
+    async def _command(self,future):
+        if future is False:
+            raise Exception('Scale is not connected')
+        return await asyncio.wrap_future(future)
+
+    async def tare(self):
+        return await self._command(self.scale.tare())
+
+    async def startTimer(self):
+        return await self._command(self.scale.startTimer())
+
+    async def stopTimer(self):
+        return await self._command(self.scale.stopTimer())
+
+    async def resetTimer(self):
+        return await self._command(self.scale.resetTimer())
+
+    def weights(self,maxlen=256,overflow=DROP_OLDEST):
+        """Stream of WeightSample(time, weight, timer), time is the
+           time.monotonic() the notification was received
+        """
+        stream=Stream(self,maxlen,overflow)
+        self.weight_streams.append(stream)
+        return stream
+
+    def events(self,maxlen=64,overflow=DROP_OLDEST):
+        """Stream of button Messages and Settings"""
+        stream=Stream(self,maxlen,overflow)
+        self.event_streams.append(stream)
+        return stream
+
+    def _remove_stream(self,stream):
+        for streams in (self.weight_streams,self.event_streams):
+            if stream in streams:
+                streams.remove(stream)
+
+    def _on_message(self,msg,now):
+        if isinstance(msg,Message):
+            if msg.msgType==5:
+                if not self.weight_streams:
+                    return
+                item=WeightSample(now,msg.value,self.scale.get_scale_time(now))
+                streams=self.weight_streams
+            elif msg.msgType==8:
+                item=msg
+                streams=self.event_streams
+            else:
+                return
+        elif isinstance(msg,Settings):
+            item=msg
+            streams=self.event_streams
+        else:
+            return
+        if threading.get_ident()==self.loop_thread:
+            self._publish(streams,item)
+        else:
+            # pygatt calls back from its own thread
+            self.loop.call_soon_threadsafe(self._publish,streams,item)
+
+    def _publish(self,streams,item):
+        for stream in streams:
+            stream.put(item)
+
+    # io_driver interface, see AcaiaScale.notificationsReady()
+
+    def add(self,scale):
+        if threading.get_ident()!=self.loop_thread:
+            self.loop.call_soon_threadsafe(self.add,scale)
+            return
+        fd=scale.notification_fd()
+        if fd is not None:
+            self.loop.add_reader(fd,self._run,scale.read_notifications)
+        self.loop.add_reader(scale.command_queue.fileno(),self._run,scale.service)
+        self._schedule()
+
+    def remove(self,scale):
+        if self.loop is None:
+            return
+        if threading.get_ident()!=self.loop_thread:
+            self.loop.call_soon_threadsafe(self.remove,scale)
+            return
+        fd=scale.notification_fd()
+        if fd is not None:
+            self.loop.remove_reader(fd)
+        if scale.command_queue.wake_r is not None:
+            self.loop.remove_reader(scale.command_queue.wake_r)
+        if self.timer:
+            self.timer.cancel()
+            self.timer=None
+
+    def _schedule(self):
+        deadline=self.scale.next_deadline()
+        # Keep an earlier timer, see AcaiaHub._schedule()
+        if self.timer and self.deadline<=deadline:
+            return
+        if self.timer:
+            self.timer.cancel()
+        self.deadline=deadline
+        self.timer=self.loop.call_later(max(0,deadline-time.monotonic()),self._on_timer)
+
+    def _on_timer(self):
+        self.timer=None
+        self._run(self.scale.service)
+
+    def _run(self,func):
+        if not self.scale.connected:
+            return
+        try:
+            func()
+            self._schedule()
+        except Exception as e:
+            logging.debug('Scale I/O failed '+str(e))
+            self.remove(self.scale)
+            try:
+                self.scale.disconnect()
+            except Exception:
+                pass
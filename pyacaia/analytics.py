@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Luca Pinello
+# Released under GPLv3
+
+"""Flow rate and stability of the weight, updated with every sample.
+
+   FlowEstimator keeps the samples of the last window seconds with the
+   running means and co-moments of their times and weights (Welford's
+   method, adding the new sample and removing the expired ones), so each
+   update takes constant time however many samples are in the window.
+   The flow is the least squares slope of the weight, and the weight is
+   stable when its standard deviation and the flow are both small.
+
+   Weights are the signed values in the units of the scale, as decoded
+   by Message._decode_weight; reset() when the units change.
+"""
+
+from collections import deque
+
+
+class FlowEstimator(object):
+
+    def __init__(self,window=1.0,stable_deviation=0.1,stable_flow=0.2,min_samples=3):
+        """window in seconds, stable_deviation in the units of the
+           weight, stable_flow in units per second
+        """
+        self.window=window
+        self.stable_deviation=stable_deviation
+        self.stable_flow=stable_flow
+        self.min_samples=min_samples
+        self.samples=deque()
+        self.reset()
+
+    def reset(self):
+        self.samples.clear()
+        self.n=0
+        self.mean_t=0.0
+        self.mean_w=0.0
+        # Sums of squared deviations and of cross deviations
+        self.m2_t=0.0
+        self.m2_w=0.0
+        self.c_tw=0.0
+
+    def add(self,t,weight):
+        samples=self.samples
+        samples.append((t,weight))
+        n=self.n+1
+        mean_t=self.mean_t
+        mean_w=self.mean_w
+        dt=t-mean_t
+        dw=weight-mean_w
+        mean_t+=dt/n
+        mean_w+=dw/n
+        dw2=weight-mean_w
+        self.m2_t+=dt*(t-mean_t)
+        self.m2_w+=dw*dw2
+        self.c_tw+=dt*dw2
+        self.mean_t=mean_t
+        self.mean_w=mean_w
+        self.n=n
+        if samples[0][0]<t-self.window:
+            start=t-self.window
+            while samples[0][0]<start:
+                self._remove(*samples.popleft())
+
+    def _remove(self,t,weight):
+        n=self.n-1
+        if n==0:
+            self.reset()
+            return
+        dt=t-self.mean_t
+        dw=weight-self.mean_w
+        self.mean_t-=dt/n
+        self.mean_w-=dw/n
+        self.m2_t-=dt*(t-self.mean_t)
+        self.m2_w-=dw*(weight-self.mean_w)
+        self.c_tw-=dt*(weight-self.mean_w)
+        self.n=n
+
+    @property
+    def flow(self):
+        """Slope of the weight in units per second, 0 with less than
+           min_samples samples
+        """
+        if self.n<self.min_samples or self.m2_t<=0:
+            return 0.0
+        return self.c_tw/self.m2_t
+
+    @property
+    def variance(self):
+        if self.n<2:
+            return 0.0
+        # Rounding can leave a tiny negative sum
+        return max(0.0,self.m2_w/(self.n-1))
+
+    @property
+    def deviation(self):
+        return self.variance**0.5
+
+    @property
+    def stable(self):
+        return (self.n>=self.min_samples
+                and self.variance<=self.stable_deviation**2
+                and abs(self.flow)<=self.stable_flow)
+
+
+class RateMeter(object):
+    """Events per second, from a moving average of the intervals
+       between them
+    """
+
+    def __init__(self,smoothing=0.1):
+        self.smoothing=smoothing
+        self.count=0
+        self.last=None
+        self.interval=None
+
+    def add(self,now):
+        last=self.last
+        if last is not None:
+            if self.interval is None:
+                self.interval=now-last
+            else:
+                self.interval+=self.smoothing*(now-last-self.interval)
+        self.last=now
+        self.count+=1
+
+    def rate(self,now=None):
+        """0 when no event came in the last 5 intervals before now"""
+        interval=self.interval
+        if not interval:
+            return 0.0
+        if now is not None and now-self.last>5*interval:
+            return 0.0
+        return 1.0/interval
@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Luca Pinello
+# Released under GPLv3
+
+"""Links to the scales behind one interface, looked up by name.
+
+   AcaiaScale(backend=name) and AcaiaScanner create the backend
+   registered under name in BACKENDS.  A backend imports its Bluetooth
+   library when it is created, so importing pyacaia imports neither
+   bluepy nor pygatt.  Other transports can be registered:
+
+       register_backend('mylink',MyBackend)
+       scale=AcaiaScale(mac,backend='mylink')
+
+   A backend implements:
+
+       scan(deadline,found,done)   call found(name,address,rssi) for the
+                                   devices seen, until deadline or done()
+       connect()                   open the link to scale.mac, return the
+                                   device
+       exchange_mtu()              negotiate the MTU of the link
+       discover()                  find the command characteristic and
+                                   the notification handles
+       subscribe()                 enable the notifications
+       write(packet,withResponse)  write to the command characteristic
+       fileno()                    file descriptor readable when
+                                   notifications are pending, or None
+       wait(timeout,commands)      when there is no fileno(), wait for
+                                   notifications or a command queued in
+                                   the CommandQueue commands
+       poll()                      handle the pending notifications
+                                   without blocking
+       close()
+
+   AcaiaScale.connect() calls the four in this order and times each of
+   them, see connect_timings.
+
+   Notifications are passed to scale.handleNotification(), in the thread
+   calling wait() or poll(), or in the thread of the library (pygatt).
+   Whatever the backend, commands are queued and written by the I/O
+   thread of the scale, or by its AcaiaHub or event loop.
+"""
+
+import logging
+import select
+import time
+
+# Timeout used to poll bluepy for notifications without blocking
+_NOTIFY_POLL = 0.001
+
+# Weight characteristic of the old-style scales, also the command one
+OLD_STYLE_CHAR = '00002a80-0000-1000-8000-00805f9b34fb'
+PYXIS_COMMAND_CHAR = '49535343-8841-43f4-a8d4-ecbe34729bb3'
+PYXIS_WEIGHT_CHAR = '49535343-1e4d-4bd9-ba61-23c647249616'
+
+_ENABLE_NOTIFICATIONS = bytearray([0x01,0x00])
+
+
+class Backend(object):
+    """Base of the backends, see the module docstring"""
+
+    name = None
+    # Default heartbeat_options of the scales, see HeartbeatPolicy
+    heartbeat_options = {}
+    # Whether discover() took the handles from the profile cache
+    cached = False
+
+    def __init__(self,scale=None,iface='hci0'):
+        self.scale=scale
+        self.iface=iface
+        self.device=None
+
+    def scan(self,deadline,found,done):
+        raise Exception('Backend %s can not scan' % self.name)
+
+    def connect(self):
+        raise NotImplementedError
+
+    def exchange_mtu(self):
+        pass
+
+    def discover(self):
+        pass
+
+    def subscribe(self):
+        pass
+
+    def write(self,packet,withResponse=False):
+        raise NotImplementedError
+
+    def fileno(self):
+        return None
+
+    def wait(self,timeout,commands):
+        commands.wait(timeout)
+
+    def poll(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class PeripheralBackend(Backend):
+    """Backends whose device is a bluepy Peripheral, or stands in for
+       one.  Subclasses implement open()
+    """
+
+    # MTU of 247 required by Pyxis for long notification payloads,
+    # not sure if it is needed for older scales
+    mtu = 247
+
+    def open(self):
+        raise NotImplementedError
+
+    def connect(self):
+        self.device=None
+        self.device=self.open().withDelegate(self.scale)
+        return self.device
+
+    def exchange_mtu(self):
+        self.device.setMTU(self.mtu)
+
+    def write(self,packet,withResponse=False):
+        self.device.writeCharacteristic(self.scale.char_handle,packet,withResponse)
+
+    def fileno(self):
+        # bluepy reads notifications from the stdout of bluepy-helper
+        helper=getattr(self.device,'_helper',None)
+        if helper is None or helper.stdout is None:
+            return None
+        return helper.stdout.fileno()
+
+    def wait(self,timeout,commands):
+        # Nothing to poll, keep the wait short so commands still go out
+        self.device.waitForNotifications(min(timeout,0.05) or _NOTIFY_POLL)
+
+    def poll(self):
+        fd=self.fileno()
+        # bluepy handles one notification per call.  A zero timeout
+        # would make it block, so check the pipe first
+        while select.select([fd],[],[],0)[0]:
+            self.device.waitForNotifications(_NOTIFY_POLL)
+
+    def close(self):
+        if self.device:
+            self.device.disconnect()
+
+
+class BluepyBackend(PeripheralBackend):
+
+    name = 'bluepy'
+
+    def __init__(self,scale=None,iface='hci0'):
+        PeripheralBackend.__init__(self,scale,iface)
+        try:
+            from bluepy import btle
+        except ImportError:
+            raise Exception('bluepy is not installed')
+        self.btle=btle
+        self.scanner=None
+        self.found=None
+
+    def scan(self,deadline,found,done):
+        if self.scanner is None:
+            # bluepy calls handleDiscovery() for every advertisement
+            self.scanner=self.btle.Scanner(int(self.iface.replace('hci',''))).withDelegate(self)
+        self.found=found
+        self.scanner.clear()
+        self.scanner.start()
+        try:
+            while time.monotonic()<deadline:
+                self.scanner.process(min(0.1,max(0.01,deadline-time.monotonic())))
+                if done():
+                    break
+        finally:
+            self.scanner.stop()
+
+    def handleDiscovery(self,scanEntry,isNewDev,isNewData):
+        # 9 is the Complete Local Name
+        self.found(scanEntry.getValueText(9),scanEntry.addr,scanEntry.rssi)
+
+    def open(self):
+        return self.btle.Peripheral(self.scale.mac,addrType=self.btle.ADDR_TYPE_PUBLIC)
+
+    def discover(self):
+        """Use the handles of the profile cache of the scale, or
+           discover them and cache them
+        """
+        scale=self.scale
+        profile=scale.profile_cache.get(scale.mac)
+        if profile:
+            start=time.monotonic()
+            self.use_profile(profile)
+            self.cached=True
+            scale.profile_time_saved=profile['discovery_time']-(time.monotonic()-start)
+            logging.debug('Using cached GATT profile, saved %.0f ms'
+                          % (scale.profile_time_saved*1000))
+            return
+        self.cached=False
+        start=time.monotonic()
+        self.find_characteristics()
+        scale.profile_cache.put(scale.mac,{
+            'isPyxisStyle': bool(scale.isPyxisStyle),
+            'char_uuid': scale.char_uuid,
+            'weight_uuid': scale.weight_uuid,
+            'char_handle': scale.char_handle,
+            'notify_handle': scale.notify_handle,
+            'discovery_time': time.monotonic()-start,
+        })
+
+    def subscribe(self):
+        """Enable the weight notifications.  A cached handle that turns
+           out to be stale is discovered again
+        """
+        scale=self.scale
+        try:
+            # With a response, so a stale handle raises
+            self.device.writeCharacteristic(scale.notify_handle,_ENABLE_NOTIFICATIONS,True)
+        except Exception as e:
+            if not self.cached:
+                raise
+            logging.debug('Cached GATT profile failed, discovering '+str(e))
+            scale.profile_cache.invalidate(scale.mac)
+            scale.profile_time_saved=None
+            self.discover()
+            self.device.writeCharacteristic(scale.notify_handle,_ENABLE_NOTIFICATIONS,True)
+
+    def find_characteristics(self):
+        """Find the command characteristic of the scale and the
+           descriptor that enables the weight notifications
+        """
+        scale=self.scale
+        device=self.device
+        UUID=self.btle.UUID
+        foundCommandChar=False
+        foundWeightChar=False
+        pyxisWeightChar=None
+
+        if scale.char_uuid:
+            scale.char=device.getCharacteristics(uuid=scale.char_uuid)[0]
+            foundCommandChar=True
+            scale.isPyxisStyle=False
+            if scale.weight_uuid:
+                pyxisWeightChar=device.getCharacteristics(uuid=scale.weight_uuid)[0]
+                scale.isPyxisStyle=True
+            logging.debug("Overriding characteristic UUIDs from constructor")
+            foundWeightChar=True
+        else:
+            # Get all the characteristics to decide if we
+            # are connecting to an older scale or or a new Pyxis
+            for char in device.getCharacteristics():
+                if char.uuid==UUID(PYXIS_COMMAND_CHAR):
+                    logging.debug("Has Pyxis-style command char")
+                    scale.char=char
+                    scale.char_uuid=str(char.uuid)
+                    scale.isPyxisStyle=True
+                    foundCommandChar=True
+                elif char.uuid==UUID(PYXIS_WEIGHT_CHAR):
+                    logging.debug("Has Pyxis-style weight char")
+                    pyxisWeightChar=char
+                    scale.weight_uuid=str(char.uuid)
+                    foundWeightChar=True
+                elif char.uuid==UUID(OLD_STYLE_CHAR):
+                    logging.debug("Has old-style char")
+                    scale.char=char
+                    scale.char_uuid=str(char.uuid)
+                    # command and weight in the same characteristic
+                    scale.isPyxisStyle=False
+                    foundCommandChar=True
+                    foundWeightChar=True
+
+        if not foundCommandChar:
+            raise Exception("Could not find command characteristic")
+        scale.char_handle=scale.char.valHandle
+
+        # Client config descriptor of the weight notifications
+        if scale.isPyxisStyle:
+            notifyDescriptors=pyxisWeightChar.getDescriptors(forUUID='2902',
+                    hndEnd=pyxisWeightChar.valHandle+3)
+            if notifyDescriptors:
+                scale.notify_handle=notifyDescriptors[0].handle
+                foundWeightChar=True
+        else:
+            # Old-style scale: Hardcoded client config descriptor
+            # which uses the same characteristic as the command
+            # characteristic.  Instead of hardcoding,
+            # this could probably be done like the Pyxis style
+            scale.notify_handle=14
+            foundWeightChar=True
+
+        if not foundWeightChar:
+            raise Exception("Could not find weight characteristic")
+
+    def use_profile(self,profile):
+        """Take the handles found by an earlier find_characteristics()"""
+        scale=self.scale
+        scale.isPyxisStyle=profile['isPyxisStyle']
+        scale.char_uuid=profile['char_uuid']
+        scale.weight_uuid=profile['weight_uuid']
+        scale.char_handle=profile['char_handle']
+        scale.notify_handle=profile['notify_handle']
+
+
+class PygattBackend(Backend):
+    """Only old-style scales are supported with pygatt.  pygatt calls
+       scale.characteristicValueChanged() from its own thread
+    """
+
+    name = 'pygatt'
+    # pygatt sends a heartbeat every 5 seconds at most
+    heartbeat_options = {'interval': 5}
+
+    def __init__(self,scale=None,iface='hci0'):
+        Backend.__init__(self,scale,iface)
+        try:
+            from pygatt import GATTToolBackend
+        except ImportError:
+            raise Exception('pygatt is not installed')
+        self.adapter_class=GATTToolBackend
+        self.adapter=None
+
+    def _start_adapter(self):
+        if self.adapter is None:
+            self.adapter=self.adapter_class(self.iface)
+            self.adapter.reset()
+            self.adapter.start(False)
+        return self.adapter
+
+    def scan(self,deadline,found,done):
+        adapter=self._start_adapter()
+        # gatttool scans for a fixed time, scan in short slices
+        while time.monotonic()<deadline:
+            for d in adapter.scan(timeout=min(1,deadline-time.monotonic()),run_as_root=True):
+                found(d['name'],d['address'],d.get('rssi'))
+            if done():
+                break
+
+    def connect(self):
+        self.device=self._start_adapter().connect(self.scale.mac)
+        return self.device
+
+    def discover(self):
+        scale=self.scale
+        if not scale.char_uuid:
+            scale.char_uuid=OLD_STYLE_CHAR
+        scale.char_handle=self.device.get_handle(scale.char_uuid)
+
+    def subscribe(self):
+        self.device.subscribe(self.scale.char_uuid,self.scale.characteristicValueChanged)
+
+    def write(self,packet,withResponse=False):
+        self.device.char_write_handle(self.scale.char_handle,packet,
+                                      wait_for_response=withResponse)
+
+    def close(self):
+        if self.device:
+            self.device.disconnect()
+        if self.adapter:
+            self.adapter.stop()
+            self.adapter=None
+
+
+class SimBackend(PeripheralBackend):
+    """In memory scale answering the real protocol, see pyacaia.sim.
+       Scanning finds one simulated scale
+    """
+
+    name = 'sim'
+
+    def scan(self,deadline,found,done):
+        found('ACAIA SIM','00:00:00:00:00:00',-40)
+
+    def open(self):
+        from .sim import SimPeripheral
+        return SimPeripheral(**self.scale.sim_options)
+
+    def discover(self):
+        from .sim import CHAR_HANDLE, NOTIFY_HANDLE
+        self.scale.char_handle=CHAR_HANDLE
+        self.scale.notify_handle=NOTIFY_HANDLE
+
+
+class ReplayBackend(PeripheralBackend):
+    """Replays the notifications of scale.capture, see pyacaia.capture"""
+
+    name = 'replay'
+
+    def open(self):
+        from .capture import ReplayPeripheral
+        return ReplayPeripheral(self.scale.capture,self.scale.replay_speed)
+
+
+BACKENDS = {}
+
+def register_backend(name,backend):
+    """Make backend, a Backend subclass, available as
+       AcaiaScale(backend=name)
+    """
+    BACKENDS[name]=backend
+
+def get_backend(name):
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise Exception('Backend not supported')
+
+for _backend in (BluepyBackend,PygattBackend,SimBackend,ReplayBackend):
+    register_backend(_backend.name,_backend)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Luca Pinello
+# Released under GPLv3
+
+"""Capture files of the traffic with a scale, and replay of them.
+
+   A capture starts with an 8 byte header, b'ACAP', the format version
+   and 3 reserved bytes.  It is followed by records of a 14 byte header
+   and the raw bytes:
+
+       timestamp   double, time.monotonic() when received or written
+       kind        byte, NOTIFICATION or COMMAND
+       reserved    byte
+       handle      unsigned short, GATT handle
+       length      unsigned short, number of bytes that follow
+
+   all little-endian.  Records are appended through a large write
+   buffer, and read back from a memory map without copying.
+"""
+
+import mmap
+import os
+import struct
+import time
+from threading import Lock
+
+MAGIC = b'ACAP'
+VERSION = 1
+
+NOTIFICATION = 0
+COMMAND = 1
+
+_HEADER = struct.Struct('<4sB3x')
+_RECORD = struct.Struct('<dBxHH')
+
+
+class CaptureWriter(object):
+
+    def __init__(self,path,buffering=1<<16):
+        new=not os.path.exists(path) or os.path.getsize(path)==0
+        self.file=open(path,'ab',buffering=buffering)
+        self.lock=Lock()
+        self.records=0
+        if new:
+            self.file.write(_HEADER.pack(MAGIC,VERSION))
+
+    def record(self,kind,handle,data,timestamp=None):
+        if timestamp is None:
+            timestamp=time.monotonic()
+        header=_RECORD.pack(timestamp,kind,handle or 0,len(data))
+        with self.lock:
+            if self.file.closed:
+                # Closed by stop_recording() while a notification came in
+                return
+            self.file.write(header)
+            self.file.write(data)
+            self.records+=1
+
+    def notification(self,handle,data):
+        self.record(NOTIFICATION,handle,data)
+
+    def command(self,handle,data):
+        self.record(COMMAND,handle,data)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class CaptureReader(object):
+    """Iterates over the records of a capture as (timestamp, kind,
+       handle, data) tuples.  data is a memoryview of the memory map
+       that is released when the iteration moves to the next record.
+    """
+
+    def __init__(self,path):
+        self.file=open(path,'rb')
+        self.map=mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+        self.view=memoryview(self.map)
+        magic,version=_HEADER.unpack_from(self.map)
+        if magic!=MAGIC:
+            raise Exception('%s is not a pyacaia capture' % path)
+        if version!=VERSION:
+            raise Exception('Unsupported capture version %d' % version)
+
+    def __iter__(self):
+        return self.records()
+
+    def records(self,kind=None):
+        view=self.view
+        size=len(view)
+        offset=_HEADER.size
+        while offset+_RECORD.size<=size:
+            timestamp,record_kind,handle,length=_RECORD.unpack_from(view,offset)
+            offset+=_RECORD.size
+            if offset+length>size:
+                # Truncated by a crash while recording
+                break
+            if kind is None or record_kind==kind:
+                with view[offset:offset+length] as data:
+                    yield timestamp,record_kind,handle,data
+            offset+=length
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+
+class ReplayPeripheral(object):
+    """Stands in for a bluepy Peripheral and delivers the notifications
+       of a capture to its delegate.  speed is relative to the recorded
+       timing, None delivers them as fast as they are read.  Writes are
+       counted and otherwise ignored.
+    """
+
+    def __init__(self,path,speed=1.0):
+        self.reader=CaptureReader(path)
+        self.records=self.reader.records(NOTIFICATION)
+        self.next=next(self.records,None)
+        self.speed=speed
+        self.delegate=None
+        self.start=None
+        self.first=None
+        self.writes=0
+
+    def withDelegate(self,delegate):
+        self.delegate=delegate
+        return self
+
+    def setMTU(self,mtu):
+        pass
+
+    def writeCharacteristic(self,handle,data,withResponse=False):
+        self.writes+=1
+
+    def waitForNotifications(self,timeout):
+        record=self.next
+        if record is None:
+            time.sleep(timeout)
+            return False
+        timestamp,kind,handle,data=record
+        if self.speed:
+            now=time.monotonic()
+            if self.start is None:
+                self.start=now
+                self.first=timestamp
+            wait=self.start+(timestamp-self.first)/self.speed-now
+            if wait>timeout:
+                time.sleep(timeout)
+                return False
+            if wait>0:
+                time.sleep(wait)
+        self.delegate.handleNotification(handle,data)
+        self.next=next(self.records,None)
+        return True
+
+    def disconnect(self):
+        self.next=None
+        self.records.close()
+        self.reader.close()
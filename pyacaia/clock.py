@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Luca Pinello
+# Released under GPLv3
+
+"""Alignment of the timer of the scale with time.monotonic().
+
+   The scale reports its timer in tenths of a second, in timer messages
+   and heartbeat responses, and each report arrives after a Bluetooth
+   delay that varies from one notification to the next.  A report of
+   timer T received at host time r says the timer started at r-T-delay,
+   minus the fraction of a tenth the report was truncated by.  Both
+   errors only make r-T larger, so ClockSync keeps the minimum of r-T
+   over the last window reports (a minimum filter, as NTP clients do
+   with round trips).
+
+   The delay is half the shortest round trip of the last window
+   heartbeats, the time from writing a heartbeat to receiving its
+   response.
+
+   elapsed(now) is the timer displayed by the scale at now.  Corrections
+   of the estimate smaller than step seconds are slewed at max_slew
+   seconds per second, so elapsed() never goes back while the timer runs
+   and only jumps when the scale restarts its timer.
+
+   scale_time(now) is the timer when the scale measured a weight received
+   at now.  The weight and the timer reports come over the same link, so
+   the delay cancels: weight samples and their timers agree to a tenth of
+   a second whatever the delay.  to_host() converts a timer value back to
+   time.monotonic(), to align the samples with other sensors.
+"""
+
+import time
+from collections import deque
+
+
+class ClockSync(object):
+
+    def __init__(self,window=32,delay=0.2,max_slew=0.05,step=1.0):
+        """delay in seconds until the first round trip is measured"""
+        self.window=window
+        self.max_slew=max_slew
+        self.step=step
+        # r-T of the last reports, and round trips of the last heartbeats
+        self.reports=deque(maxlen=window)
+        self.round_trips=deque(maxlen=window)
+        self.delay=delay
+        self.running=False
+        # Timer shown while paused
+        self.paused=0.0
+        # The host time the timer started at is base+correction(now),
+        # moving from base to target from since on
+        self.base=0.0
+        self.target=0.0
+        self.since=0.0
+        self.steps=0
+        self.observations=0
+
+    def _start(self,now):
+        # Host time the timer started at, according to the scale
+        return self.base+self._correction(now)
+
+    def _correction(self,now):
+        correction=self.target-self.base
+        slew=self.max_slew*max(0.0,now-self.since)
+        if correction>slew:
+            return slew
+        if correction<-slew:
+            return -slew
+        return correction
+
+    def _set_target(self,now,target,jump=False):
+        if jump or abs(target-self._start(now))>self.step:
+            self.base=target
+            self.steps+=1
+        else:
+            self.base=self._start(now)
+        self.target=target
+        self.since=now
+
+    def observe(self,now,elapsed):
+        """Timer elapsed, in seconds, reported by the scale and received
+           at now
+        """
+        self.observations+=1
+        reports=self.reports
+        offset=now-elapsed
+        if not self.running:
+            reports.clear()
+            self.running=True
+            reports.append(offset)
+            self._set_target(now,offset-self.delay,jump=True)
+            return
+        if abs(offset-self.delay-self._start(now))>self.step:
+            # The timer was restarted, the reports before are stale
+            reports.clear()
+        reports.append(offset)
+        self._set_target(now,min(reports)-self.delay)
+
+    def round_trip(self,now,seconds):
+        """Seconds from writing a heartbeat to receiving its response at
+           now
+        """
+        round_trips=self.round_trips
+        round_trips.append(seconds)
+        delay=min(round_trips)/2
+        if delay!=self.delay:
+            self.delay=delay
+            if self.running and self.reports:
+                # The first round trip replaces a guess, no need to slew
+                self._set_target(now,min(self.reports)-delay,jump=len(round_trips)==1)
+
+    def start(self,now,elapsed=None):
+        """The timer started or resumed from elapsed, the paused time by
+           default, acknowledged by the scale at now
+        """
+        if elapsed is None:
+            elapsed=self.paused
+        self.running=False
+        self.observe(now,elapsed)
+
+    def stop(self,elapsed=None):
+        """The timer stopped showing elapsed, the current time by default"""
+        if elapsed is None:
+            elapsed=self.elapsed()
+        self.paused=elapsed
+        self.running=False
+
+    def reset(self):
+        self.paused=0.0
+        self.running=False
+        self.reports.clear()
+
+    def elapsed(self,now=None):
+        """Timer displayed by the scale at now"""
+        if not self.running:
+            return self.paused
+        if now is None:
+            now=time.monotonic()
+        return max(0.0,now-self._start(now))
+
+    def scale_time(self,now):
+        """Timer when the scale measured a weight received at now"""
+        if not self.running:
+            return self.paused
+        # Called for every weight, skip the slew when there is none
+        start=self.base
+        if start!=self.target:
+            start=self._start(now)
+        elapsed=now-self.delay-start
+        return elapsed if elapsed>0.0 else 0.0
+
+    def to_host(self,elapsed):
+        """time.monotonic() at which the running timer showed elapsed"""
+        return self.offset+elapsed
+
+    @property
+    def offset(self):
+        """time.monotonic() at which the running timer showed 0"""
+        return self._start(time.monotonic())
+
+    def as_dict(self):
+        return {
+            'running': self.running,
+            'offset': self.offset if self.running else None,
+            'delay': self.delay,
+            'reports': len(self.reports),
+            'round_trips': len(self.round_trips),
+            'observations': self.observations,
+            'steps': self.steps,
+        }
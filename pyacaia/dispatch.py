@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Luca Pinello
+# Released under GPLv3
+
+"""Callbacks for weights and events, run outside the I/O thread.
+
+   Every Subscription has its own bounded queue and worker thread, so a
+   slow handler only makes its own queue overflow, and never delays the
+   decoding or the heartbeat of the scale:
+
+       sub=scale.on_weight(lambda sample: print(sample.weight),overflow=COALESCE_LATEST)
+       ...
+       print(sub.stats())
+       sub.close()
+"""
+
+import logging
+import time
+from collections import deque, namedtuple
+from threading import Thread, Condition
+
+WeightSample = namedtuple('WeightSample', 'time weight timer')
+ButtonEvent = namedtuple('ButtonEvent', 'time button weight timer')
+
+# Overflow policies, when maxlen items are waiting
+DROP_OLDEST = 'drop-oldest'
+COALESCE_LATEST = 'coalesce-latest'
+BLOCK = 'block'
+
+WEIGHT = 'weight'
+BUTTON = 'button'
+SETTINGS = 'settings'
+DISCONNECT = 'disconnect'
+
+
+class Subscription(object):
+    """Calls handler(item) from a worker thread for each item put().
+
+       When maxlen items are waiting, DROP_OLDEST discards the oldest,
+       COALESCE_LATEST replaces the newest so the handler still sees the
+       latest value, and BLOCK makes put() wait up to block_timeout
+       seconds for room before dropping the item.  BLOCK holds up the
+       I/O thread of the scale while it waits: only use it for handlers
+       that must see every item and keep up on average.
+
+       dropped counts the items discarded or replaced, lag is how long
+       the oldest waiting item has been queued, in seconds.
+    """
+
+    def __init__(self,kind,handler,maxlen=256,overflow=DROP_OLDEST,block_timeout=1.0,
+                 owner=None):
+        if overflow not in (DROP_OLDEST,COALESCE_LATEST,BLOCK):
+            raise Exception('Unknown overflow policy %s' % overflow)
+        self.kind=kind
+        self.handler=handler
+        self.maxlen=maxlen
+        self.overflow=overflow
+        self.block_timeout=block_timeout
+        self.owner=owner
+        # (time queued, item)
+        self.queue=deque()
+        self.condition=Condition()
+        self.closed=False
+        self.delivered=0
+        self.dropped=0
+        self.errors=0
+        self.max_lag=0.0
+        self.thread=Thread(target=self._run,name='AcaiaSubscriber-'+kind)
+        self.thread.daemon=True
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def put(self,item):
+        now=time.monotonic()
+        with self.condition:
+            if self.closed:
+                return
+            if len(self.queue)>=self.maxlen:
+                if self.overflow==DROP_OLDEST:
+                    self.queue.popleft()
+                    self.dropped+=1
+                elif self.overflow==COALESCE_LATEST:
+                    # Keep the time of the replaced item, for the lag
+                    self.queue[-1]=(self.queue[-1][0],item)
+                    self.dropped+=1
+                    return
+                else:
+                    deadline=now+self.block_timeout
+                    while len(self.queue)>=self.maxlen and not self.closed:
+                        remaining=deadline-time.monotonic()
+                        if remaining<=0:
+                            self.dropped+=1
+                            return
+                        self.condition.wait(remaining)
+            self.queue.append((now,item))
+            self.condition.notify_all()
+
+    @property
+    def lag(self):
+        queue=self.queue
+        try:
+            return time.monotonic()-queue[0][0]
+        except IndexError:
+            return 0.0
+
+    def stats(self):
+        return {
+            'kind': self.kind,
+            'pending': len(self.queue),
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'lag': self.lag,
+            'max_lag': self.max_lag,
+        }
+
+    def close(self,wait=False):
+        """Stop the worker, items still queued are discarded unless
+           wait is True
+        """
+        if self.owner is not None:
+            self.owner.remove(self)
+        with self.condition:
+            if not wait:
+                self.queue.clear()
+            self.closed=True
+            self.condition.notify_all()
+        if wait:
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                queued,item=self.queue.popleft()
+                self.condition.notify_all()
+            lag=time.monotonic()-queued
+            if lag>self.max_lag:
+                self.max_lag=lag
+            try:
+                self.handler(item)
+            except Exception as e:
+                self.errors+=1
+                logging.debug('Subscriber '+str(self.handler)+' failed '+str(e))
+            self.delivered+=1
+
+
+class Dispatcher(object):
+    """Sink of an AcaiaScale that hands its messages to the subscriptions"""
+
+    def __init__(self,scale):
+        self.scale=scale
+        self.subscriptions={WEIGHT: [],BUTTON: [],SETTINGS: [],DISCONNECT: []}
+
+    def subscribe(self,kind,handler,**kwargs):
+        subscription=Subscription(kind,handler,owner=self,**kwargs)
+        # Copy on write, the I/O thread iterates over the lists
+        self.subscriptions[kind]=self.subscriptions[kind]+[subscription]
+        return subscription
+
+    def remove(self,subscription):
+        subscriptions=self.subscriptions[subscription.kind]
+        if subscription in subscriptions:
+            self.subscriptions[subscription.kind]=[s for s in subscriptions
+                                                   if s is not subscription]
+
+    def __call__(self,msg,now):
+        msgType=getattr(msg,'msgType',None)
+        if msgType==5:
+            subscriptions=self.subscriptions[WEIGHT]
+            if not subscriptions:
+                return
+            item=WeightSample(now,msg.value,self.scale.get_scale_time(now))
+        elif msgType==8:
+            subscriptions=self.subscriptions[BUTTON]
+            if not subscriptions:
+                return
+            # Timestamped like the weight samples
+            item=ButtonEvent(now,msg.button,msg.value,msg.time)
+        elif msgType is None:
+            subscriptions=self.subscriptions[SETTINGS]
+            item=msg
+        else:
+            return
+        for subscription in subscriptions:
+            subscription.put(item)
+
+    def disconnected(self,now):
+        for subscription in self.subscriptions[DISCONNECT]:
+            subscription.put(now)
+
+    def stats(self):
+        return [subscription.stats() for subscriptions in self.subscriptions.values()
+                for subscription in subscriptions]
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Luca Pinello
+# Released under GPLv3
+
+"""Export of the weights and button events to CSV, Parquet or Arrow.
+
+   Exporter is a sink of the scale.  The I/O thread appends each sample
+   to columnar batches, and hands full batches to a writer thread which
+   writes them in bulk, so a slow disk (an SD card that stalls for a
+   second) never delays the scale.  The writer thread also takes the
+   batches whose first row is flush_interval seconds old, when no
+   sample came after it to hand them over.  When max_pending batches are already
+   waiting for the writer, a new batch is dropped and counted instead.
+   The rotations of the files are queued with the batches but never
+   dropped, and do not count towards max_pending.
+
+       exporter=Exporter(scale,'shots',format='parquet',shots=True).start()
+       ...
+       exporter.close()
+       print(exporter.stats())
+
+   Each row has the columns:
+
+       time     time.monotonic() when the notification was received
+       weight   in the units of the scale
+       timer    timer of the scale when it measured the weight, in seconds
+       shot     number of the shot the row belongs to, 0 outside shots
+       event    '' for a weight sample, or the button: 'tare', 'start',
+                'stop' or 'reset'
+
+   A shot starts with the 'start' button and ends with 'stop' or
+   'reset', pressed on the scale or sent as commands.  With shots=True
+   only the rows of shots are exported, one file per shot, otherwise
+   every row is.  Files are also rotated after max_bytes bytes or
+   max_seconds seconds.  They are named
+   <directory>/<prefix>-<date>-<time>-<n>.<format>.
+
+   Parquet and Arrow IPC need pyarrow.
+"""
+
+import csv
+import logging
+import os
+import queue
+import time
+from array import array
+from threading import Thread, Lock
+
+from . import Histogram, Message
+
+COLUMNS = ('time','weight','timer','shot','event')
+
+_EXTENSIONS = {'csv': 'csv','parquet': 'parquet','arrow': 'arrow'}
+
+# Items of the writer queue besides batches
+_ROTATE = 'rotate'
+_CLOSE = 'close'
+_STOP = 'stop'
+
+
+class Batch(object):
+    """Columns of the rows buffered in the I/O thread"""
+
+    __slots__ = ('time','weight','timer','shot','event','first','queued')
+
+    def __init__(self):
+        self.time=array('d')
+        self.weight=array('d')
+        self.timer=array('d')
+        self.shot=array('q')
+        self.event=[]
+        # time.monotonic() of the first row
+        self.first=None
+        self.queued=None
+
+    def __len__(self):
+        return len(self.time)
+
+    def append(self,t,weight,timer,shot,event):
+        self.time.append(t)
+        self.weight.append(weight)
+        self.timer.append(timer)
+        self.shot.append(shot)
+        self.event.append(event)
+
+    def columns(self):
+        return (self.time,self.weight,self.timer,self.shot,self.event)
+
+
+class CsvWriter(object):
+
+    def __init__(self,path):
+        self.file=open(path,'w',newline='',buffering=1<<16)
+        self.csv=csv.writer(self.file)
+        self.csv.writerow(COLUMNS)
+
+    def write(self,batch):
+        self.csv.writerows(zip(*batch.columns()))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class _ArrowWriter(object):
+
+    def __init__(self):
+        try:
+            import pyarrow
+        except ImportError:
+            raise Exception('pyarrow is not installed')
+        self.pa=pyarrow
+        self.schema=pyarrow.schema([('time',pyarrow.float64()),('weight',pyarrow.float64()),
+                                    ('timer',pyarrow.float64()),('shot',pyarrow.int64()),
+                                    ('event',pyarrow.string())])
+
+    def table(self,batch):
+        pa=self.pa
+        n=len(batch)
+        # The numeric columns are wrapped as they are, without a copy
+        columns=[pa.Array.from_buffers(field.type,n,[None,pa.py_buffer(column)])
+                 for field,column in zip(self.schema,batch.columns()[:4])]
+        columns.append(pa.array(batch.event,pa.string()))
+        return pa.Table.from_arrays(columns,schema=self.schema)
+
+
+class ParquetWriter(_ArrowWriter):
+
+    def __init__(self,path):
+        _ArrowWriter.__init__(self)
+        import pyarrow.parquet
+        self.writer=pyarrow.parquet.ParquetWriter(path,self.schema)
+
+    def write(self,batch):
+        # One row group per batch
+        self.writer.write_table(self.table(batch))
+
+    def close(self):
+        self.writer.close()
+
+
+class ArrowWriter(_ArrowWriter):
+
+    def __init__(self,path):
+        _ArrowWriter.__init__(self)
+        import pyarrow.ipc
+        self.writer=pyarrow.ipc.new_file(path,self.schema)
+
+    def write(self,batch):
+        self.writer.write_table(self.table(batch))
+
+    def close(self):
+        self.writer.close()
+
+WRITERS = {'csv': CsvWriter,'parquet': ParquetWriter,'arrow': ArrowWriter}
+
+
+class Exporter(object):
+    """Sink writing the rows of scale to files in directory, see the
+       module docstring.  A batch is handed to the writer thread once
+       it has batch_size rows or its first row is flush_interval seconds
+       old
+    """
+
+    def __init__(self,scale,directory='.',format='csv',prefix='pyacaia',shots=False,
+                 batch_size=256,flush_interval=1.0,max_bytes=None,max_seconds=None,
+                 max_pending=64):
+        if format not in WRITERS:
+            raise Exception('Unknown export format %s' % format)
+        if format!='csv':
+            _ArrowWriter()
+        self.scale=scale
+        self.directory=directory
+        self.format=format
+        self.prefix=prefix
+        self.shots=shots
+        self.batch_size=batch_size
+        self.flush_interval=flush_interval
+        self.max_bytes=max_bytes
+        self.max_seconds=max_seconds
+        self.max_pending=max_pending
+        # Not bounded, so the markers never wait: the batches are
+        # counted in queued by the I/O thread and in taken by the writer
+        self.queue=queue.Queue()
+        self.queued=0
+        self.taken=0
+        self.thread=None
+        # The batch is filled by the I/O thread and handed over by the
+        # writer thread too when it is due, never held while writing
+        self.lock=Lock()
+        self.batch=Batch()
+        # Number of the current shot, and whether it is running
+        self.shot=0
+        self.in_shot=False
+        # Writer thread state
+        self.writer=None
+        self.path=None
+        self.opened=None
+        self.files=[]
+        self.sequence=0
+        self.rows=0
+        self.batches=0
+        self.dropped_batches=0
+        self.dropped_rows=0
+        self.errors=0
+        # Seconds from handing a batch over to having written it
+        self.flush_latency=Histogram()
+
+    def start(self):
+        os.makedirs(self.directory,exist_ok=True)
+        self.thread=Thread(target=self._run,name='AcaiaExport')
+        self.thread.daemon=True
+        self.thread.start()
+        self.scale.sinks.append(self)
+        return self
+
+    # Sink, called in the I/O thread of the scale
+
+    def __call__(self,msg,now):
+        if not isinstance(msg,Message):
+            return
+        with self.lock:
+            self._row(msg,now)
+
+    def _row(self,msg,now):
+        if msg.msgType==5:
+            if self.shots and not self.in_shot:
+                return
+            event=''
+        elif msg.msgType==8 and msg.button in ('tare','start','stop','reset'):
+            event=msg.button
+            if event=='start' and not self.in_shot:
+                self.shot+=1
+                self.in_shot=True
+                if self.shots:
+                    self._hand_over(_ROTATE)
+            elif event in ('stop','reset') and self.in_shot:
+                # The last row of the shot
+                self.in_shot=False
+                self._add(now,msg,event,self.shot)
+                if self.shots:
+                    self._hand_over(_CLOSE)
+                return
+            elif self.shots and not self.in_shot:
+                return
+        else:
+            return
+        self._add(now,msg,event,self.shot if self.in_shot else 0)
+
+    def _add(self,now,msg,event,shot):
+        batch=self.batch
+        value=msg.value
+        if not len(batch):
+            batch.first=now
+        batch.append(now,value if value is not None else float('nan'),
+                     self.scale.get_scale_time(now),shot,event)
+        if len(batch)>=self.batch_size or now-batch.first>=self.flush_interval:
+            self._hand_over()
+
+    def _hand_over(self,then=None):
+        """Queue the current batch for the writer, followed by then.
+           Called with the lock held
+        """
+        batch=self.batch
+        if len(batch):
+            self.batch=Batch()
+            if self.queued-self.taken>=self.max_pending:
+                # The writer is stalled, drop the rows not the scale
+                self.dropped_batches+=1
+                self.dropped_rows+=len(batch)
+            else:
+                batch.queued=time.monotonic()
+                self.queued+=1
+                self.queue.put(batch)
+        if then is not None:
+            # Rotations must not be lost, and the queue is never full
+            self.queue.put(then)
+
+    def flush(self):
+        """Hand the rows buffered so far to the writer"""
+        with self.lock:
+            self._hand_over()
+
+    def _flush_due(self):
+        """Hand the batch over if its first row is flush_interval old,
+           return the seconds until the next one can be
+        """
+        with self.lock:
+            first=self.batch.first
+            if first is not None:
+                wait=first+self.flush_interval-time.monotonic()
+                if wait>0:
+                    return wait
+                self._hand_over()
+        return self.flush_interval
+
+    def close(self):
+        """Write what is buffered, close the file and stop the writer"""
+        if self in self.scale.sinks:
+            self.scale.sinks.remove(self)
+        with self.lock:
+            self._hand_over(_STOP)
+        if self.thread:
+            self.thread.join()
+            self.thread=None
+
+    # Writer thread
+
+    def _run(self):
+        while True:
+            try:
+                # Wake up to flush the rows that no sample followed
+                item=self.queue.get(timeout=self._flush_due())
+            except queue.Empty:
+                continue
+            if item is _STOP:
+                self._close_file()
+                return
+            if item is _ROTATE or item is _CLOSE:
+                self._close_file()
+                continue
+            self.taken+=1
+            try:
+                self._write(item)
+            except Exception as e:
+                self.errors+=1
+                logging.debug('Export of %d rows failed %s' % (len(item),e))
+
+    def _write(self,batch):
+        now=time.monotonic()
+        if self.writer is not None and (
+                (self.max_seconds and now-self.opened>=self.max_seconds) or
+                (self.max_bytes and os.path.getsize(self.path)>=self.max_bytes)):
+            self._close_file()
+        if self.writer is None:
+            self._open_file()
+        self.writer.write(batch)
+        self.rows+=len(batch)
+        self.batches+=1
+        self.flush_latency.add(time.monotonic()-batch.queued)
+
+    def _open_file(self):
+        self.sequence+=1
+        name='%s-%s-%d.%s' % (self.prefix,time.strftime('%Y%m%d-%H%M%S'),self.sequence,
+                              _EXTENSIONS[self.format])
+        self.path=os.path.join(self.directory,name)
+        self.writer=WRITERS[self.format](self.path)
+        self.opened=time.monotonic()
+        self.files.append(self.path)
+
+    def _close_file(self):
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception as e:
+                self.errors+=1
+                logging.debug('Closing '+self.path+' failed '+str(e))
+            self.writer=None
+
+    def stats(self):
+        return {
+            'rows': self.rows,
+            'batches': self.batches,
+            'pending': self.queued-self.taken,
+            'dropped_batches': self.dropped_batches,
+            'dropped_rows': self.dropped_rows,
+            'errors': self.errors,
+            'files': list(self.files),
+            'flush_latency': self.flush_latency.as_dict(),
+        }
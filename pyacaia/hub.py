@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Luca Pinello
+# Released under GPLv3
+
+"""One I/O thread for many scales.
+
+   AcaiaHub multiplexes the notification and command queue descriptors
+   of all its scales with a selector, and keeps their heartbeat and
+   command deadlines in a single heap, instead of running one thread
+   per scale.
+
+       hub=AcaiaHub()
+       hub.start()
+       for mac in addresses:
+           scale=hub.attach(AcaiaScale(mac))
+           scale.connect()
+"""
+
+import heapq
+import logging
+import os
+import selectors
+import time
+from collections import deque
+from threading import Thread, get_ident
+
+
+class AcaiaHub(Thread):
+
+    def __init__(self):
+        Thread.__init__(self,name='AcaiaHub')
+        self.daemon=True
+        self.keep_going=False
+        self.selector=selectors.DefaultSelector()
+        self.scales=[]
+        # (deadline, sequence, scale), stale entries are skipped
+        self.heap=[]
+        self.deadlines={}
+        self.sequence=0
+        # add/remove requests from other threads
+        self.requests=deque()
+        self.wake_r,self.wake_w=os.pipe()
+        os.set_blocking(self.wake_r,False)
+        os.set_blocking(self.wake_w,False)
+        self.selector.register(self.wake_r,selectors.EVENT_READ,None)
+        self.started=None
+        self.wakeups=0
+
+    def attach(self,scale):
+        """Have the hub do the I/O of scale once it is connected"""
+        scale.io_driver=self
+        self.scales.append(scale)
+        return scale
+
+    def stop(self):
+        self.keep_going=False
+        self._wakeup()
+
+    # io_driver interface, see AcaiaScale.notificationsReady()
+
+    def add(self,scale):
+        self.requests.append((self._add,scale))
+        self._wakeup()
+
+    def remove(self,scale):
+        if get_ident()==self.ident:
+            self._remove(scale)
+        else:
+            self.requests.append((self._remove,scale))
+            self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self.wake_w,b'\0')
+        except OSError:
+            pass
+
+    def _add(self,scale):
+        fd=scale.notification_fd()
+        if fd is not None:
+            self.selector.register(fd,selectors.EVENT_READ,(scale,scale.read_notifications))
+        self.selector.register(scale.command_queue.fileno(),selectors.EVENT_READ,
+                               (scale,scale.service))
+        self._schedule(scale)
+
+    def _remove(self,scale):
+        for key in list(self.selector.get_map().values()):
+            if key.data and key.data[0] is scale:
+                self.selector.unregister(key.fileobj)
+        self.deadlines.pop(scale,None)
+
+    def _schedule(self,scale):
+        deadline=scale.next_deadline()
+        current=self.deadlines.get(scale)
+        # Notifications postpone the heartbeat, an earlier entry is kept
+        # rather than pushing a new one for each: service() does nothing
+        # before the deadline and the scale is scheduled again
+        if current is None or deadline<current:
+            self.deadlines[scale]=deadline
+            self.sequence+=1
+            heapq.heappush(self.heap,(deadline,self.sequence,scale))
+
+    def _run(self,scale,func):
+        if not scale.connected:
+            return
+        try:
+            func()
+            self._schedule(scale)
+        except Exception as e:
+            logging.debug('Scale '+str(scale.mac)+' I/O failed '+str(e))
+            self._remove(scale)
+            try:
+                scale.disconnect()
+            except Exception:
+                pass
+
+    def run(self):
+        self.keep_going=True
+        self.started=time.monotonic()
+        while self.keep_going:
+            timeout=None
+            if self.heap:
+                timeout=max(0,self.heap[0][0]-time.monotonic())
+            events=self.selector.select(timeout)
+            self.wakeups+=1
+            for key,mask in events:
+                if key.data is None:
+                    try:
+                        while os.read(self.wake_r,512):
+                            pass
+                    except OSError:
+                        pass
+                    while self.requests:
+                        func,scale=self.requests.popleft()
+                        func(scale)
+                else:
+                    self._run(*key.data)
+            now=time.monotonic()
+            while self.heap and self.heap[0][0]<=now:
+                deadline,_,scale=heapq.heappop(self.heap)
+                if self.deadlines.get(scale)==deadline:
+                    del self.deadlines[scale]
+                    self._run(scale,scale.service)
+
+    def state(self):
+        """Per scale state"""
+        return [{
+            'mac': scale.mac,
+            'connected': scale.connected,
+            'weight': scale.weight,
+            'battery': scale.battery,
+            'frames': scale.framer.frames,
+            'weight_samples': scale.series.count,
+        } for scale in self.scales]
+
+    def stats(self):
+        """Aggregate throughput since the hub started"""
+        elapsed=time.monotonic()-self.started if self.started else 0
+        frames=sum(scale.framer.frames for scale in self.scales)
+        samples=sum(scale.series.count for scale in self.scales)
+        return {
+            'scales': len(self.scales),
+            'connected': sum(1 for scale in self.scales if scale.connected),
+            'elapsed': elapsed,
+            'wakeups': self.wakeups,
+            'frames': frames,
+            'weight_samples': samples,
+            'frames_per_s': frames/elapsed if elapsed else 0.0,
+            'weight_samples_per_s': samples/elapsed if elapsed else 0.0,
+            'wakeups_per_s': self.wakeups/elapsed if elapsed else 0.0,
+        }
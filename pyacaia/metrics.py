@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Luca Pinello
+# Released under GPLv3
+
+"""Profiling of the notification pipeline and Prometheus export.
+
+   The counters of AcaiaScale.stats() are always kept.  The time spent
+   in each stage of callback_queue() is only measured once
+   scale.enable_metrics() has set a Profiler, so it costs nothing
+   otherwise:
+
+       profiler=scale.enable_metrics(hooks=[lambda stage,seconds: ...])
+       ...
+       print(scale.stats()['stages'])
+       print(prometheus_text([scale]))
+
+   The stages are 'feed' (copying the notification into the Framer),
+   'decode' (finding, verifying and decoding a frame), 'update' (the
+   state of the scale and the acknowledgement of commands) and 'sinks'
+   (triggers, subscriptions and the other sinks), the last three once
+   per frame.
+"""
+
+import logging
+import time
+from threading import Thread
+
+from . import Histogram
+
+# Buckets for the microseconds spent in a stage
+_STAGE_BOUNDS = (1e-6,2e-6,5e-6,1e-5,2e-5,5e-5,1e-4,2e-4,5e-4,1e-3,2e-3,5e-3,1e-2)
+
+STAGES = ('feed','decode','update','sinks')
+
+
+class Profiler(object):
+    """Histograms of the time spent in each pipeline stage.  hooks are
+       called with hook(stage, seconds) for every measurement, in the
+       I/O thread
+    """
+
+    def __init__(self,hooks=()):
+        self.stages=dict((stage,Histogram(_STAGE_BOUNDS)) for stage in STAGES)
+        self.hooks=list(hooks)
+
+    def lap(self,stage,start):
+        """Record the time since start in stage, return the time now"""
+        now=time.perf_counter()
+        seconds=now-start
+        self.stages[stage].add(seconds)
+        for hook in self.hooks:
+            hook(stage,seconds)
+        return now
+
+    def as_dict(self):
+        return dict((stage,histogram.as_dict()) for stage,histogram in self.stages.items())
+
+
+# Metrics of AcaiaScale.stats(): (name, key path, type, help)
+_METRICS = (
+    ('notifications_total',('notifications',),'counter','Notifications received'),
+    ('notifications_per_second',('notifications_per_s',),'gauge',
+     'Notification rate since the previous scrape'),
+    ('received_bytes_total',('bytes',),'counter','Bytes of notifications received'),
+    ('frames_total',('frames',),'counter','Frames found in the notifications'),
+    ('garbage_bytes_total',('garbage_bytes',),'counter','Bytes skipped looking for a header'),
+    ('unknown_frames_total',('unknown_frames',),'counter','Frames of unknown commands'),
+    ('checksum_failures_total',('checksum_failures',),'counter',
+     'Frames dropped for a wrong checksum'),
+    ('decode_errors_total',('decode_errors',),'counter',
+     'Frames dropped because they could not be decoded'),
+    ('decimated_total',('decimated',),'counter','Weights dropped by max_rate'),
+    ('notification_queue_max',('notification_queue_max',),'gauge',
+     'Most notifications queued at once'),
+    ('command_queue_depth',('command_queue','depth'),'gauge','Commands waiting to be written'),
+    ('command_queue_max',('command_queue','max_depth'),'gauge','Most commands queued at once'),
+    ('command_wait_seconds',('command_queue','wait'),'histogram',
+     'Time from queueing a command to writing it'),
+    ('heartbeat_jitter_seconds',('heartbeat_jitter',),'histogram','Lateness of the heartbeats'),
+    ('writes_per_minute',('writes_per_minute',),'gauge','Writes to the scale in the last minute'),
+    ('write_stall_seconds',('write_stall',),'histogram','Time each write blocked the thread'),
+    ('connects_total',('connects',),'counter','Successful connections'),
+    ('reconnects_total',('reconnects',),'counter','Connections after the first'),
+    ('connect_failures_total',('connect_failures',),'counter','Failed connection attempts'),
+    ('transit_delay_seconds',('clock','delay'),'gauge',
+     'Delay of the notifications, half the shortest heartbeat round trip'),
+)
+
+
+def _get(stats,path):
+    for key in path:
+        if stats is None:
+            return None
+        stats=stats.get(key)
+    return stats
+
+
+def _labels(labels):
+    return '{'+','.join('%s="%s"' % (k,str(v).replace('\\','\\\\').replace('"','\\"'))
+                        for k,v in labels)+'}'
+
+
+def _histogram(lines,name,labels,histogram):
+    seen=0
+    for bound,count in histogram['buckets']:
+        seen+=count
+        le='+Inf' if bound==float('inf') else repr(bound)
+        lines.append('%s_bucket%s %d' % (name,_labels(labels+[('le',le)]),seen))
+    lines.append('%s_sum%s %r' % (name,_labels(labels),histogram['sum']))
+    lines.append('%s_count%s %d' % (name,_labels(labels),histogram['count']))
+
+
+def prometheus_text(scales,prefix='pyacaia_',marks=None):
+    """stats() of the scales in the Prometheus text exposition format,
+       labelled by MAC address.  marks keeps the 'mark' of the stats of
+       each scale between calls, so that the rates are since the
+       previous scrape, and since the scale was created without it
+    """
+    snapshots=[]
+    for scale in scales:
+        stats=scale.stats(marks.get(scale.mac) if marks is not None else None)
+        if marks is not None:
+            marks[scale.mac]=stats['mark']
+        snapshots.append((scale.mac,stats))
+    lines=[]
+    for name,path,kind,help in _METRICS:
+        name=prefix+name
+        lines.append('# HELP %s %s' % (name,help))
+        lines.append('# TYPE %s %s' % (name,kind))
+        for mac,stats in snapshots:
+            value=_get(stats,path)
+            if value is None:
+                continue
+            labels=[('mac',mac)]
+            if kind=='histogram':
+                _histogram(lines,name,labels,value)
+            else:
+                lines.append('%s%s %r' % (name,_labels(labels),float(value)))
+    name=prefix+'stage_seconds'
+    lines.append('# HELP %s Time spent in each stage of the notification pipeline' % name)
+    lines.append('# TYPE %s histogram' % name)
+    for mac,stats in snapshots:
+        for stage,histogram in sorted((stats.get('stages') or {}).items()):
+            _histogram(lines,name,[('mac',mac),('stage',stage)],histogram)
+    return '\n'.join(lines)+'\n'
+
+
+def serve_prometheus(scales,port=9464,address=''):
+    """Serve prometheus_text(scales) over HTTP from a daemon thread,
+       return the server, shutdown() it to stop
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    # Rates since the previous scrape of this server
+    marks={}
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body=prometheus_text(scales,marks=marks).encode()
+            self.send_response(200)
+            self.send_header('Content-Type','text/plain; version=0.0.4')
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self,format,*args):
+            logging.debug('metrics: '+format % args)
+
+    server=ThreadingHTTPServer((address,port),Handler)
+    thread=Thread(target=server.serve_forever,name='AcaiaMetrics')
+    thread.daemon=True
+    thread.start()
+    return server
@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Luca Pinello
+# Released under GPLv3
+
+"""Fan-out of one scale connection to many network clients.
+
+   ScaleServer is a sink of the scale: the I/O thread only appends the
+   samples and events to a list.  Every batch_interval seconds the
+   asyncio loop of the server encodes the batch once and writes the
+   same bytes to every client, so the cost per sample does not grow
+   with the number of clients.  A client whose socket buffer holds more
+   than max_buffer bytes skips batches, and gets the latest sample and
+   the events it missed once it catches up.
+
+       server=ScaleServer(scale,port=8765,websocket_port=8766,token='secret')
+       server.start()            # or await server.serve() in a loop
+
+   Clients connect over TCP to port, or over WebSocket to websocket_port,
+   and receive newline separated JSON messages, one WebSocket message
+   per batch:
+
+       {"type": "hello", "mac": ..., "clock": ..., "weight": ..., ...}
+       {"type": "weight", "samples": [[time, weight, timer], ...]}
+       {"type": "button", "button": "tare", "time": ..., "weight": ..., "timer": ...}
+       {"type": "settings", "battery": 80, "units": "grams", ...}
+
+   time is the time.monotonic() of the server when the notification was
+   received, add clock from the hello for the Unix time.  A client can
+   send JSON lines, or WebSocket text messages, of its own:
+
+       {"encoding": "binary"}    switch to the binary encoding
+       {"auth": "secret"}        allow commands, if the server has a token
+       {"cmd": "tare", "id": 1}  also "start", "stop" and "reset", the
+                                 reply is {"type": "result", "id": 1, "ok": true}
+
+   A client message longer than 64 KiB, or an unmasked WebSocket frame,
+   closes the connection.
+
+   In the binary encoding each message is a type byte and a length
+   (unsigned short, little-endian).  Type 1 is a weight batch of that
+   many (time double, weight float, timer float) samples, type 2 is an
+   event of that many bytes of JSON.
+"""
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import struct
+import time
+from collections import deque
+from threading import Thread, Event
+
+from . import Message, Settings
+
+WEIGHTS = 1
+EVENT = 2
+
+_HEADER = struct.Struct('<BH')
+_SAMPLE = struct.Struct('<dff')
+# Samples in one binary weight message
+_MAX_SAMPLES = 0xffff
+
+_WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# Longest message read from a client, a line or a WebSocket payload
+_MAX_MESSAGE = 1<<16
+
+# WebSocket close codes
+_PROTOCOL_ERROR = 1002
+_TOO_BIG = 1009
+
+_COMMANDS = {
+    'tare': lambda scale: scale.tare(),
+    'start': lambda scale: scale.startTimer(),
+    'stop': lambda scale: scale.stopTimer(),
+    'reset': lambda scale: scale.resetTimer(),
+}
+
+
+def _json(message):
+    return json.dumps(message,separators=(',',':')).encode()
+
+
+def encode_batch(items,encoding):
+    """Bytes of a batch of items, (time, weight, timer) tuples for the
+       weight samples and dicts for the events, in the order received
+    """
+    out=[]
+    samples=[]
+    def flush():
+        if not samples:
+            return
+        if encoding=='json':
+            out.append(_json({'type': 'weight','samples': samples})+b'\n')
+        else:
+            for i in range(0,len(samples),_MAX_SAMPLES):
+                chunk=samples[i:i+_MAX_SAMPLES]
+                out.append(_HEADER.pack(WEIGHTS,len(chunk)))
+                out.extend(_SAMPLE.pack(*sample) for sample in chunk)
+        del samples[:]
+    for item in items:
+        if type(item) is tuple:
+            samples.append(item)
+            continue
+        flush()
+        if encoding=='json':
+            out.append(_json(item)+b'\n')
+        else:
+            data=_json(item)
+            out.append(_HEADER.pack(EVENT,len(data)))
+            out.append(data)
+    flush()
+    return b''.join(out)
+
+
+def websocket_frame(payload,opcode):
+    """Unmasked frame, as sent by a server"""
+    n=len(payload)
+    if n<126:
+        header=struct.pack('!BB',0x80|opcode,n)
+    elif n<1<<16:
+        header=struct.pack('!BBH',0x80|opcode,126,n)
+    else:
+        header=struct.pack('!BBQ',0x80|opcode,127,n)
+    return header+payload
+
+
+class _Client(object):
+
+    def __init__(self,server,reader,writer,websocket):
+        self.server=server
+        self.reader=reader
+        self.writer=writer
+        self.websocket=websocket
+        self.encoding=server.encoding
+        self.authenticated=server.token is None and server.allow_commands
+        self.address=writer.get_extra_info('peername')
+        self.task=asyncio.current_task()
+        # While behind, the events of the skipped batches
+        self.behind=False
+        self.events=deque(maxlen=64)
+        self.latest=None
+        self.sent=0
+        self.skipped=0
+
+    def write(self,data):
+        if self.websocket:
+            data=websocket_frame(data,1 if self.encoding=='json' else 2)
+        self.writer.write(data)
+        self.sent+=1
+
+    def stats(self):
+        return {
+            'address': self.address,
+            'encoding': self.encoding,
+            'websocket': self.websocket,
+            'authenticated': self.authenticated,
+            'batches_sent': self.sent,
+            'batches_skipped': self.skipped,
+            'buffered': self.writer.transport.get_write_buffer_size(),
+        }
+
+
+class ScaleServer(object):
+    """Streams the weights and events of scale to TCP and WebSocket
+       clients, see the module docstring.  Commands are accepted from
+       clients that sent the token, or from any client if token is None
+       and allow_commands is True
+    """
+
+    def __init__(self,scale,host='127.0.0.1',port=8765,websocket_port=None,token=None,
+                 encoding='json',batch_interval=0.05,max_buffer=1<<16,allow_commands=False):
+        if encoding not in ('json','binary'):
+            raise Exception('Unknown encoding %s' % encoding)
+        self.scale=scale
+        self.host=host
+        self.port=port
+        self.websocket_port=websocket_port
+        self.token=token
+        self.encoding=encoding
+        self.batch_interval=batch_interval
+        self.max_buffer=max_buffer
+        self.allow_commands=allow_commands
+        self.clients=[]
+        self.loop=None
+        self.servers=[]
+        self.thread=None
+        # Appended to by the I/O thread, drained by the loop
+        self.pending=deque()
+        self.armed=False
+        self.batches=0
+        self.samples=0
+        self.encode_time=0.0
+
+    # Sink, called in the I/O thread of the scale
+
+    def __call__(self,msg,now):
+        if not self.clients:
+            return
+        if isinstance(msg,Message):
+            if msg.msgType==5:
+                item=(now,msg.value,self.scale.get_scale_time(now))
+            elif msg.msgType==8:
+                item={'type': 'button','button': msg.button,'time': now,'weight': msg.value,
+                      'timer': msg.time}
+            else:
+                return
+        elif isinstance(msg,Settings):
+            item={'type': 'settings','time': now,'battery': msg.battery,'units': msg.units,
+                  'auto_off': msg.auto_off,'beep_on': msg.beep_on}
+        else:
+            return
+        self.pending.append(item)
+        if not self.armed:
+            self.armed=True
+            self.loop.call_soon_threadsafe(self._arm)
+
+    # Event loop side
+
+    def _arm(self):
+        self.loop.call_later(self.batch_interval,self._flush)
+
+    def _flush(self):
+        self.armed=False
+        pending=self.pending
+        items=[pending.popleft() for i in range(len(pending))]
+        if not items or not self.clients:
+            return
+        start=time.perf_counter()
+        self.batches+=1
+        latest=None
+        events=[]
+        for item in items:
+            if type(item) is tuple:
+                latest=item
+                self.samples+=1
+            else:
+                events.append(item)
+        # Encoded once per encoding in use, not per client
+        encoded={}
+        for client in self.clients:
+            if client.writer.transport.get_write_buffer_size()>self.max_buffer:
+                client.behind=True
+                client.skipped+=1
+                client.events.extend(events)
+                if latest is not None:
+                    client.latest=latest
+                continue
+            if client.behind:
+                # Catching up: what was missed, coalesced to the latest sample
+                client.behind=False
+                client.events.extend(events)
+                if latest is not None:
+                    client.latest=latest
+                missed=list(client.events)
+                if client.latest is not None:
+                    missed.append(client.latest)
+                client.events.clear()
+                client.latest=None
+                client.write(encode_batch(missed,client.encoding))
+                continue
+            data=encoded.get(client.encoding)
+            if data is None:
+                data=encoded[client.encoding]=encode_batch(items,client.encoding)
+            client.write(data)
+        self.encode_time+=time.perf_counter()-start
+
+    def _hello(self):
+        scale=self.scale
+        return {'type': 'hello','mac': scale.mac,'clock': time.time()-time.monotonic(),
+                'connected': scale.connected,'weight': scale.weight,'battery': scale.battery,
+                'units': scale.units,'timer_running': scale.timer_running,
+                'elapsed': scale.get_elapsed_time()}
+
+    async def _handle_websocket(self,reader,writer):
+        try:
+            await self._upgrade(reader,writer)
+        except (ConnectionError,asyncio.IncompleteReadError,ValueError) as e:
+            logging.debug('WebSocket handshake failed '+str(e))
+            writer.close()
+            return
+        await self._handle(reader,writer,True)
+
+    async def _handle(self,reader,writer,websocket=False):
+        client=_Client(self,reader,writer,websocket)
+        client.write(encode_batch([self._hello()],client.encoding))
+        self.clients.append(client)
+        try:
+            while True:
+                if websocket:
+                    data=await self._read_frame(client)
+                else:
+                    data=await reader.readline()
+                if not data:
+                    break
+                await self._message(client,data)
+        except (ConnectionError,asyncio.IncompleteReadError,ValueError) as e:
+            # ValueError is a line longer than _MAX_MESSAGE
+            logging.debug('Client '+str(client.address)+' left '+str(e))
+        except asyncio.CancelledError:
+            # The server is stopping, see _close()
+            logging.debug('Closing client '+str(client.address))
+        finally:
+            self.clients.remove(client)
+            writer.close()
+
+    async def _upgrade(self,reader,writer):
+        headers={}
+        while True:
+            line=await reader.readline()
+            if line in (b'\r\n',b'\n',b''):
+                break
+            name,_,value=line.decode('latin-1').partition(':')
+            headers[name.strip().lower()]=value.strip()
+        key=headers.get('sec-websocket-key')
+        if not key:
+            writer.write(b'HTTP/1.1 400 Bad Request\r\n\r\n')
+            raise ValueError('not a WebSocket request')
+        accept=base64.b64encode(hashlib.sha1(key.encode()+_WEBSOCKET_GUID).digest())
+        writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+                     b'Connection: Upgrade\r\nSec-WebSocket-Accept: '+accept+b'\r\n\r\n')
+
+    async def _read_frame(self,client):
+        """Payload of the next text or binary message, b'' on close"""
+        reader=client.reader
+        while True:
+            first,second=await reader.readexactly(2)
+            opcode=first & 0x0f
+            n=second & 0x7f
+            if n==126:
+                n=struct.unpack('!H',await reader.readexactly(2))[0]
+            elif n==127:
+                n=struct.unpack('!Q',await reader.readexactly(8))[0]
+            # Checked before reading the payload, clients may not have
+            # sent the token yet
+            if not second & 0x80:
+                logging.debug('Unmasked frame from '+str(client.address))
+                client.writer.write(websocket_frame(struct.pack('!H',_PROTOCOL_ERROR),8))
+                return b''
+            if n>_MAX_MESSAGE:
+                logging.debug('Frame of %d bytes from %s' % (n,client.address))
+                client.writer.write(websocket_frame(struct.pack('!H',_TOO_BIG),8))
+                return b''
+            mask=await reader.readexactly(4)
+            payload=await reader.readexactly(n)
+            payload=bytes(b ^ mask[i & 3] for i,b in enumerate(payload))
+            if opcode==8:
+                client.writer.write(websocket_frame(b'',8))
+                return b''
+            if opcode==9:
+                client.writer.write(websocket_frame(payload,10))
+            elif opcode in (1,2):
+                return payload
+
+    async def _message(self,client,data):
+        try:
+            message=json.loads(data)
+        except ValueError:
+            logging.debug('Ignoring '+repr(data)+' from '+str(client.address))
+            return
+        if not isinstance(message,dict):
+            return
+        if message.get('encoding') in ('json','binary'):
+            client.encoding=message['encoding']
+        if 'auth' in message and self.token is not None:
+            # As bytes, compare_digest() only takes ASCII strings
+            client.authenticated=hmac.compare_digest(str(message['auth']).encode(),
+                                                     self.token.encode())
+        command=message.get('cmd')
+        if command is None:
+            return
+        result={'type': 'result','cmd': command,'id': message.get('id')}
+        if not client.authenticated:
+            result.update(ok=False,error='not authenticated')
+        elif command not in _COMMANDS:
+            result.update(ok=False,error='unknown command')
+        else:
+            future=_COMMANDS[command](self.scale)
+            try:
+                if future is False:
+                    raise Exception('Scale is not connected')
+                await asyncio.wrap_future(future)
+                result['ok']=True
+            except Exception as e:
+                result.update(ok=False,error=str(e) or type(e).__name__)
+        if client in self.clients:
+            client.write(encode_batch([result],client.encoding))
+
+    async def serve(self):
+        """Serve in the running loop until the task is cancelled"""
+        await self.listen()
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in self.servers))
+        finally:
+            await self._close()
+
+    async def listen(self):
+        """Start listening, port 0 picks a free port"""
+        self.loop=asyncio.get_running_loop()
+        server=await asyncio.start_server(self._handle,self.host,self.port,limit=_MAX_MESSAGE)
+        self.port=server.sockets[0].getsockname()[1]
+        self.servers.append(server)
+        if self.websocket_port is not None:
+            server=await asyncio.start_server(self._handle_websocket,self.host,
+                                              self.websocket_port,limit=_MAX_MESSAGE)
+            self.websocket_port=server.sockets[0].getsockname()[1]
+            self.servers.append(server)
+        if self not in self.scale.sinks:
+            self.scale.sinks.append(self)
+
+    def start(self):
+        """Serve from a thread with its own event loop"""
+        listening=Event()
+        errors=[]
+        def run():
+            loop=asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self.listen())
+            except Exception as e:
+                errors.append(e)
+                loop.close()
+                return
+            finally:
+                listening.set()
+            loop.run_forever()
+            loop.run_until_complete(self._close())
+            loop.close()
+        self.thread=Thread(target=run,name='AcaiaServer')
+        self.thread.daemon=True
+        self.thread.start()
+        listening.wait()
+        if errors:
+            self.thread=None
+            raise errors[0]
+        return self
+
+    async def _close(self):
+        if self in self.scale.sinks:
+            self.scale.sinks.remove(self)
+        for server in self.servers:
+            server.close()
+        tasks=[client.task for client in self.clients]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks,return_exceptions=True)
+        for server in self.servers:
+            await server.wait_closed()
+        self.servers=[]
+
+    def stop(self):
+        if self.thread:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread=None
+        elif self.servers:
+            asyncio.run_coroutine_threadsafe(self._close(),self.loop)
+
+    def stats(self):
+        return {
+            'clients': len(self.clients),
+            'batches': self.batches,
+            'samples': self.samples,
+            'encode_time': self.encode_time,
+            'per_client': [client.stats() for client in self.clients],
+        }
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Luca Pinello
+# Released under GPLv3
+
+"""Live state of a scale in shared memory, for other processes.
+
+   Only one process can be connected to a scale.  StatePublisher is a
+   sink of that process: it writes the weight, timer, battery and units
+   and a window of the last weight samples into a
+   multiprocessing.shared_memory segment named after the MAC address,
+   and StateReader attaches to it from any process on the machine:
+
+       scale.publish_state()                     # in the owning process
+       reader=StateReader('00:1C:97:17:FD:97')   # anywhere else
+       state=reader.read()
+       times,weights,timers=reader.last(50)
+
+   The segment is little-endian:
+
+       0   magic b'ACSM', version and capacity, unsigned ints
+       16  sequence, unsigned long long
+       24  state: samples appended (unsigned long long), time.monotonic()
+           of the update, weight, elapsed timer (doubles, NaN if
+           unknown), battery (short, -1 if unknown), units, timer
+           running and connected (bytes)
+       64  window of (time, weight, timer) doubles, written twice like
+           pyacaia.WeightSeries so the last samples are contiguous
+
+   The sequence is a seqlock: it is odd while the publisher writes, and
+   a reader retries when it was odd or changed during its read.  Reads
+   are struct unpacks from the mapped memory, without system calls.
+   The time is from time.monotonic(), the same clock in every process.
+"""
+
+import struct
+import time
+from array import array
+from collections import namedtuple
+from multiprocessing import shared_memory
+from threading import Lock
+
+MAGIC = b'ACSM'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sII')
+_SEQUENCE = struct.Struct('<Q')
+_STATE = struct.Struct('<QdddhBBB')
+_SAMPLE = struct.Struct('<ddd')
+
+_SEQUENCE_OFFSET = 16
+_STATE_OFFSET = 24
+_WINDOW_OFFSET = 64
+
+_UNITS = (None,'grams','ounces')
+_NAN = float('nan')
+
+# Segments published by this process
+_published = set()
+
+ScaleState = namedtuple('ScaleState',
+                        'time weight elapsed battery units timer_running connected samples')
+
+
+def segment_name(mac):
+    """Name of the shared memory segment of a scale"""
+    return 'pyacaia_'+mac.replace(':','').lower()
+
+
+class StatePublisher(object):
+    """Sink that publishes the state of scale, see the module docstring.
+       window is the number of weight samples kept
+    """
+
+    def __init__(self,scale,window=1024,name=None):
+        self.scale=scale
+        self.capacity=window
+        self.size=window+1
+        self.name=name or segment_name(scale.mac)
+        nbytes=_WINDOW_OFFSET+2*self.size*_SAMPLE.size
+        try:
+            self.shm=shared_memory.SharedMemory(self.name,create=True,size=nbytes)
+        except FileExistsError:
+            # Left over by a publisher that did not close
+            old=shared_memory.SharedMemory(self.name)
+            old.close()
+            old.unlink()
+            self.shm=shared_memory.SharedMemory(self.name,create=True,size=nbytes)
+        _published.add(self.name)
+        # close() may run in another thread than the updates
+        self.lock=Lock()
+        self.buf=self.shm.buf
+        self.sequence=0
+        self.count=0
+        _HEADER.pack_into(self.buf,0,MAGIC,VERSION,window)
+        self.update(time.monotonic())
+
+    def __call__(self,msg,now):
+        if getattr(msg,'msgType',None)==5:
+            self.update(now,msg.value)
+        else:
+            self.update(now)
+
+    def update(self,now,weight=None):
+        """Publish the state of the scale, and a weight sample if given.
+           Nothing is published once closed
+        """
+        scale=self.scale
+        elapsed=scale.get_elapsed_time()
+        with self.lock:
+            buf=self.buf
+            if buf is None:
+                return
+            self.sequence+=1
+            _SEQUENCE.pack_into(buf,_SEQUENCE_OFFSET,self.sequence)
+            if weight is not None:
+                # The timer when the scale measured it, as in scale.series
+                timer=scale.get_scale_time(now)
+                offset=_WINDOW_OFFSET+self.count%self.size*_SAMPLE.size
+                _SAMPLE.pack_into(buf,offset,now,weight,timer)
+                _SAMPLE.pack_into(buf,offset+self.size*_SAMPLE.size,now,weight,timer)
+                self.count+=1
+            _STATE.pack_into(buf,_STATE_OFFSET,self.count,now,
+                             _NAN if scale.weight is None else scale.weight,
+                             _NAN if elapsed is None else elapsed,
+                             -1 if scale.battery is None else scale.battery,
+                             _UNITS.index(scale.units) if scale.units in _UNITS else 0,
+                             bool(scale.timer_running),bool(scale.connected))
+            self.sequence+=1
+            _SEQUENCE.pack_into(buf,_SEQUENCE_OFFSET,self.sequence)
+
+    def close(self):
+        """Remove the segment, readers attached keep their mapping.
+           Waits for an update() running in the I/O thread
+        """
+        with self.lock:
+            if self.buf is None:
+                return
+            self.buf=None
+            _published.discard(self.name)
+            self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class StateReader(object):
+    """Reads the state published for the scale with MAC address mac,
+       or for the segment name
+    """
+
+    def __init__(self,mac=None,name=None):
+        self.name=name or segment_name(mac)
+        try:
+            self.shm=shared_memory.SharedMemory(self.name,track=False)
+        except TypeError:
+            # Before Python 3.13 attaching registers the segment with the
+            # resource tracker, which would remove it when we exit.  The
+            # publisher registered it already if it is in this process
+            from multiprocessing import resource_tracker
+            self.shm=shared_memory.SharedMemory(self.name)
+            if self.name not in _published:
+                resource_tracker.unregister(self.shm._name,'shared_memory')
+        self.buf=self.shm.buf
+        magic,version,self.capacity=_HEADER.unpack_from(self.buf,0)
+        if magic!=MAGIC or version!=VERSION:
+            self.close()
+            raise Exception('%s is not a pyacaia state segment' % self.name)
+        self.size=self.capacity+1
+        self.samples=self.buf[_WINDOW_OFFSET:_WINDOW_OFFSET+2*self.size*_SAMPLE.size].cast('d')
+        # Reads that were retried because the publisher was writing
+        self.retries=0
+
+    def read(self):
+        """Return a consistent ScaleState"""
+        buf=self.buf
+        while True:
+            before=_SEQUENCE.unpack_from(buf,_SEQUENCE_OFFSET)[0]
+            if not before & 1:
+                state=_STATE.unpack_from(buf,_STATE_OFFSET)
+                if _SEQUENCE.unpack_from(buf,_SEQUENCE_OFFSET)[0]==before:
+                    break
+            self.retries+=1
+        samples,t,weight,elapsed,battery,units,timer_running,connected=state
+        return ScaleState(t,None if weight!=weight else weight,
+                          None if elapsed!=elapsed else elapsed,
+                          None if battery<0 else battery,_UNITS[units],
+                          bool(timer_running),bool(connected),samples)
+
+    def last(self,n=None,copy=True):
+        """Return (times, weights, timers) of the last n samples, oldest
+           first.  With copy=False they are memoryviews of the segment,
+           strided over its records, which stay valid for capacity-n
+           more samples
+        """
+        while True:
+            count=self.read().samples
+            if n is None or n>min(count,self.capacity):
+                n=min(count,self.capacity)
+            stop=count%self.size+self.size
+            window=self.samples[3*(stop-n):3*stop]
+            if not copy:
+                return window[0::3],window[1::3],window[2::3]
+            result=(array('d',window[0::3]),array('d',window[1::3]),array('d',window[2::3]))
+            # Retry if the publisher overwrote the samples while copying
+            if self.read().samples-count<self.size-n:
+                return result
+
+    def close(self):
+        """Detach, the memoryviews returned by last() must be released"""
+        self.samples.release()
+        self.samples=None
+        self.buf=None
+        self.shm.close()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Luca Pinello
+# Released under GPLv3
+
+"""Simulated Acaia scale, used with AcaiaScale(backend='sim').
+
+   SimulatedScale answers the commands of the real protocol: ident with
+   the settings, the notification request by streaming weights, the
+   heartbeat, tare and timer commands with their events.  SimPeripheral
+   stands in for a bluepy Peripheral and carries the frames over a
+   simulated radio that coalesces them into MTU sized notifications,
+   and can fragment, corrupt and drop notifications.  Notifications are
+   signalled through a pipe like bluepy-helper does, so AcaiaHub and
+   AsyncAcaiaScale can poll simulated scales too.
+
+   The weight streams of all the simulated scales are generated by one
+   shared thread, so hundreds of them can run in one process:
+
+       scale=AcaiaScale('sim-1',backend='sim',sim_options={'rate':10,'drop':0.01})
+       scale.connect()
+       scale.device.scale.flow=2.0    # grams per second
+"""
+
+import heapq
+import logging
+import os
+import random
+import select
+import time
+from collections import deque
+from threading import Thread, Condition, Lock
+
+from . import HEADER, encodeEventData, encodeSettings
+
+# Handles of the old-style scale, see BluepyBackend.find_characteristics()
+CHAR_HANDLE = 13
+NOTIFY_HANDLE = 14
+
+# ATT header bytes in a notification
+_ATT_OVERHEAD = 3
+
+def _weight_bytes(weight):
+    """Weight payload with a resolution of 0.1"""
+    value=int(round(abs(weight)*10))
+    if value>0xffff:
+        value=0xffff
+    return [value & 0xff, value>>8, 0, 0, 1, 0x02 if weight<0 else 0]
+
+
+def _time_bytes(seconds):
+    tenths=int(round(seconds*10))
+    return [tenths//600, (tenths//10)%60, tenths%10]
+
+
+class SimulatedScale(object):
+    """State of a simulated scale.  The weight grows by flow grams per
+       second, plus uniform noise of the given amplitude.  All the
+       methods take the time.monotonic() they happen at and return the
+       frames the scale sends back.
+    """
+
+    def __init__(self,weight=0.0,flow=0.0,noise=0.0,battery=80,units='grams',
+                 auto_off=30,beep_on=True,seed=None):
+        self.gross=weight
+        self.tare_offset=0.0
+        self.flow=flow
+        self.noise=noise
+        self.battery=battery
+        self.units=units
+        self.auto_off=auto_off
+        self.beep_on=beep_on
+        self.random=random.Random(seed)
+        self.notifying=False
+        # Weight argument of the notification request, the weights are
+        # sent every weight_interval ticks
+        self.weight_interval=1
+        # Timer argument, a timer message every timer_interval
+        # heartbeats while the timer runs, None if not requested
+        self.timer_interval=None
+        self.heartbeats=0
+        self.timer_running=False
+        self.timer_start=0.0
+        self.timer_paused=0.0
+        self.last_update=None
+
+    def update(self,now):
+        if self.last_update is not None:
+            self.gross+=self.flow*(now-self.last_update)
+        self.last_update=now
+
+    def weight(self):
+        weight=self.gross-self.tare_offset
+        if self.noise:
+            weight+=self.random.uniform(-self.noise,self.noise)
+        return weight
+
+    def elapsed(self,now):
+        if self.timer_running:
+            return now-self.timer_start
+        return self.timer_paused
+
+    def settings_frame(self):
+        return encodeSettings(self.battery,self.units,self.auto_off,self.beep_on)
+
+    def weight_frame(self,now):
+        self.update(now)
+        return encodeEventData([5]+_weight_bytes(self.weight()))
+
+    def timer_frame(self,now):
+        return encodeEventData([7]+_time_bytes(self.elapsed(now)))
+
+    def command(self,frame,now):
+        """Handle a command frame, return the frames sent in reply"""
+        self.update(now)
+        cmd=frame[2]
+        if cmd==11:
+            # ident
+            return [self.settings_frame()]
+        if cmd==12:
+            # notification request, (event, interval) pairs
+            pairs=frame[4:3+frame[3]]
+            intervals=dict(zip(pairs[0::2],pairs[1::2]))
+            self.weight_interval=max(1,intervals.get(0,1))
+            self.timer_interval=intervals.get(2)
+            self.notifying=True
+            return [self.weight_frame(now)]
+        if cmd==0:
+            self.heartbeats+=1
+            replies=[encodeEventData([11,0,0,5]+_weight_bytes(self.weight()))]
+            interval=self.timer_interval
+            if self.timer_running and interval and self.heartbeats%interval==0:
+                replies.append(self.timer_frame(now))
+            return replies
+        if cmd==4:
+            self.tare_offset=self.gross
+            return [encodeEventData([8,0,5]+_weight_bytes(self.weight()))]
+        if cmd==13:
+            action=frame[4]
+            if action==0:
+                if not self.timer_running:
+                    self.timer_start=now-self.timer_paused
+                    self.timer_running=True
+                return [encodeEventData([8,8,5]+_weight_bytes(self.weight()))]
+            if action==2:
+                self.timer_paused=self.elapsed(now)
+                self.timer_running=False
+                return [encodeEventData([8,10,7]+_time_bytes(self.timer_paused)+[0]
+                                        +_weight_bytes(self.weight()))]
+            if action==1:
+                self.timer_running=False
+                self.timer_paused=0.0
+                return [encodeEventData([8,9,7]+_time_bytes(0)+[0]
+                                        +_weight_bytes(self.weight()))]
+        if cmd==6:
+            return [self.settings_frame()]
+        logging.debug('Simulated scale ignores command %d' % cmd)
+        return []
+
+
+class _Helper(object):
+    """Where AcaiaScale.notification_fd() looks for the pipe"""
+
+    def __init__(self,fd):
+        self.stdout=os.fdopen(fd,'rb',0)
+
+
+class SimPeripheral(object):
+    """bluepy Peripheral stand-in connected to a SimulatedScale.
+
+       rate          weight notifications per second, divided by the
+                     weight interval of the notification request
+       fragment      probability to split a notification in two
+       bitflip       probability to flip one bit of a notification
+       drop          probability to lose a notification
+       coalesce      pack the frames of one tick in as few MTU sized
+                     notifications as possible
+       seed          for the random faults
+       scale         SimulatedScale, or the arguments to make one
+    """
+
+    def __init__(self,rate=10.0,fragment=0.0,bitflip=0.0,drop=0.0,coalesce=True,
+                 seed=None,scale=None,**scale_args):
+        self.scale=scale if scale is not None else SimulatedScale(seed=seed,**scale_args)
+        self.rate=rate
+        self.fragment=fragment
+        self.bitflip=bitflip
+        self.drop=drop
+        self.coalesce=coalesce
+        self.random=random.Random(seed)
+        # Default ATT MTU until setMTU()
+        self.mtu=23
+        self.delegate=None
+        self.lock=Lock()
+        self.outbox=deque()
+        r,w=os.pipe()
+        self._helper=_Helper(r)
+        self.wake_w=w
+        self.connected=True
+        self.writes=0
+        self.notifications=0
+        self.dropped=0
+        # In the heap of the driver thread
+        self.scheduled=False
+
+    def withDelegate(self,delegate):
+        self.delegate=delegate
+        return self
+
+    def setMTU(self,mtu):
+        self.mtu=mtu
+
+    def writeCharacteristic(self,handle,data,withResponse=False):
+        now=time.monotonic()
+        with self.lock:
+            self.writes+=1
+            if handle!=CHAR_HANDLE:
+                return
+            # Commands have no length field, the scale takes one per write
+            if bytes(data[:2])!=HEADER:
+                logging.debug('Simulated scale ignores a write without header')
+                return
+            replies=self.scale.command(data,now)
+            was_notifying=self.scale.notifying
+        if replies:
+            self.send(replies)
+        if was_notifying and not self.scheduled:
+            _driver().add(self,now+self.interval())
+
+    def tick(self,now):
+        """Called by the shared driver thread, return the next due time"""
+        if not self.connected:
+            return None
+        with self.lock:
+            frame=self.scale.weight_frame(now)
+        self.send([frame])
+        return now+self.interval()
+
+    def interval(self):
+        return self.scale.weight_interval/self.rate
+
+    def send(self,frames):
+        """Carry frames over the simulated radio"""
+        size=max(1,self.mtu-_ATT_OVERHEAD)
+        if self.coalesce:
+            data=bytearray()
+            for frame in frames:
+                data+=frame
+            packets=[data]
+        else:
+            packets=frames
+        notifications=[]
+        for packet in packets:
+            for i in range(0,len(packet),size):
+                notifications.append(bytes(packet[i:i+size]))
+        rnd=self.random
+        sent=0
+        with self.lock:
+            for data in notifications:
+                if self.drop and rnd.random()<self.drop:
+                    self.dropped+=1
+                    continue
+                if self.bitflip and rnd.random()<self.bitflip:
+                    data=bytearray(data)
+                    data[rnd.randrange(len(data))]^=1<<rnd.randrange(8)
+                    data=bytes(data)
+                if self.fragment and len(data)>1 and rnd.random()<self.fragment:
+                    cut=rnd.randrange(1,len(data))
+                    self.outbox.append(data[:cut])
+                    self.outbox.append(data[cut:])
+                    sent+=2
+                else:
+                    self.outbox.append(data)
+                    sent+=1
+            if sent and self.connected:
+                try:
+                    os.write(self.wake_w,b'n'*sent)
+                except OSError:
+                    pass
+
+    def waitForNotifications(self,timeout):
+        helper=self._helper
+        if helper is None:
+            time.sleep(timeout)
+            return False
+        try:
+            fd=helper.stdout.fileno()
+            if not select.select([fd],[],[],timeout)[0] or not os.read(fd,1):
+                return False
+        except (OSError,ValueError):
+            return False
+        with self.lock:
+            data=self.outbox.popleft()
+            self.notifications+=1
+        self.delegate.handleNotification(NOTIFY_HANDLE,data)
+        return True
+
+    def disconnect(self):
+        if not self.connected:
+            return
+        self.connected=False
+        # Like bluepy, which stops bluepy-helper
+        helper=self._helper
+        self._helper=None
+        with self.lock:
+            os.close(self.wake_w)
+        helper.stdout.close()
+
+
+class _SimDriver(Thread):
+    """Generates the weight notifications of all the simulated scales"""
+
+    def __init__(self):
+        Thread.__init__(self,name='AcaiaSim')
+        self.daemon=True
+        self.condition=Condition()
+        self.heap=[]
+        self.sequence=0
+
+    def add(self,peripheral,due):
+        with self.condition:
+            peripheral.scheduled=True
+            self.sequence+=1
+            heapq.heappush(self.heap,(due,self.sequence,peripheral))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0]>time.monotonic():
+                    timeout=self.heap[0][0]-time.monotonic() if self.heap else None
+                    self.condition.wait(timeout)
+                due,_,peripheral=heapq.heappop(self.heap)
+            try:
+                next_due=peripheral.tick(time.monotonic())
+            except Exception as e:
+                logging.debug('Simulated scale failed '+str(e))
+                next_due=None
+            if next_due is None:
+                peripheral.scheduled=False
+                continue
+            # Do not try to catch up when running late
+            next_due=max(next_due,due+peripheral.interval())
+            with self.condition:
+                self.sequence+=1
+                heapq.heappush(self.heap,(next_due,self.sequence,peripheral))
+
+_driver_lock = Lock()
+_the_driver = None
+
+def _driver():
+    global _the_driver
+    with _driver_lock:
+        if _the_driver is None:
+            _the_driver=_SimDriver()
+            _the_driver.start()
+        return _the_driver
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Luca Pinello
+# Released under GPLv3
+
+"""Weight triggers, for instance to stop a pump at a target weight.
+
+   Triggers are evaluated in the I/O thread as each weight sample is
+   decoded, and their callbacks are called right there, so they must be
+   quick: switch a GPIO, set an Event, or hand the work to a thread.
+
+   A threshold trigger fires early, when the weight extrapolated with
+   the current flow rate (scale.flow_rate) over the lead time reaches
+   the target.  The lead time defaults to the latency of the whole
+   pipeline: the Bluetooth transit (scale.transit_delay), the time from
+   receiving a sample to evaluating it, and the time the callbacks take.
+
+       trigger=scale.when_weight(36.0,pump.stop)
+       ...
+       print(trigger.stats())
+
+   A trigger with once=True belongs to a shot: the one running when it
+   is added, or else the next one started.  If it has not fired when
+   that shot is stopped or reset, it is removed rather than fire in the
+   next shot.  Triggers with once=False stay until cancel().
+"""
+
+import logging
+import time
+from collections import namedtuple
+
+from . import Histogram
+
+TriggerEvent = namedtuple('TriggerEvent', 'time weight flow predicted lead latency')
+
+# Buckets for latencies from tens of microseconds to tens of milliseconds
+_LATENCY_BOUNDS = (1e-5,2e-5,5e-5,1e-4,2e-4,5e-4,1e-3,2e-3,5e-3,1e-2,2e-2,5e-2)
+
+# Weight of new measurements in the moving averages of the pipeline
+_SMOOTHING = 0.1
+
+
+class Trigger(object):
+    """A rule and its callback.  The rule is either a target weight,
+       reached from below if rising is True, or predicate(weight, flow).
+       callback(TriggerEvent) is called when the rule becomes true, and
+       then again every time it becomes true after being false unless
+       once is True.
+
+       latency has the time from receiving the sample to calling the
+       callback.  For targets, early has how long before the weight was
+       actually reported at the target the trigger fired.  expired is
+       True if the shot of a once trigger ended before it fired.
+    """
+
+    def __init__(self,engine,callback,target=None,predicate=None,rising=True,lead=None,
+                 once=True):
+        if (target is None)==(predicate is None):
+            raise Exception('A trigger needs either a target or a predicate')
+        self.engine=engine
+        self.callback=callback
+        self.target=target
+        self.predicate=predicate
+        self.rising=rising
+        self.lead=lead
+        self.once=once
+        self.armed=True
+        # Fired once, kept until the target is reached to measure early
+        self.done=False
+        self.fired=0
+        self.errors=0
+        self.last_event=None
+        self.latency=Histogram(_LATENCY_BOUNDS)
+        self.early=Histogram()
+        # Fire time waiting for the weight to actually reach the target
+        self.crossing=None
+        # Whether the shot of the trigger has started, see the module
+        # docstring
+        self.in_shot=bool(engine.scale.timer_running)
+        self.expired=False
+
+    def cancel(self):
+        self.done=True
+        self.engine.remove(self)
+
+    def shot_ended(self):
+        """Remove the trigger if its shot ended before it fired"""
+        if self.once and self.in_shot and not self.fired:
+            self.expired=True
+            self.cancel()
+
+    def check(self,now,weight,flow,lead):
+        if self.crossing is not None and self._reached(weight):
+            self.early.add(max(0.0,now-self.crossing))
+            self.crossing=None
+            if self.done:
+                self.engine.remove(self)
+        if self.done:
+            return False
+        if self.target is not None:
+            if self.lead is not None:
+                lead=self.lead
+            # Only extrapolate towards the target
+            if (flow>0)==self.rising:
+                predicted=weight+flow*lead
+            else:
+                predicted=weight
+            active=self._reached(predicted)
+        else:
+            predicted=weight
+            active=self.predicate(weight,flow)
+        if not active:
+            self.armed=True
+            return False
+        if not self.armed:
+            return False
+        self.armed=False
+        self.fire(now,weight,flow,predicted,lead)
+        return True
+
+    def _reached(self,weight):
+        if self.rising:
+            return weight>=self.target
+        return weight<=self.target
+
+    def fire(self,received,weight,flow,predicted,lead):
+        start=time.monotonic()
+        latency=start-received
+        event=TriggerEvent(received,weight,flow,predicted,lead,latency)
+        self.last_event=event
+        self.fired+=1
+        self.latency.add(latency)
+        if self.target is not None:
+            self.crossing=received if not self._reached(weight) else None
+            if self.crossing is None:
+                self.early.add(0.0)
+        try:
+            self.callback(event)
+        except Exception as e:
+            self.errors+=1
+            logging.debug('Trigger callback failed '+str(e))
+        self.engine.callback_done(time.monotonic()-start)
+        if self.once:
+            self.done=True
+            if self.crossing is None:
+                self.engine.remove(self)
+
+    def stats(self):
+        return {
+            'target': self.target,
+            'fired': self.fired,
+            'expired': self.expired,
+            'errors': self.errors,
+            'latency': self.latency.as_dict(),
+            'early': self.early.as_dict(),
+            'last_event': self.last_event._asdict() if self.last_event else None,
+        }
+
+
+class TriggerEngine(object):
+    """Sink of an AcaiaScale that evaluates its triggers on each weight"""
+
+    def __init__(self,scale):
+        self.scale=scale
+        self.triggers=[]
+        # Moving averages of the receive to evaluation time and of the
+        # time the callbacks take
+        self.pipeline=0.0
+        self.callback_time=0.0
+
+    def add(self,callback,**kwargs):
+        trigger=Trigger(self,callback,**kwargs)
+        # Copy on write, the I/O thread iterates over the list
+        self.triggers=self.triggers+[trigger]
+        return trigger
+
+    def remove(self,trigger):
+        self.triggers=[t for t in self.triggers if t is not trigger]
+
+    def lead(self):
+        """Seconds between the scale measuring a weight and the end of
+           the callback that reacts to it
+        """
+        return self.scale.transit_delay+self.pipeline+self.callback_time
+
+    def callback_done(self,duration):
+        self.callback_time+=_SMOOTHING*(duration-self.callback_time)
+
+    def button(self,button):
+        """The start, stop and reset buttons delimit the shots"""
+        if button=='start':
+            for trigger in self.triggers:
+                trigger.in_shot=True
+        elif button in ('stop','reset'):
+            for trigger in self.triggers:
+                trigger.shot_ended()
+
+    def __call__(self,msg,now):
+        triggers=self.triggers
+        if not triggers:
+            return
+        msgType=getattr(msg,'msgType',None)
+        if msgType!=5:
+            if msgType==8:
+                self.button(msg.button)
+            return
+        weight=msg.value
+        flow=self.scale.analytics.flow
+        self.pipeline+=_SMOOTHING*(time.monotonic()-now-self.pipeline)
+        lead=self.lead()
+        for trigger in triggers:
+            trigger.check(now,weight,flow,lead)
@@ -24,7 +24,20 @@ setup(
     author='Luca Pinello',
     license='GPLv3',
     packages=find_packages(),
+    # asyncio.get_running_loop() and multiprocessing.shared_memory
+    python_requires='>=3.8',
     install_requires=[
         'bluepy', #pygatt is also supported
+    ],
+    classifiers=[
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
+        'Operating System :: POSIX :: Linux',
+        'Framework :: AsyncIO',
     ]
 )
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from pyacaia import AsyncAcaiaScale
+from pyacaia.aio import Stream
+from pyacaia.dispatch import COALESCE_LATEST, DROP_OLDEST
+
+
+class _Owner(object):
+
+    def _remove_stream(self,stream):
+        pass
+
+
+def _scale(**sim_options):
+    return AsyncAcaiaScale('00:00:00:00:00:01',backend='sim',
+                           sim_options=dict(rate=50,**sim_options))
+
+
+def test_weights():
+    async def run():
+        scale=_scale(weight=15.0)
+        await scale.connect()
+        samples=[]
+        stream=scale.weights()
+        async for sample in stream:
+            samples.append(sample)
+            if len(samples)==5:
+                break
+        await scale.disconnect()
+        return samples
+    samples=asyncio.run(run())
+    assert [sample.weight for sample in samples]==[15.0]*5
+    times=[sample.time for sample in samples]
+    assert times==sorted(times)
+
+
+def test_tare_and_events():
+    async def run():
+        scale=_scale(weight=15.0)
+        await scale.connect()
+        events=scale.events()
+        msg=await asyncio.wait_for(scale.tare(),5)
+        event=await asyncio.wait_for(events.__anext__(),5)
+        weight=await asyncio.wait_for(scale.weights().__anext__(),5)
+        await scale.disconnect()
+        return msg,event,weight
+    msg,event,weight=asyncio.run(run())
+    assert msg.button=='tare'
+    assert event.button=='tare'
+    assert weight.weight==0.0
+
+
+def test_disconnect_ends_the_streams():
+    async def run():
+        scale=_scale()
+        await scale.connect()
+        stream=scale.weights()
+        await stream.__anext__()
+        await scale.disconnect()
+        async def rest():
+            return [sample async for sample in stream]
+        # The samples received before the disconnect, then the end
+        return await asyncio.wait_for(rest(),5)
+    assert len(asyncio.run(run()))<=256
+
+
+def test_stream_overflow():
+    stream=Stream(_Owner(),3,DROP_OLDEST)
+    for i in range(5):
+        stream.put(i)
+    assert list(stream.buffer)==[2,3,4]
+    assert stream.dropped==2
+    stream=Stream(_Owner(),3,COALESCE_LATEST)
+    for i in range(5):
+        stream.put(i)
+    assert list(stream.buffer)==[0,1,4]
+    assert stream.dropped==2
+    with pytest.raises(Exception):
+        Stream(_Owner(),3,'block')
@@ -0,0 +1,47 @@
+import pytest
+
+from pyacaia.analytics import FlowEstimator
+
+
+def test_flow_of_a_linear_pour():
+    flow=FlowEstimator(window=1.0)
+    for i in range(50):
+        flow.add(i*0.1,2.0*i*0.1+5.0)
+    assert flow.flow==pytest.approx(2.0)
+    # Only the last second is kept
+    assert flow.n==11
+    assert not flow.stable
+
+
+def test_flow_stable_weight():
+    flow=FlowEstimator(window=1.0)
+    assert flow.flow==0.0
+    assert not flow.stable
+    for i in range(20):
+        flow.add(i*0.1,18.0+(0.02 if i%2 else -0.02))
+    assert abs(flow.flow)<0.05
+    assert flow.stable
+
+
+def test_flow_matches_a_full_recomputation():
+    flow=FlowEstimator(window=0.5)
+    samples=[(i*0.05,(i*7919)%13*0.3) for i in range(200)]
+    for t,w in samples:
+        flow.add(t,w)
+    window=[(t,w) for t,w in samples if t>=samples[-1][0]-0.5]
+    n=len(window)
+    mean_t=sum(t for t,w in window)/n
+    mean_w=sum(w for t,w in window)/n
+    slope=(sum((t-mean_t)*(w-mean_w) for t,w in window)/
+           sum((t-mean_t)**2 for t,w in window))
+    assert flow.n==n
+    assert flow.flow==pytest.approx(slope,abs=1e-9)
+
+
+def test_flow_reset():
+    flow=FlowEstimator()
+    for i in range(5):
+        flow.add(i*0.1,i)
+    flow.reset()
+    assert flow.n==0
+    assert flow.flow==0.0
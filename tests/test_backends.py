@@ -0,0 +1,61 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+from pyacaia import AcaiaScale, find_acaia_devices
+from pyacaia.backends import BACKENDS, SimBackend, get_backend, register_backend
+
+
+def _wait(condition,timeout=5):
+    deadline=time.monotonic()+timeout
+    while not condition() and time.monotonic()<deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class _CountingBackend(SimBackend):
+
+    name = 'counting'
+    opened = 0
+
+    def scan(self,deadline,found,done):
+        found('ACAIA COUNT','00:00:00:00:25:01',-40)
+
+    def open(self):
+        _CountingBackend.opened+=1
+        return super(_CountingBackend,self).open()
+
+
+@pytest.fixture
+def counting():
+    register_backend('counting',_CountingBackend)
+    yield _CountingBackend
+    del BACKENDS['counting']
+
+
+def test_registered_backend(counting):
+    assert get_backend('counting') is counting
+    assert find_acaia_devices(backend='counting',timeout=0.1)==['00:00:00:00:25:01']
+    scale=AcaiaScale('00:00:00:00:25:01',backend='counting',sim_options={'weight':3.0})
+    scale.connect()
+    try:
+        assert counting.opened==1
+        assert _wait(lambda: scale.weight==3.0)
+    finally:
+        scale.disconnect()
+
+
+def test_unknown_backend():
+    with pytest.raises(Exception,match='Backend not supported'):
+        get_backend('carrier-pigeon')
+    with pytest.raises(Exception,match='Backend not supported'):
+        AcaiaScale('00:00:00:00:25:02',backend='carrier-pigeon')
+
+
+def test_import_does_not_load_bluetooth_libraries():
+    code=('import sys,pyacaia; '
+          'print(any(m in sys.modules for m in ("bluepy","pygatt")))')
+    output=subprocess.check_output([sys.executable,'-c',code])
+    assert output.strip()==b'False'
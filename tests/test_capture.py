@@ -0,0 +1,134 @@
+import time
+
+import pytest
+
+from pyacaia import AcaiaScale
+from pyacaia.capture import COMMAND, NOTIFICATION, CaptureReader, CaptureWriter
+
+
+def _wait(condition,timeout=5):
+    deadline=time.monotonic()+timeout
+    while not condition() and time.monotonic()<deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_records_round_trip(tmp_path):
+    path=str(tmp_path/'capture.acap')
+    writer=CaptureWriter(path)
+    writer.record(NOTIFICATION,14,b'\xef\xdd\x0c',1.5)
+    writer.record(COMMAND,13,b'\xef\xdd\x04\x00\x00\x00',2.5)
+    writer.close()
+    # Appending keeps the single header
+    writer=CaptureWriter(path)
+    writer.record(NOTIFICATION,14,b'',3.5)
+    writer.close()
+    writer.record(NOTIFICATION,14,b'late')
+    reader=CaptureReader(path)
+    records=[(t,kind,handle,bytes(data)) for t,kind,handle,data in reader]
+    assert records==[(1.5,NOTIFICATION,14,b'\xef\xdd\x0c'),
+                     (2.5,COMMAND,13,b'\xef\xdd\x04\x00\x00\x00'),
+                     (3.5,NOTIFICATION,14,b'')]
+    assert [t for t,kind,handle,data in reader.records(COMMAND)]==[2.5]
+    reader.close()
+
+
+def test_truncated_capture(tmp_path):
+    path=str(tmp_path/'capture.acap')
+    writer=CaptureWriter(path)
+    writer.record(NOTIFICATION,14,b'abc',1.0)
+    writer.record(NOTIFICATION,14,b'defgh',2.0)
+    writer.close()
+    with open(path,'r+b') as f:
+        f.truncate(f.seek(0,2)-2)
+    reader=CaptureReader(path)
+    assert [bytes(data) for t,kind,handle,data in reader]==[b'abc']
+    reader.close()
+
+
+def test_not_a_capture(tmp_path):
+    path=tmp_path/'other'
+    path.write_bytes(b'PK\x03\x04'+b'\0'*20)
+    with pytest.raises(Exception):
+        CaptureReader(str(path))
+
+
+def _record(path,**sim_options):
+    """Record a simulated scale from after it connected, return the
+       weights received meanwhile
+    """
+    scale=AcaiaScale('00:00:00:00:00:01',backend='sim',
+                     sim_options=dict(rate=50,**sim_options))
+    scale.connect()
+    weights=[]
+    scale.record(path)
+    scale.sinks.append(lambda msg,now: getattr(msg,'msgType',None)==5
+                       and weights.append(msg.value))
+    scale.device.scale.flow=10.0
+    assert _wait(lambda: len(weights)>=20)
+    scale.tare().result(5)
+    count=len(weights)
+    assert _wait(lambda: len(weights)>=count+5)
+    scale.stop_recording()
+    scale.disconnect()
+    return weights
+
+
+def _sink(scale):
+    weights=[]
+    buttons=[]
+    def sink(msg,now):
+        if getattr(msg,'msgType',None)==5:
+            weights.append(msg.value)
+        elif getattr(msg,'msgType',None)==8:
+            buttons.append(msg.button)
+    scale.sinks.append(sink)
+    return weights,buttons
+
+
+def _replay(path):
+    scale=AcaiaScale('00:00:00:00:00:01',backend='sim')
+    weights,buttons=_sink(scale)
+    count,seconds=scale.replay(path)
+    assert count>0
+    assert scale.weight==weights[-1]
+    return weights,buttons
+
+
+def test_replay_into_a_scale(tmp_path):
+    path=str(tmp_path/'capture.acap')
+    received=_record(path)
+    weights,buttons=_replay(path)
+    assert buttons==['tare']
+    # The weights received while recording, but for the notifications
+    # in flight when it started and stopped
+    middle=received[2:-2]
+    assert any(weights[i:i+len(middle)]==middle for i in range(len(weights)))
+
+
+def test_replay_backend(tmp_path):
+    path=str(tmp_path/'capture.acap')
+    _record(path,weight=5.0)
+    expected=_replay(path)
+    scale=AcaiaScale('00:00:00:00:00:01',backend='replay',capture=path,replay_speed=None)
+    weights,buttons=_sink(scale)
+    # The settings of the scale were recorded first
+    scale.connect(5)
+    try:
+        assert _wait(lambda: len(weights)>=len(expected[0]))
+        assert (weights,buttons)==expected
+        assert scale.units=='grams'
+    finally:
+        scale.disconnect()
+
+
+def test_no_replay_on_a_connected_scale(tmp_path):
+    path=str(tmp_path/'capture.acap')
+    _record(path)
+    scale=AcaiaScale('00:00:00:00:00:01',backend='sim')
+    scale.connect()
+    try:
+        with pytest.raises(Exception):
+            scale.replay(path)
+    finally:
+        scale.disconnect()
@@ -0,0 +1,83 @@
+import pytest
+
+from pyacaia.clock import ClockSync
+
+
+def _clock():
+    clock=ClockSync(delay=0.2,max_slew=0.05,step=1.0)
+    clock.observe(100.0,0.0)
+    return clock
+
+
+def test_first_report_uses_the_initial_delay():
+    clock=_clock()
+    assert clock.running
+    assert clock.elapsed(101.0)==pytest.approx(1.2)
+    # A weight received at now was measured delay earlier
+    assert clock.scale_time(101.0)==pytest.approx(1.0)
+
+
+def test_first_round_trip_replaces_the_guess():
+    clock=_clock()
+    clock.round_trip(100.5,0.1)
+    assert clock.delay==pytest.approx(0.05)
+    assert clock.elapsed(101.0)==pytest.approx(1.05)
+    # Longer round trips do not change the delay
+    clock.round_trip(101.0,0.3)
+    assert clock.delay==pytest.approx(0.05)
+
+
+def test_small_corrections_are_slewed():
+    clock=_clock()
+    clock.round_trip(100.5,0.1)
+    # This report arrived faster, the timer started 0.04 s earlier
+    clock.observe(102.0,2.04)
+    assert clock.elapsed(102.0)==pytest.approx(2.05)
+    assert clock.elapsed(102.4)==pytest.approx(2.47)
+    assert clock.elapsed(103.0)==pytest.approx(3.09)
+    assert clock.elapsed(110.0)==pytest.approx(10.09)
+    assert clock.steps==2
+
+
+def test_elapsed_never_goes_back_while_slewing():
+    clock=_clock()
+    clock.observe(100.5,0.9)
+    previous=0.0
+    for i in range(100):
+        now=100.5+i*0.01
+        elapsed=clock.elapsed(now)
+        assert elapsed>=previous
+        previous=elapsed
+
+
+def test_large_corrections_step():
+    clock=_clock()
+    steps=clock.steps
+    # The timer was restarted on the scale
+    clock.observe(110.0,1.0)
+    assert clock.steps==steps+1
+    assert clock.elapsed(110.0)==pytest.approx(1.2)
+    assert len(clock.reports)==1
+
+
+def test_stop_start_and_reset():
+    clock=_clock()
+    clock.stop(5.0)
+    assert not clock.running
+    assert clock.elapsed(200.0)==5.0
+    assert clock.scale_time(200.0)==5.0
+    clock.start(300.0)
+    assert clock.elapsed(301.0)==pytest.approx(6.2)
+    clock.reset()
+    assert not clock.running
+    assert clock.elapsed(400.0)==0.0
+
+
+def test_as_dict():
+    clock=_clock()
+    clock.round_trip(100.5,0.1)
+    stats=clock.as_dict()
+    assert stats['running']
+    assert stats['delay']==pytest.approx(0.05)
+    assert stats['reports']==1
+    assert stats['round_trips']==1
@@ -0,0 +1,46 @@
+from pyacaia import (Framer, Message, Settings, decode_frame, encode, encodeEventData,
+                     encodeSettings, encodeTare, encodeHeartbeat)
+
+
+def _weight(tenths,unit=1,negative=False):
+    return bytes(encodeEventData([5,tenths & 0xff,tenths>>8,0,0,unit,2 if negative else 0]))
+
+
+def test_decode_frames():
+    msg=decode_frame(memoryview(_weight(1234)))
+    assert isinstance(msg,Message)
+    assert msg.msgType==5
+    assert msg.value==123.4
+    settings=decode_frame(memoryview(bytes(encodeSettings(55,'ounces',15,False))))
+    assert isinstance(settings,Settings)
+    assert (settings.battery,settings.units,settings.auto_off,settings.beep_on)==(55,'ounces',15,False)
+    assert decode_frame(memoryview(bytes(encode(4,[1,0])))) is None
+
+
+def test_message_keeps_its_payload():
+    framer=Framer()
+    framer.feed(_weight(1))
+    msg=decode_frame(next(iter(framer)))
+    payload=msg.payload
+    framer.feed(_weight(999))
+    list(framer)
+    assert msg.payload==payload==_weight(1)[5:]
+
+
+def test_weight_units_and_sign():
+    assert Message(5,_weight(1234,unit=2)[5:]).value==12.34
+    assert Message(5,_weight(50,negative=True)[5:]).value==-5.0
+
+
+def test_button_messages():
+    msg=Message(8,bytes(encodeEventData([8,10,7,0,3,0,0,100,0,0,0,1,0]))[5:])
+    assert msg.button=='stop'
+    assert msg.time==3.0
+    assert msg.value==10.0
+    assert Message(8,bytes(encodeEventData([8,0,5,0,0,0,0,1,0]))[5:]).button=='tare'
+
+
+def test_command_frames_are_precomputed():
+    assert encodeTare() is encodeTare()
+    assert encodeTare()==bytes(encode(4,[0]))
+    assert encodeHeartbeat()==bytes(encode(0,[2,0]))
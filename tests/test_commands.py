@@ -0,0 +1,163 @@
+import select
+import time
+
+import pytest
+
+from pyacaia import (AcaiaScale, CommandQueue, CommandTracker, Message, encodeEventData,
+                     encodeGetSettings, encodeTare)
+
+
+def _message(payload):
+    frame=encodeEventData(payload)
+    return Message(frame[4],frame[5:])
+
+
+def _weight(tenths):
+    return _message([5,tenths & 0xff,tenths>>8,0,0,1,0])
+
+_TARE_BUTTON = [8,0,5,0,0,0,0,1,0]
+_START_BUTTON = [8,8,5,0,0,0,0,1,0]
+
+
+def _wait(condition,timeout=5):
+    deadline=time.monotonic()+timeout
+    while not condition() and time.monotonic()<deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_command_queue_wakes_up_the_poller():
+    queue=CommandQueue()
+    fd=queue.fileno()
+    queue.add(b'a')
+    queue.add(b'b')
+    assert select.select([fd],[],[],0)[0]==[fd]
+    queue.clear_wakeup()
+    assert select.select([fd],[],[],0)[0]==[]
+    assert queue.dequeue()==b'a'
+    assert queue.dequeue()==b'b'
+    assert queue.dequeue() is None
+    assert queue.max_depth==2
+    queue.close()
+
+
+def test_commands_are_written_right_away():
+    # One weight every 2 seconds, the I/O thread would sleep in between
+    scale=AcaiaScale('00:00:00:00:00:01',backend='sim',sim_options={'rate':0.5})
+    scale.connect()
+    try:
+        scale.send_command(encodeGetSettings())
+        assert _wait(lambda: len(scale.command_queue.latencies)>0)
+        packet,latency=scale.command_queue.latencies[-1]
+        assert packet==encodeGetSettings()
+        assert latency<0.1
+    finally:
+        scale.disconnect()
+
+
+def test_retries_then_timeout():
+    tracker=CommandTracker(timeout=0.0,retries=2)
+    command=tracker.add('tare',encodeTare())
+    for i in range(2):
+        tracker.sent(command)
+        assert tracker.expire()==[command]
+        assert not command.future.done()
+    tracker.sent(command)
+    assert tracker.expire()==[]
+    with pytest.raises(TimeoutError):
+        command.future.result(0)
+    assert tracker.pending==[]
+
+
+def test_acknowledged_by_the_button_echo():
+    tracker=CommandTracker()
+    command=tracker.add('tare',encodeTare())
+    tracker.sent(command,0.0)
+    msg=_message(_TARE_BUTTON)
+    tracker.acknowledge(msg,command.sent)
+    assert command.future.result(0) is msg
+    assert tracker.latency['tare'].count==1
+
+
+def test_not_acknowledged_before_the_write():
+    tracker=CommandTracker()
+    command=tracker.add('tare',encodeTare())
+    # Not written yet
+    tracker.acknowledge(_message(_TARE_BUTTON))
+    tracker.sent(command,0.0)
+    # Received before the write
+    tracker.acknowledge(_message(_TARE_BUTTON),command.sent-0.01)
+    assert not command.future.done()
+
+
+def test_tare_needs_a_weight_that_went_to_zero():
+    tracker=CommandTracker()
+    command=tracker.add('tare',encodeTare())
+    # An empty scale: zero before and after the write
+    tracker.sent(command,0.0)
+    tracker.acknowledge(_weight(0),command.sent)
+    assert not command.future.done()
+
+    command=tracker.add('tare',encodeTare())
+    tracker.sent(command,25.0)
+    # Measured before the tare was applied
+    tracker.acknowledge(_weight(250),command.sent)
+    assert not command.future.done()
+    tracker.acknowledge(_weight(0),command.sent)
+    assert command.future.result(0).value==0.0
+
+
+def test_start_needs_the_button_echo():
+    tracker=CommandTracker()
+    command=tracker.add('start',b'')
+    tracker.sent(command)
+    # A timer message of a timer that was already running
+    tracker.acknowledge(_message([7,0,5,3]),command.sent)
+    assert not command.future.done()
+    tracker.acknowledge(_message(_START_BUTTON),command.sent)
+    assert command.future.done()
+
+
+def test_cancel_all():
+    tracker=CommandTracker()
+    command=tracker.add('stop',b'')
+    tracker.cancel_all()
+    with pytest.raises(Exception):
+        command.future.result(0)
+
+
+def _pouring(**sim_options):
+    scale=AcaiaScale('00:00:00:00:00:01',backend='sim',
+                     sim_options=dict(rate=50,weight=20.0,flow=2.0,**sim_options))
+    scale.connect()
+    assert _wait(lambda: scale.analytics.n>=5)
+    return scale
+
+
+def test_acknowledged_tare_resets_the_flow():
+    scale=_pouring()
+    try:
+        msg=scale.tare().result(5)
+        assert msg.button=='tare'
+        # Reset by the I/O thread, the weights since then are kept
+        assert scale.analytics.n<5
+        assert scale.commands.latency['tare'].count==1
+    finally:
+        scale.disconnect()
+
+
+def test_failed_tare_keeps_the_flow():
+    scale=_pouring()
+    scale.commands.timeout=0.05
+    scale.commands.retries=0
+    simulated=scale.device.scale
+    command=simulated.command
+    # The scale misses the tare
+    simulated.command=lambda frame,now: [] if frame[2]==4 else command(frame,now)
+    try:
+        with pytest.raises(TimeoutError):
+            scale.tare().result(5)
+        assert scale.analytics.n>=5
+        assert scale.flow_rate==pytest.approx(2.0,abs=0.5)
+    finally:
+        scale.disconnect()
@@ -0,0 +1,127 @@
+import time
+
+import pytest
+
+from pyacaia import AcaiaScale
+from pyacaia.backends import BACKENDS, SimBackend
+
+
+class _FlakyBackend(SimBackend):
+    """Simulated scale whose steps fail the first times"""
+
+    failures = {}
+    calls = []
+
+    def _step(self,name):
+        _FlakyBackend.calls.append(name)
+        left=_FlakyBackend.failures.get(name,0)
+        if left:
+            _FlakyBackend.failures[name]=left-1
+            raise Exception(name+' failed')
+
+    def connect(self):
+        self._step('link')
+        return SimBackend.connect(self)
+
+    def discover(self):
+        self._step('discovery')
+        SimBackend.discover(self)
+
+    def subscribe(self):
+        self._step('subscribe')
+
+    def close(self):
+        _FlakyBackend.calls.append('close')
+        SimBackend.close(self)
+
+
+@pytest.fixture
+def flaky(monkeypatch):
+    monkeypatch.setitem(BACKENDS,'flaky',_FlakyBackend)
+    monkeypatch.setattr(_FlakyBackend,'failures',{})
+    monkeypatch.setattr(_FlakyBackend,'calls',[])
+    return _FlakyBackend
+
+
+def _scale(backend='sim',**sim_options):
+    return AcaiaScale('00:00:00:00:00:01',backend=backend,
+                      sim_options=dict(rate=20,**sim_options))
+
+
+def test_connect_timings():
+    scale=_scale()
+    scale.connect()
+    try:
+        assert scale.connected
+        assert list(scale.connect_timings)==['link','mtu','discovery','subscribe','ident',
+                                             'first_sample','total']
+        assert scale.connect_timings['total']>=scale.connect_timings['first_sample']
+        assert scale.stats()['connects']==1
+    finally:
+        scale.disconnect()
+    assert not scale.connected
+
+
+def test_backoff_between_link_attempts(flaky):
+    flaky.failures['link']=3
+    scale=_scale('flaky')
+    start=time.monotonic()
+    scale.connect(5)
+    try:
+        assert scale.connect_failures==3
+        assert flaky.calls[:6]==['link','close','link','close','link','close']
+        # 0.05 to 0.1 s, then 0.1 to 0.2 s, then 0.2 to 0.4 s
+        assert time.monotonic()-start>=0.35
+    finally:
+        scale.disconnect()
+
+
+@pytest.mark.parametrize('step',['discovery','subscribe'])
+def test_failed_discovery_or_subscription_closes_the_link(flaky,step):
+    flaky.failures[step]=1
+    scale=_scale('flaky')
+    scale.connect(5)
+    try:
+        assert scale.connect_failures==1
+        assert flaky.calls.index('close')==flaky.calls.index(step)+1
+        # Started over from the link
+        assert flaky.calls.count('link')==2
+    finally:
+        scale.disconnect()
+
+
+def test_gives_up_at_the_deadline(flaky):
+    flaky.failures['discovery']=1000
+    scale=_scale('flaky')
+    start=time.monotonic()
+    with pytest.raises(TimeoutError) as e:
+        scale.connect(0.5)
+    assert time.monotonic()-start<1.5
+    assert 'in 0.5 seconds, discovery failed' in str(e.value)
+    assert scale.connect_failures==flaky.calls.count('close')
+    assert flaky.calls[-1]=='close'
+    assert not scale.connected
+
+
+def test_readiness_timeout():
+    scale=_scale()
+    # The link is up but the scale never answers
+    scale.transport.subscribe=lambda: scale.device.__setattr__(
+        'writeCharacteristic',lambda *args: None)
+    start=time.monotonic()
+    with pytest.raises(TimeoutError) as e:
+        scale.connect(0.5)
+    assert 0.5<=time.monotonic()-start<1.5
+    assert 'no settings or weight received in 0.5 seconds' in str(e.value)
+    assert not scale.connected
+    assert scale.connect_failures==0
+
+
+def test_connect_async():
+    scale=_scale()
+    timings=scale.connect_async().result(5)
+    try:
+        assert timings is scale.connect_timings
+        assert scale.connected
+    finally:
+        scale.disconnect()
@@ -0,0 +1,151 @@
+import threading
+import time
+
+import pytest
+
+from pyacaia import AcaiaScale
+from pyacaia.dispatch import BLOCK, COALESCE_LATEST, DROP_OLDEST, Subscription
+
+
+def _wait(condition,timeout=5):
+    deadline=time.monotonic()+timeout
+    while not condition() and time.monotonic()<deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class _Handler(object):
+    """Holds the first item until release()"""
+
+    def __init__(self):
+        self.items=[]
+        self.started=threading.Event()
+        self.gate=threading.Event()
+
+    def __call__(self,item):
+        self.started.set()
+        self.gate.wait(5)
+        self.items.append(item)
+
+    def release(self):
+        self.gate.set()
+
+
+def _stuck(handler,**kwargs):
+    """Subscription whose handler is busy with item 0"""
+    subscription=Subscription('weight',handler,**kwargs)
+    subscription.put(0)
+    assert handler.started.wait(5)
+    return subscription
+
+
+def test_drop_oldest():
+    handler=_Handler()
+    subscription=_stuck(handler,maxlen=3,overflow=DROP_OLDEST)
+    for i in range(1,7):
+        subscription.put(i)
+    assert len(subscription)==3
+    assert subscription.dropped==3
+    time.sleep(0.02)
+    stats=subscription.stats()
+    assert stats['pending']==3
+    assert stats['lag']>=0.02
+    handler.release()
+    assert _wait(lambda: subscription.delivered==4)
+    assert handler.items==[0,4,5,6]
+    assert subscription.lag==0.0
+    assert subscription.max_lag>=0.02
+    subscription.close()
+
+
+def test_coalesce_latest():
+    handler=_Handler()
+    subscription=_stuck(handler,maxlen=3,overflow=COALESCE_LATEST)
+    for i in range(1,7):
+        subscription.put(i)
+    assert subscription.dropped==3
+    handler.release()
+    assert _wait(lambda: subscription.delivered==4)
+    assert handler.items==[0,1,2,6]
+    subscription.close()
+
+
+def test_block_waits_for_room():
+    handler=_Handler()
+    subscription=_stuck(handler,maxlen=2,overflow=BLOCK,block_timeout=5)
+    subscription.put(1)
+    subscription.put(2)
+    threading.Timer(0.1,handler.release).start()
+    start=time.monotonic()
+    subscription.put(3)
+    assert time.monotonic()-start>=0.09
+    assert subscription.dropped==0
+    subscription.close(wait=True)
+    assert handler.items==[0,1,2,3]
+
+
+def test_block_drops_after_the_timeout():
+    handler=_Handler()
+    subscription=_stuck(handler,maxlen=1,overflow=BLOCK,block_timeout=0.1)
+    subscription.put(1)
+    start=time.monotonic()
+    subscription.put(2)
+    assert time.monotonic()-start>=0.1
+    assert subscription.dropped==1
+    handler.release()
+    subscription.close(wait=True)
+    assert handler.items==[0,1]
+
+
+def test_failing_handler_is_counted():
+    def handler(item):
+        raise ValueError(item)
+    subscription=Subscription('weight',handler)
+    subscription.put(1)
+    subscription.put(2)
+    subscription.close(wait=True)
+    assert subscription.errors==2
+    assert subscription.delivered==2
+
+
+def test_close_discards_the_queue():
+    handler=_Handler()
+    subscription=_stuck(handler)
+    subscription.put(1)
+    subscription.close()
+    handler.release()
+    subscription.thread.join(5)
+    assert handler.items==[0]
+    subscription.put(2)
+    assert len(subscription)==0
+
+
+def test_unknown_overflow():
+    with pytest.raises(Exception):
+        Subscription('weight',print,overflow='ignore')
+
+
+def test_scale_subscriptions():
+    scale=AcaiaScale('00:00:00:00:00:01',backend='sim',
+                     sim_options={'rate':50,'weight':8.0})
+    weights=[]
+    buttons=[]
+    disconnects=[]
+    subscription=scale.on_weight(weights.append)
+    scale.on_button(buttons.append)
+    scale.on_disconnect(disconnects.append)
+    scale.connect()
+    try:
+        assert _wait(lambda: len(weights)>=3)
+        scale.tare().result(5)
+        assert _wait(lambda: buttons)
+        assert buttons[0].button=='tare'
+        assert weights[0].weight==8.0
+        assert weights[0].time<=weights[-1].time
+        kinds=[stats['kind'] for stats in scale.subscriptions()]
+        assert sorted(kinds)==['button','disconnect','weight']
+        subscription.close()
+        assert len(scale.subscriptions())==2
+    finally:
+        scale.disconnect()
+    assert _wait(lambda: len(disconnects)==1)
@@ -0,0 +1,102 @@
+import csv
+import threading
+import time
+
+from pyacaia import AcaiaScale, Message, encodeEventData
+from pyacaia import export
+from pyacaia.export import Exporter
+
+
+def _message(payload):
+    frame=encodeEventData(payload)
+    return Message(frame[4],frame[5:])
+
+_WEIGHT = _message([5,100,0,0,0,1,0])
+_START = _message([8,8,5,0,0,0,0,1,0])
+_STOP = _message([8,10,7,0,3,0,0,100,0,0,0,1,0])
+_RESET = _message([8,9,7,0,0,0,0,0,0,0,0,1,0])
+
+
+def _scale():
+    return AcaiaScale('00:00:00:00:00:01',backend='sim')
+
+
+def _rows(path):
+    with open(path) as f:
+        return list(csv.reader(f))[1:]
+
+
+def _feed(exporter,messages):
+    for msg in messages:
+        exporter(msg,time.monotonic())
+
+
+def test_all_rows_in_one_file(tmp_path):
+    exporter=Exporter(_scale(),str(tmp_path)).start()
+    _feed(exporter,[_WEIGHT,_START,_WEIGHT,_STOP,_WEIGHT])
+    exporter.close()
+    stats=exporter.stats()
+    assert stats['rows']==5
+    assert len(stats['files'])==1
+    rows=_rows(stats['files'][0])
+    assert [(row[3],row[4]) for row in rows]==[('0',''),('1','start'),('1',''),('1','stop'),
+                                               ('0','')]
+    assert float(rows[0][1])==10.0
+
+
+def test_one_file_per_shot(tmp_path):
+    exporter=Exporter(_scale(),str(tmp_path),shots=True).start()
+    _feed(exporter,[_WEIGHT,_START,_WEIGHT,_WEIGHT,_STOP,_WEIGHT,
+                    _START,_WEIGHT,_RESET,_WEIGHT])
+    exporter.close()
+    files=exporter.stats()['files']
+    assert len(files)==2
+    assert [row[4] for row in _rows(files[0])]==['start','','','stop']
+    assert [row[3] for row in _rows(files[1])]==['2','2','2']
+
+
+def test_rotation_on_size(tmp_path):
+    exporter=Exporter(_scale(),str(tmp_path),batch_size=10,max_bytes=200).start()
+    for i in range(5):
+        _feed(exporter,[_WEIGHT]*10)
+        # Let the writer see the size of the file before the next batch
+        exporter.flush()
+        while exporter.stats()['batches']<i+1:
+            time.sleep(0.001)
+    exporter.close()
+    stats=exporter.stats()
+    assert stats['rows']==50
+    assert len(stats['files'])>1
+    assert sum(len(_rows(path)) for path in stats['files'])==50
+
+
+def test_idle_batch_is_flushed(tmp_path):
+    exporter=Exporter(_scale(),str(tmp_path),flush_interval=0.05).start()
+    _feed(exporter,[_WEIGHT,_WEIGHT])
+    deadline=time.monotonic()+2
+    while exporter.stats()['rows']<2 and time.monotonic()<deadline:
+        time.sleep(0.01)
+    assert exporter.stats()['rows']==2
+    exporter.close()
+
+
+def test_stalled_writer_drops_batches(tmp_path,monkeypatch):
+    release=threading.Event()
+
+    class Stalled(export.CsvWriter):
+        def write(self,batch):
+            release.wait()
+            export.CsvWriter.write(self,batch)
+
+    monkeypatch.setitem(export.WRITERS,'csv',Stalled)
+    exporter=Exporter(_scale(),str(tmp_path),shots=True,batch_size=2,max_pending=2).start()
+    start=time.monotonic()
+    for i in range(10):
+        _feed(exporter,[_START,_WEIGHT,_WEIGHT,_STOP])
+    # The sink never waits for the writer
+    assert time.monotonic()-start<1.0
+    assert exporter.stats()['dropped_batches']>0
+    release.set()
+    exporter.close()
+    stats=exporter.stats()
+    assert stats['rows']+stats['dropped_rows']==40
@@ -0,0 +1,88 @@
+from pyacaia import Framer, checksum_ok, decode, encodeEventData
+
+
+def _weight(tenths):
+    return bytes(encodeEventData([5,tenths & 0xff,tenths>>8,0,0,1,0]))
+
+
+# Tare button event
+_TARE = bytes(encodeEventData([8,0,5,0,0,0,0,1,0]))
+
+
+def _frames(framer):
+    return [bytes(frame) for frame in framer]
+
+
+def test_frames_of_one_notification():
+    framer=Framer()
+    framer.feed(_weight(10)+_weight(20)+_TARE)
+    assert _frames(framer)==[_weight(10),_weight(20),_TARE]
+    assert framer.frames==3
+    assert framer.garbage==0
+    assert len(framer)==0
+
+
+def test_frame_split_across_notifications():
+    frame=_weight(123)
+    framer=Framer()
+    for i in range(len(frame)-1):
+        framer.feed(frame[i:i+1])
+        assert _frames(framer)==[]
+    framer.feed(frame[-1:])
+    assert _frames(framer)==[frame]
+
+
+def test_header_split_across_notifications():
+    frame=_weight(5)
+    framer=Framer()
+    framer.feed(b'\x01\x02'+frame[:1])
+    assert _frames(framer)==[]
+    framer.feed(frame[1:])
+    assert _frames(framer)==[frame]
+    assert framer.garbage==2
+
+
+def test_garbage_before_header():
+    framer=Framer()
+    framer.feed(b'\x00\x11\x22'+_weight(1))
+    assert _frames(framer)==[_weight(1)]
+    assert framer.garbage==3
+
+
+def test_buffer_grows():
+    framer=Framer(size=8)
+    data=b''.join(_weight(i) for i in range(50))
+    framer.feed(data)
+    assert len(_frames(framer))==50
+
+
+def test_checksum():
+    frame=bytearray(_weight(42))
+    assert checksum_ok(frame)
+    frame[6]^=0x10
+    assert not checksum_ok(frame)
+
+
+def test_decode_compatibility_wrapper():
+    data=b'\x00'+_weight(7)+_weight(8)[:4]
+    msg,rest=decode(data)
+    assert msg.value==0.7
+    assert bytes(rest)==_weight(8)[:4]
+    assert decode(b'\xef')==(None,b'\xef')
+
+
+def test_reject_resyncs_after_a_corrupted_length():
+    bad=bytearray(_weight(1))
+    # The length now swallows the next frame
+    bad[3]+=len(_weight(2))
+    framer=Framer()
+    framer.feed(bytes(bad)+_weight(2)+_weight(3))
+    frames=[]
+    for frame in framer:
+        if not checksum_ok(frame):
+            framer.reject()
+            continue
+        frames.append(bytes(frame))
+    assert frames==[_weight(2),_weight(3)]
+    assert framer.frames==2
+    assert framer.garbage==len(bad)
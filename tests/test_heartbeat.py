@@ -0,0 +1,61 @@
+import time
+
+from pyacaia import AcaiaScale, HeartbeatPolicy
+
+
+def test_heartbeat_postponed_by_notifications():
+    policy=HeartbeatPolicy(interval=1.0,max_silence=5.0)
+    policy.reset(0.0)
+    assert not policy.heartbeat_due(0.5)
+    assert policy.heartbeat_due(1.0)
+    # Notifications postpone it, but not beyond max_silence
+    policy.last_receive=4.5
+    assert not policy.heartbeat_due(4.9)
+    assert policy.heartbeat_due(5.0)
+    assert policy.next_deadline()==5.0
+
+
+def test_writes_postpone_the_heartbeat():
+    policy=HeartbeatPolicy(interval=1.0)
+    policy.reset(0.0)
+    policy.last_write=0.8
+    assert not policy.heartbeat_due(1.5)
+    assert policy.next_deadline()==1.8
+
+
+def test_intervals_of_the_models():
+    classic=HeartbeatPolicy.for_model('classic')
+    assert (classic.interval,classic.ident_interval)==(1.0,None)
+    pyxis=HeartbeatPolicy.for_model('pyxis')
+    assert (pyxis.interval,pyxis.ident_interval)==(5.0,30.0)
+    assert HeartbeatPolicy.for_model('pyxis',interval=2.0).interval==2.0
+
+
+def test_ident_refresh():
+    policy=HeartbeatPolicy(interval=5.0,ident_interval=30.0)
+    policy.reset(0.0)
+    assert policy.next_deadline()==5.0
+    policy.last_write=policy.last_receive=29.0
+    assert policy.next_deadline()==30.0
+    assert policy.ident_due(30.0)
+    # Settings sent by the scale answer the ident
+    policy.last_ident=29.5
+    assert not policy.ident_due(30.0)
+
+
+def _heartbeats(sim_options,seconds=1.0):
+    scale=AcaiaScale('00:00:00:00:00:01',backend='sim',sim_options=sim_options,
+                     heartbeat_options={'interval':0.1,'max_silence':0.4})
+    scale.connect()
+    try:
+        writes=scale.io_stats()['writes'].get('heartbeat',0)
+        time.sleep(seconds)
+        return scale.io_stats()['writes'].get('heartbeat',0)-writes
+    finally:
+        scale.disconnect()
+
+
+def test_weight_stream_cuts_the_heartbeats():
+    # Every max_silence while weights come in, every interval otherwise
+    assert 1<=_heartbeats({'rate':50})<=4
+    assert 7<=_heartbeats({'rate':0.5})<=11
@@ -0,0 +1,75 @@
+import time
+
+from pyacaia import AcaiaHub, AcaiaScale
+
+
+def _wait(condition,timeout=5):
+    deadline=time.monotonic()+timeout
+    while not condition() and time.monotonic()<deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_one_thread_for_several_scales():
+    hub=AcaiaHub()
+    hub.start()
+    scales=[hub.attach(AcaiaScale('00:00:00:00:00:%02x' % i,backend='sim',
+                                  sim_options={'rate':20,'weight':float(i)}))
+            for i in range(8)]
+    try:
+        for scale in scales:
+            scale.connect()
+        # No I/O thread per scale
+        assert all(scale.set_interval_thread is None for scale in scales)
+        assert _wait(lambda: all(len(scale.series)>=3 for scale in scales))
+        assert [scale.weight for scale in scales]==[float(i) for i in range(8)]
+        stats=hub.stats()
+        assert stats['scales']==8
+        assert stats['connected']==8
+        assert stats['weight_samples']>=24
+        state=hub.state()
+        assert [s['mac'] for s in state]==[scale.mac for scale in scales]
+    finally:
+        for scale in scales:
+            scale.disconnect()
+        hub.stop()
+        hub.join(5)
+    assert hub.stats()['connected']==0
+
+
+def test_commands_through_the_hub():
+    hub=AcaiaHub()
+    hub.start()
+    scales=[hub.attach(AcaiaScale('00:00:00:00:00:%02x' % i,backend='sim',
+                                  sim_options={'rate':20,'weight':10.0}))
+            for i in range(3)]
+    try:
+        for scale in scales:
+            scale.connect()
+        futures=[scale.tare() for scale in scales]
+        assert [future.result(5).button for future in futures]==['tare']*3
+        assert _wait(lambda: all(scale.weight==0.0 for scale in scales))
+    finally:
+        for scale in scales:
+            scale.disconnect()
+        hub.stop()
+        hub.join(5)
+
+
+def test_disconnected_scale_leaves_the_others_running():
+    hub=AcaiaHub()
+    hub.start()
+    scales=[hub.attach(AcaiaScale('00:00:00:00:00:%02x' % i,backend='sim',
+                                  sim_options={'rate':50}))
+            for i in range(2)]
+    try:
+        for scale in scales:
+            scale.connect()
+        scales[0].disconnect()
+        count=len(scales[1].series)
+        assert _wait(lambda: len(scales[1].series)>count+3)
+        assert scales[1].connected
+    finally:
+        scales[1].disconnect()
+        hub.stop()
+        hub.join(5)
@@ -0,0 +1,121 @@
+import time
+import urllib.request
+
+import pytest
+
+from pyacaia import AcaiaScale, encodeEventData
+from pyacaia.metrics import prometheus_text, serve_prometheus
+
+_MAC = '00:1C:97:17:FD:97'
+
+
+def _weight(tenths):
+    return bytes(encodeEventData([5,tenths & 0xff,tenths>>8,0,0,1,0]))
+
+
+def _scale():
+    scale=AcaiaScale(_MAC,backend='sim')
+    corrupted=bytearray(_weight(3))
+    corrupted[6]^=0x10
+    # Two notifications, as the I/O thread would hand them over
+    scale.callback_queue(b'\x00\x00'+_weight(1)+_weight(2))
+    scale.callback_queue(bytes(corrupted)+_weight(4))
+    return scale
+
+
+def _samples(text):
+    """{name{labels}: value} of the sample lines"""
+    return dict(line.rsplit(' ',1) for line in text.splitlines()
+                if line and not line.startswith('#'))
+
+
+def test_counters():
+    stats=_scale().stats()
+    assert stats['notifications']==2
+    assert stats['frames']==3
+    # The bytes of the rejected frame are skipped too
+    assert stats['garbage_bytes']==2+len(_weight(3))
+    assert stats['checksum_failures']==1
+    assert stats['weights']==3
+
+
+def test_prometheus_text():
+    text=prometheus_text([_scale()])
+    assert '# TYPE pyacaia_notifications_total counter' in text
+    assert '# HELP pyacaia_checksum_failures_total Frames dropped for a wrong checksum' in text
+    samples=_samples(text)
+    labels='{mac="%s"}' % _MAC
+    assert float(samples['pyacaia_notifications_total'+labels])==2.0
+    assert float(samples['pyacaia_checksum_failures_total'+labels])==1.0
+    assert float(samples['pyacaia_garbage_bytes_total'+labels])==2+len(_weight(3))
+    assert float(samples['pyacaia_decode_errors_total'+labels])==0.0
+    # Cumulative buckets
+    buckets=[(name,int(value)) for name,value in samples.items()
+             if name.startswith('pyacaia_write_stall_seconds_bucket')]
+    counts=[count for name,count in buckets]
+    assert counts==sorted(counts)
+    assert buckets[-1][0]=='pyacaia_write_stall_seconds_bucket{mac="%s",le="+Inf"}' % _MAC
+    assert int(samples['pyacaia_write_stall_seconds_count'+labels])==counts[-1]
+    assert text.endswith('\n')
+
+
+def test_prometheus_text_of_the_stages():
+    scale=AcaiaScale(_MAC,backend='sim')
+    laps=[]
+    scale.enable_metrics(hooks=[lambda stage,seconds: laps.append(stage)])
+    scale.callback_queue(_weight(1)+_weight(2))
+    assert laps==['feed','decode','update','sinks','decode','update','sinks']
+    samples=_samples(prometheus_text([scale],prefix='scale_'))
+    assert int(samples['scale_stage_seconds_count{mac="%s",stage="decode"}' % _MAC])==2
+    assert int(samples['scale_stage_seconds_count{mac="%s",stage="feed"}' % _MAC])==1
+    scale.disable_metrics()
+    assert 'stages' not in scale.stats()
+
+
+def test_label_values_are_escaped():
+    scale=AcaiaScale('a"b\\c',backend='sim')
+    assert 'pyacaia_connects_total{mac="a\\"b\\\\c"} 0.0' in prometheus_text([scale])
+
+
+def test_rates_since_each_callers_mark():
+    scale=_scale()
+    marks={}
+    prometheus_text([scale],marks=marks)
+    assert marks[_MAC][1:]==(2,scale.bytes_received)
+    scale.callback_queue(_weight(5))
+    stats=scale.stats(marks[_MAC])
+    assert stats['notifications_per_s']>0
+    # Other callers keep their own marks
+    assert scale.stats(stats['mark'])['notifications_per_s']==0.0
+    assert prometheus_text([scale],marks={})
+
+
+def test_serve_prometheus():
+    scale=_scale()
+    server=serve_prometheus([scale],port=0,address='127.0.0.1')
+    try:
+        url='http://127.0.0.1:%d/metrics' % server.server_address[1]
+        with urllib.request.urlopen(url,timeout=5) as response:
+            assert response.status==200
+            assert response.headers['Content-Type'].startswith('text/plain')
+            body=response.read().decode()
+        assert 'pyacaia_notifications_total{mac="%s"} 2.0' % _MAC in body
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_corrupted_notifications_are_dropped():
+    scale=AcaiaScale('00:00:00:00:00:01',backend='sim',
+                     sim_options={'rate':50,'weight':10.0,'bitflip':0.05,'seed':1})
+    scale.connect()
+    try:
+        deadline=time.monotonic()+5
+        while scale.stats()['checksum_failures']==0 and time.monotonic()<deadline:
+            time.sleep(0.01)
+        assert scale.stats()['checksum_failures']>0
+        assert scale.connected
+        # Corrupted frames never show as a weight
+        assert scale.weight==pytest.approx(10.0,abs=0.1)
+    finally:
+        scale.disconnect()
@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+from pyacaia import AcaiaScale, encodeEventData, encodeNotificationRequest
+from pyacaia.analytics import RateMeter
+
+
+def _wait(condition,timeout=5):
+    deadline=time.monotonic()+timeout
+    while not condition() and time.monotonic()<deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_notification_request():
+    assert encodeNotificationRequest()==bytes(encodeEventData([0,1,1,2,2,5,3,4]))
+    request=encodeNotificationRequest(weight=4,timer=None)
+    assert request==bytes(encodeEventData([0,4,1,2,3,4]))
+    assert encodeNotificationRequest(weight=4,timer=None) is request
+
+
+def test_rate_meter():
+    meter=RateMeter()
+    for i in range(20):
+        meter.add(i*0.1)
+    assert meter.rate(1.9)==pytest.approx(10.0)
+    assert meter.rate(10.0)==0.0
+    assert meter.count==20
+
+
+def test_max_rate_decimates_before_decoding():
+    scale=AcaiaScale('00:00:00:00:00:01',backend='sim',sim_options={'rate':50},max_rate=10)
+    scale.connect()
+    try:
+        weights=scale.weight_meter.count
+        samples=scale.sample_meter.count
+        time.sleep(1.0)
+        stats=scale.stats()
+        assert scale.weight_meter.count-weights==pytest.approx(50,abs=8)
+        assert scale.sample_meter.count-samples==pytest.approx(10,abs=2)
+        assert stats['decimated']>0
+    finally:
+        scale.disconnect()
+    # The weights dropped never reach the series
+    assert scale.weight_meter.count==scale.decimated+len(scale.series)
+
+
+def test_set_notifications():
+    scale=AcaiaScale('00:00:00:00:00:01',backend='sim',sim_options={'rate':50},
+                     notifications={'weight':2})
+    scale.connect()
+    try:
+        simulated=scale.device.scale
+        assert simulated.weight_interval==2
+        scale.set_notifications(weight=5,timer=None)
+        assert _wait(lambda: simulated.weight_interval==5)
+        assert simulated.timer_interval is None
+        count=scale.weight_meter.count
+        time.sleep(1.0)
+        assert scale.weight_meter.count-count==pytest.approx(10,abs=3)
+    finally:
+        scale.disconnect()
+    assert scale.notifications=={'weight':5,'timer':None}
+    # Sent again when connecting
+    scale.connect()
+    try:
+        assert scale.device.scale.weight_interval==5
+    finally:
+        scale.disconnect()
@@ -0,0 +1,112 @@
+import json
+import sys
+import types
+
+import pytest
+
+import pyacaia
+from pyacaia import AcaiaScale, ProfileCache
+from pyacaia.backends import OLD_STYLE_CHAR
+from pyacaia.sim import CHAR_HANDLE, NOTIFY_HANDLE, SimPeripheral
+
+_MAC = '00:1C:97:17:FD:97'
+
+
+class _Characteristic(object):
+
+    uuid = OLD_STYLE_CHAR
+    valHandle = CHAR_HANDLE
+
+
+class _Peripheral(SimPeripheral):
+    """Simulated old-style scale with the bluepy discovery calls"""
+
+    discoveries = 0
+
+    def getCharacteristics(self,uuid=None):
+        _Peripheral.discoveries+=1
+        return [_Characteristic()]
+
+    def writeCharacteristic(self,handle,data,withResponse=False):
+        if withResponse and handle not in (CHAR_HANDLE,NOTIFY_HANDLE):
+            raise Exception('Invalid handle')
+        SimPeripheral.writeCharacteristic(self,handle,data,withResponse)
+
+
+@pytest.fixture
+def bluepy(monkeypatch):
+    """bluepy stand-in whose peripherals are simulated scales"""
+    btle=types.ModuleType('bluepy.btle')
+    btle.ADDR_TYPE_PUBLIC='public'
+    btle.UUID=str
+    btle.Peripheral=lambda mac,addrType=None: _Peripheral(rate=20)
+    module=types.ModuleType('bluepy')
+    module.btle=btle
+    monkeypatch.setitem(sys.modules,'bluepy',module)
+    monkeypatch.setitem(sys.modules,'bluepy.btle',btle)
+    monkeypatch.setattr(pyacaia,'_CACHED_PROFILE_WAIT',0.2)
+    _Peripheral.discoveries=0
+    return btle
+
+
+def _connect(cache):
+    scale=AcaiaScale(_MAC,profile_cache=cache)
+    scale.connect(5)
+    scale.disconnect()
+    return scale
+
+
+def test_reconnect_uses_the_cache(bluepy,tmp_path):
+    path=str(tmp_path/'profiles.json')
+    scale=_connect(ProfileCache(path))
+    assert not scale.transport.cached
+    assert _Peripheral.discoveries==1
+    with open(path) as f:
+        profile=json.load(f)[_MAC]
+    assert (profile['char_handle'],profile['notify_handle'])==(CHAR_HANDLE,NOTIFY_HANDLE)
+
+    scale=_connect(ProfileCache(path))
+    assert scale.transport.cached
+    assert scale.profile_time_saved is not None
+    assert _Peripheral.discoveries==1
+
+
+def _stale(path,**handles):
+    profile={'isPyxisStyle': False,'char_uuid': OLD_STYLE_CHAR,'weight_uuid': None,
+             'char_handle': CHAR_HANDLE,'notify_handle': NOTIFY_HANDLE,'discovery_time': 0.5}
+    profile.update(handles)
+    with open(path,'w') as f:
+        json.dump({_MAC: profile},f)
+    return ProfileCache(path)
+
+
+def test_wrong_command_handle_is_discovered_again(bluepy,tmp_path):
+    path=str(tmp_path/'profiles.json')
+    # Still writable, but the scale never sees the commands
+    scale=_connect(_stale(path,char_handle=NOTIFY_HANDLE))
+    assert _Peripheral.discoveries==1
+    assert scale.connect_failures==0
+    with open(path) as f:
+        assert json.load(f)[_MAC]['char_handle']==CHAR_HANDLE
+    # The next connect uses the corrected profile
+    scale=_connect(ProfileCache(path))
+    assert scale.transport.cached
+    assert _Peripheral.discoveries==1
+
+
+def test_failing_notify_handle_is_discovered_again(bluepy,tmp_path):
+    path=str(tmp_path/'profiles.json')
+    scale=_connect(_stale(path,notify_handle=99))
+    assert _Peripheral.discoveries==1
+    with open(path) as f:
+        assert json.load(f)[_MAC]['notify_handle']==NOTIFY_HANDLE
+
+
+def test_no_answer_without_a_cache_times_out(bluepy,monkeypatch):
+    # The scale ignores every command
+    monkeypatch.setattr(_Peripheral,'writeCharacteristic',lambda *args: None)
+    scale=AcaiaScale(_MAC,profile_cache=ProfileCache())
+    with pytest.raises(TimeoutError):
+        scale.connect(0.5)
+    assert _Peripheral.discoveries==1
+    assert not scale.connected
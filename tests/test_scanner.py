@@ -0,0 +1,125 @@
+import time
+
+import pytest
+
+import pyacaia
+from pyacaia import AcaiaScale, AcaiaScanner, find_acaia_devices, get_scanner
+from pyacaia.backends import BACKENDS, Backend, SimBackend
+
+
+class _SlowBackend(Backend):
+    """Finds a scale 0.05 s into each scan, and other devices"""
+
+    scans = 0
+
+    def scan(self,deadline,found,done):
+        _SlowBackend.scans+=1
+        start=time.monotonic()
+        while time.monotonic()<deadline:
+            found('Phone','11:11:11:11:11:11',-30)
+            if time.monotonic()-start>=0.05:
+                found('ACAIA LUNAR','00:1C:97:00:00:01',-60)
+                found('PROCHBT001','00:1C:97:00:00:02',-50)
+            if done():
+                break
+            time.sleep(0.01)
+
+
+@pytest.fixture
+def slow(monkeypatch):
+    monkeypatch.setitem(BACKENDS,'slow',_SlowBackend)
+    _SlowBackend.scans=0
+
+
+@pytest.fixture
+def sim_scans(monkeypatch):
+    """Scans of the sim backend"""
+    monkeypatch.setattr(pyacaia,'_scanners',{})
+    scans=[]
+    scan=SimBackend.scan
+    def counted(self,deadline,found,done):
+        scans.append(time.monotonic())
+        scan(self,deadline,found,done)
+    monkeypatch.setattr(SimBackend,'scan',counted)
+    return scans
+
+
+def test_first_returns_as_soon_as_a_scale_is_seen(slow):
+    scanner=AcaiaScanner('slow')
+    start=time.monotonic()
+    devices=scanner.scan(timeout=3,first=True)
+    assert time.monotonic()-start<1
+    assert devices[0].name.startswith('ACAIA') or devices[0].name.startswith('PROCH')
+    assert 'Phone' not in [d.name for d in devices]
+    assert scanner.time_to_first_device.count==1
+
+
+def test_full_scan_sorted_by_signal(slow):
+    scanner=AcaiaScanner('slow')
+    start=time.monotonic()
+    devices=scanner.scan(timeout=0.3,first=False)
+    assert time.monotonic()-start>=0.3
+    assert [d.address for d in devices]==['00:1C:97:00:00:02','00:1C:97:00:00:01']
+
+
+def test_scales_seen_within_the_ttl_need_no_scan(slow):
+    scanner=AcaiaScanner('slow',ttl=0.5)
+    scanner.scan(first=True)
+    assert _SlowBackend.scans==1
+    start=time.monotonic()
+    assert len(scanner.scan(first=True))==2
+    assert time.monotonic()-start<0.05
+    assert _SlowBackend.scans==1
+    # max_age=0 scans afresh
+    scanner.scan(first=True,max_age=0)
+    assert _SlowBackend.scans==2
+    time.sleep(0.6)
+    assert scanner.seen()==[]
+    scanner.scan(first=True)
+    assert _SlowBackend.scans==3
+
+
+def test_background_scanning(slow):
+    scanner=AcaiaScanner('slow')
+    scanner.start()
+    try:
+        devices=scanner.scan(timeout=3,first=True)
+        assert devices
+        scans=_SlowBackend.scans
+        # The background thread scans, scan() only waits for it
+        assert len(scanner.scan(timeout=3,first=True))>=1
+        assert _SlowBackend.scans<=scans+1
+    finally:
+        scanner.stop()
+    assert scanner.thread is None
+
+
+def test_find_acaia_devices_scans_afresh(sim_scans):
+    assert find_acaia_devices(backend='sim',first=True)==['00:00:00:00:00:00']
+    assert find_acaia_devices(backend='sim',first=True)==['00:00:00:00:00:00']
+    assert len(sim_scans)==2
+    assert find_acaia_devices(backend='sim',first=True,max_age=30)==['00:00:00:00:00:00']
+    assert len(sim_scans)==2
+
+
+def test_auto_connect_within_the_ttl_does_not_scan_again(sim_scans):
+    scale=AcaiaScale(None,backend='sim')
+    scale.auto_connect()
+    assert scale.connected
+    assert scale.mac=='00:00:00:00:00:00'
+    scale.disconnect()
+    assert len(sim_scans)==1
+    scale=AcaiaScale(None,backend='sim')
+    scale.auto_connect()
+    assert scale.connected
+    scale.disconnect()
+    assert len(sim_scans)==1
+    assert get_scanner('sim','hci0').ttl>0
+
+
+def test_auto_connect_uses_the_scanner_of_its_adapter(sim_scans):
+    scale=AcaiaScale(None,backend='sim',iface='hci1')
+    scale.auto_connect()
+    scale.disconnect()
+    assert ('sim','hci1') in pyacaia._scanners
+    assert ('sim','hci0') not in pyacaia._scanners
@@ -0,0 +1,54 @@
+import time
+
+from pyacaia import FakeClock, Scheduler
+
+
+def test_scheduler_on_a_fake_clock():
+    clock=FakeClock(10.0)
+    calls=[]
+    def func():
+        calls.append(clock.monotonic())
+        return len(calls)<5
+    scheduler=Scheduler(func,0.5,clock=clock)
+    # Run in this thread, the FakeClock only moves when it waits
+    scheduler.run()
+    assert calls==[10.5,11.0,11.5,12.0,12.5]
+    assert scheduler.jitter.max==0.0
+
+
+def test_slow_calls_do_not_catch_up():
+    clock=FakeClock(0.0)
+    calls=[]
+    def func():
+        calls.append(clock.monotonic())
+        if len(calls)==2:
+            # Takes two and a half intervals
+            clock.now+=2.5
+        return len(calls)<4
+    scheduler=Scheduler(func,1.0,clock=clock)
+    scheduler.run()
+    assert calls==[1.0,2.0,4.5,5.5]
+    # The late call, planned at 3.0
+    assert scheduler.jitter.max==1.5
+
+
+def test_zero_interval_runs_until_func_fails():
+    calls=[]
+    def func():
+        calls.append(None)
+        return len(calls)<3
+    scheduler=Scheduler(func,0)
+    scheduler.run()
+    assert scheduler.calls==3
+
+
+def test_stop_wakes_the_thread_up():
+    scheduler=Scheduler(lambda: True,60)
+    scheduler.start()
+    assert scheduler.keep_going
+    start=time.monotonic()
+    scheduler.stop()
+    scheduler.join(5)
+    assert not scheduler.is_alive()
+    assert time.monotonic()-start<1
+    assert scheduler.calls==0
@@ -0,0 +1,59 @@
+import time
+
+from pyacaia import AcaiaScale, WeightSeries
+
+
+def _fill(series,n):
+    for i in range(n):
+        series.append(float(i),i*0.5,i*0.1)
+
+
+def test_last_before_wraparound():
+    series=WeightSeries(8)
+    _fill(series,5)
+    times,weights,timers=series.last()
+    assert list(times)==[0.0,1.0,2.0,3.0,4.0]
+    assert list(weights)==[0.0,0.5,1.0,1.5,2.0]
+    assert len(series)==5
+    assert list(series.last(2)[0])==[3.0,4.0]
+
+
+def test_last_after_wraparound():
+    series=WeightSeries(8)
+    _fill(series,21)
+    assert len(series)==8
+    times,weights,timers=series.last()
+    assert list(times)==[float(i) for i in range(13,21)]
+    assert list(series.last(100)[0])==list(times)
+    assert list(series.last(3,copy=False)[0])==[18.0,19.0,20.0]
+
+
+def test_since():
+    series=WeightSeries(8)
+    _fill(series,21)
+    assert list(series.since(17.5)[0])==[18.0,19.0,20.0]
+    assert list(series.since(0.0)[0])==[float(i) for i in range(13,21)]
+    assert list(series.since(30.0)[0])==[]
+
+
+def test_clear():
+    series=WeightSeries(4)
+    _fill(series,3)
+    series.clear()
+    assert len(series)==0
+    assert list(series.last()[0])==[]
+
+
+def test_connected_scale_fills_the_series():
+    scale=AcaiaScale('00:00:00:00:00:01',backend='sim',sim_options={'rate':50,'weight':12.3})
+    scale.connect()
+    try:
+        deadline=time.monotonic()+5
+        while len(scale.series)<5 and time.monotonic()<deadline:
+            time.sleep(0.01)
+        times,weights,timers=scale.series.last()
+        assert len(times)>=5
+        assert list(times)==sorted(times)
+        assert set(weights)=={12.3}
+    finally:
+        scale.disconnect()
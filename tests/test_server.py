@@ -0,0 +1,159 @@
+import asyncio
+import json
+import struct
+
+from pyacaia import AcaiaScale
+from pyacaia.server import (EVENT, WEIGHTS, ScaleServer, _Client, _HEADER, _SAMPLE,
+                            encode_batch, websocket_frame)
+
+
+def _masked(payload,opcode=1,mask=b'\x01\x02\x03\x04',length=None):
+    n=len(payload) if length is None else length
+    if n<126:
+        header=struct.pack('!BB',0x80|opcode,0x80|n)
+    elif n<1<<16:
+        header=struct.pack('!BBH',0x80|opcode,0x80|126,n)
+    else:
+        header=struct.pack('!BBQ',0x80|opcode,0x80|127,n)
+    return header+mask+bytes(b ^ mask[i & 3] for i,b in enumerate(payload))
+
+
+class _Writer(object):
+
+    def __init__(self):
+        self.data=b''
+
+    def write(self,data):
+        self.data+=data
+
+    def get_extra_info(self,name):
+        return ('test',0)
+
+
+def _read(server,data):
+    """Messages read by the server from data, and what it wrote back"""
+    async def run():
+        reader=asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        client=_Client(server,reader,_Writer(),True)
+        messages=[]
+        while True:
+            try:
+                message=await server._read_frame(client)
+            except asyncio.IncompleteReadError:
+                break
+            if not message:
+                break
+            messages.append(message)
+        return messages,client.writer.data
+    return asyncio.run(run())
+
+
+def _server(**kwargs):
+    return ScaleServer(AcaiaScale('00:00:00:00:00:01',backend='sim'),**kwargs)
+
+
+def test_websocket_frame_lengths():
+    assert websocket_frame(b'ab',1)==b'\x81\x02ab'
+    frame=websocket_frame(b'x'*300,2)
+    assert frame[:4]==b'\x82\x7e\x01\x2c'
+    frame=websocket_frame(b'x'*70000,2)
+    assert frame[:2]==b'\x82\x7f'
+    assert struct.unpack('!Q',frame[2:10])[0]==70000
+
+
+def test_encode_batch_json():
+    data=encode_batch([(1.0,2.5,0.1),(1.1,2.6,0.2),{'type':'button','button':'tare'}],'json')
+    lines=[json.loads(line) for line in data.splitlines()]
+    assert lines[0]=={'type':'weight','samples':[[1.0,2.5,0.1],[1.1,2.6,0.2]]}
+    assert lines[1]=={'type':'button','button':'tare'}
+
+
+def test_encode_batch_binary():
+    data=encode_batch([(1.0,2.5,0.5),{'type':'button'}],'binary')
+    kind,count=_HEADER.unpack_from(data)
+    assert (kind,count)==(WEIGHTS,1)
+    assert _SAMPLE.unpack_from(data,_HEADER.size)==(1.0,2.5,0.5)
+    offset=_HEADER.size+_SAMPLE.size
+    kind,length=_HEADER.unpack_from(data,offset)
+    assert kind==EVENT
+    assert json.loads(data[offset+_HEADER.size:offset+_HEADER.size+length])=={'type':'button'}
+
+
+def test_read_masked_frames():
+    server=_server()
+    messages,written=_read(server,_masked(b'{"cmd":"tare"}')+_masked(b'ping',opcode=9)
+                           +_masked(b'x'*200,opcode=2))
+    assert messages==[b'{"cmd":"tare"}',b'x'*200]
+    # The ping is answered with a pong
+    assert written==websocket_frame(b'ping',10)
+
+
+def test_unmasked_frame_closes():
+    server=_server()
+    messages,written=_read(server,b'\x81\x02hi')
+    assert messages==[]
+    assert written==websocket_frame(struct.pack('!H',1002),8)
+
+
+def test_oversized_frame_closes_before_reading_it():
+    server=_server()
+    messages,written=_read(server,_masked(b'',length=1<<40))
+    assert messages==[]
+    assert written==websocket_frame(struct.pack('!H',1009),8)
+
+
+def test_close_frame():
+    server=_server()
+    messages,written=_read(server,_masked(b'',opcode=8)+_masked(b'late'))
+    assert messages==[]
+    assert written==websocket_frame(b'',8)
+
+
+def test_auth_with_a_non_ascii_token():
+    server=_server(token='sécret')
+    async def run():
+        client=_Client(server,None,_Writer(),False)
+        await server._message(client,json.dumps({'auth':'sécret'}).encode())
+        good=client.authenticated
+        await server._message(client,b'{"auth":"secret"}')
+        return good,client.authenticated
+    assert asyncio.run(run())==(True,False)
+
+
+def test_auth_without_a_token():
+    async def run(allow_commands):
+        server=_server(allow_commands=allow_commands)
+        client=_Client(server,None,_Writer(),False)
+        server.clients.append(client)
+        await server._message(client,b'{"auth":"anything","cmd":"nope","id":1}')
+        return client.authenticated,json.loads(client.writer.data)
+    # Commands are open to everyone, the auth changes nothing
+    authenticated,result=asyncio.run(run(True))
+    assert authenticated
+    assert result['error']=='unknown command'
+    authenticated,result=asyncio.run(run(False))
+    assert not authenticated
+    assert result['error']=='not authenticated'
+
+
+def test_tcp_client_gets_hello_and_weights():
+    scale=AcaiaScale('00:00:00:00:00:01',backend='sim',sim_options={'rate':20})
+    scale.connect()
+    server=ScaleServer(scale,port=0,batch_interval=0.01).start()
+    try:
+        async def run():
+            reader,writer=await asyncio.open_connection('127.0.0.1',server.port)
+            hello=json.loads(await reader.readline())
+            kinds=set()
+            while 'weight' not in kinds:
+                kinds.add(json.loads(await asyncio.wait_for(reader.readline(),5))['type'])
+            writer.close()
+            return hello
+        hello=asyncio.run(run())
+        assert hello['type']=='hello'
+        assert hello['mac']==scale.mac
+    finally:
+        server.stop()
+        scale.disconnect()
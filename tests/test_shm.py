@@ -0,0 +1,91 @@
+import time
+
+import pytest
+
+from pyacaia import AcaiaScale
+from pyacaia.shm import StatePublisher, StateReader
+
+
+def _wait(condition,timeout=5):
+    deadline=time.monotonic()+timeout
+    while not condition() and time.monotonic()<deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def _scale(mac,rate=100):
+    scale=AcaiaScale(mac,backend='sim',sim_options=dict(rate=rate,weight=7.5))
+    scale.connect()
+    return scale
+
+
+def test_read_a_live_publisher():
+    scale=_scale('00:00:00:00:21:01')
+    publisher=scale.publish_state(window=16)
+    reader=StateReader(scale.mac)
+    try:
+        assert reader.capacity==16
+        assert _wait(lambda: reader.read().samples>=40)
+        state=reader.read()
+        assert state.weight==7.5
+        assert state.units=='grams'
+        assert state.battery==scale.battery
+        assert state.connected
+        assert not state.timer_running
+        assert state.time<=time.monotonic()
+        # The window wrapped around
+        times,weights,timers=reader.last()
+        assert len(times)==16
+        assert list(times)==sorted(times)
+        assert set(weights)=={7.5}
+    finally:
+        scale.stop_publishing()
+        scale.disconnect()
+    # Readers keep their mapping once the segment is removed
+    assert reader.read().samples>=40
+    reader.close()
+    assert publisher.buf is None
+
+
+def test_last_matches_the_series():
+    scale=AcaiaScale('00:00:00:00:21:02',backend='sim')
+    publisher=scale.publish_state(window=8)
+    reader=StateReader(scale.mac)
+    try:
+        for i in range(20):
+            scale.weight=float(i)
+            publisher.update(float(i),float(i))
+        times,weights,timers=reader.last(5)
+        assert list(weights)==[15.0,16.0,17.0,18.0,19.0]
+        views=reader.last(5,copy=False)
+        assert list(views[0])==[15.0,16.0,17.0,18.0,19.0]
+        for view in views:
+            view.release()
+        state=reader.read()
+        assert (state.samples,state.weight,state.connected)==(20,19.0,False)
+    finally:
+        reader.close()
+        scale.stop_publishing()
+
+
+def test_stop_publishing_while_notifications_come_in():
+    scale=_scale('00:00:00:00:21:03',rate=1000)
+    try:
+        for i in range(50):
+            scale.publish_state(window=64)
+            time.sleep(0.002)
+            scale.stop_publishing()
+        assert scale.connected
+        assert scale.stats()['decode_errors']==0
+    finally:
+        scale.disconnect()
+
+
+def test_update_after_close_does_nothing():
+    scale=AcaiaScale('00:00:00:00:21:04',backend='sim')
+    publisher=StatePublisher(scale,window=4)
+    publisher.close()
+    publisher.update(1.0,2.0)
+    publisher.close()
+    with pytest.raises(FileNotFoundError):
+        StateReader(scale.mac)
@@ -0,0 +1,103 @@
+import time
+
+import pytest
+
+from pyacaia import (AcaiaScale, Framer, decode_frame, encodeHeartbeat, encodeId,
+                     encodeNotificationRequest, encodeStartTimer, encodeStopTimer, encodeTare)
+from pyacaia.sim import SimPeripheral, SimulatedScale
+
+
+def _messages(frames):
+    framer=Framer()
+    for frame in frames:
+        framer.feed(frame)
+    return [decode_frame(frame) for frame in framer]
+
+
+def _wait(condition,timeout=5):
+    deadline=time.monotonic()+timeout
+    while not condition() and time.monotonic()<deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_ident_and_notification_request():
+    scale=SimulatedScale(weight=3.0,battery=55,units='ounces')
+    settings,=_messages(scale.command(encodeId(),0.0))
+    assert (settings.battery,settings.units)==(55,'ounces')
+    weight,=_messages(scale.command(encodeNotificationRequest(weight=3),0.0))
+    assert weight.value==3.0
+    assert scale.notifying
+    assert scale.weight_interval==3
+    assert scale.timer_interval==5
+
+
+def test_tare_and_flow():
+    scale=SimulatedScale(weight=10.0,flow=2.0)
+    scale.update(0.0)
+    echo,=_messages(scale.command(encodeTare(),1.0))
+    assert echo.button=='tare'
+    assert echo.value==0.0
+    assert _messages([scale.weight_frame(2.5)])[0].value==3.0
+
+
+def test_timer_messages_every_timer_interval_heartbeats():
+    scale=SimulatedScale()
+    scale.command(encodeNotificationRequest(timer=3),0.0)
+    start,=_messages(scale.command(encodeStartTimer(),0.0))
+    assert start.button=='start'
+    timers=[]
+    for i in range(9):
+        replies=_messages(scale.command(encodeHeartbeat(),i+1.0))
+        timers+=[msg.time for msg in replies if msg.msgType==7]
+    assert timers==[3.0,6.0,9.0]
+    stop,=_messages(scale.command(encodeStopTimer(),9.5))
+    assert (stop.button,stop.time)==('stop',9.5)
+
+
+def test_notifications_fit_the_mtu():
+    peripheral=SimPeripheral()
+    received=[]
+    peripheral.withDelegate(type('Delegate',(),{
+        'handleNotification': lambda self,handle,data: received.append(data)})())
+    try:
+        frames=[peripheral.scale.weight_frame(0.0) for i in range(5)]
+        peripheral.send(frames)
+        while peripheral.waitForNotifications(0):
+            pass
+        assert all(len(data)<=20 for data in received)
+        assert b''.join(received)==b''.join(bytes(frame) for frame in frames)
+        peripheral.setMTU(247)
+        received.clear()
+        peripheral.send(frames)
+        while peripheral.waitForNotifications(0):
+            pass
+        assert len(received)==1
+    finally:
+        peripheral.disconnect()
+
+
+def test_faults_are_counted():
+    peripheral=SimPeripheral(drop=0.5,seed=3)
+    try:
+        for i in range(100):
+            peripheral.send([peripheral.scale.weight_frame(0.0)])
+        assert 20<peripheral.dropped<80
+    finally:
+        peripheral.disconnect()
+
+
+def test_connected_scale_streams_weights():
+    scale=AcaiaScale('00:00:00:00:00:01',backend='sim',
+                     sim_options={'rate':50,'weight':1.0,'fragment':0.3,'seed':1})
+    scale.connect()
+    try:
+        assert scale.weight==1.0
+        scale.device.scale.flow=5.0
+        # A second of pouring fills the flow window
+        assert _wait(lambda: scale.weight>=7.0)
+        assert scale.flow_rate==pytest.approx(5.0,abs=1.0)
+        assert scale.stats()['garbage_bytes']==0
+    finally:
+        scale.disconnect()
+    assert not scale.device.connected
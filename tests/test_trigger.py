@@ -0,0 +1,170 @@
+import threading
+import time
+
+import pytest
+
+from pyacaia import AcaiaScale, Message, encodeEventData
+from pyacaia.trigger import TriggerEngine
+
+
+def _message(payload):
+    frame=encodeEventData(payload)
+    return Message(frame[4],frame[5:])
+
+
+def _weight(weight):
+    tenths=int(round(weight*10))
+    return _message([5,tenths & 0xff,tenths>>8,0,0,1,0])
+
+_START = _message([8,8,5,0,0,0,0,1,0])
+_STOP = _message([8,10,7,0,3,0,0,100,0,0,0,1,0])
+_RESET = _message([8,9,7,0,0,0,0,0,0,0,0,1,0])
+
+
+class _Analytics(object):
+    flow = 0.0
+
+
+class _Scale(object):
+
+    def __init__(self,timer_running=False,transit_delay=0.0,flow=0.0):
+        self.timer_running=timer_running
+        self.transit_delay=transit_delay
+        self.analytics=_Analytics()
+        self.analytics.flow=flow
+
+
+def _pour(engine,weights):
+    for weight in weights:
+        engine(_weight(weight),time.monotonic())
+
+
+def _range(start,stop):
+    return [w/10.0 for w in range(int(start*10),int(stop*10)+1)]
+
+
+def test_fires_lead_time_early():
+    engine=TriggerEngine(_Scale(flow=2.0))
+    events=[]
+    trigger=engine.add(events.append,target=36.0,lead=0.5)
+    _pour(engine,_range(34.0,34.9))
+    assert events==[]
+    _pour(engine,[35.0])
+    assert len(events)==1
+    event=events[0]
+    assert (event.weight,event.flow,event.lead)==(35.0,2.0,0.5)
+    assert event.predicted==pytest.approx(36.0)
+    assert event.latency>=0
+    # Kept until the weight reaches the target, to measure how early
+    assert engine.triggers==[trigger]
+    _pour(engine,_range(35.1,36.2))
+    assert engine.triggers==[]
+    assert trigger.early.count==1
+    assert len(events)==1
+    assert trigger.stats()['fired']==1
+
+
+def test_default_lead_is_the_pipeline_latency():
+    engine=TriggerEngine(_Scale(transit_delay=0.3,flow=2.0))
+    events=[]
+    engine.add(events.append,target=36.0)
+    _pour(engine,_range(35.0,35.3))
+    assert events==[]
+    _pour(engine,[35.4])
+    assert len(events)==1
+    assert events[0].lead>=0.3
+
+
+def test_no_extrapolation_away_from_the_target():
+    engine=TriggerEngine(_Scale(flow=5.0))
+    events=[]
+    engine.add(events.append,target=10.0,rising=False,lead=1.0)
+    _pour(engine,[12.0,10.5])
+    assert events==[]
+    _pour(engine,[10.0])
+    assert len(events)==1
+
+
+def test_repeating_trigger_rearms():
+    engine=TriggerEngine(_Scale())
+    events=[]
+    trigger=engine.add(events.append,predicate=lambda weight,flow: weight>5,once=False)
+    _pour(engine,[1.0,6.0,7.0,2.0,8.0])
+    assert [event.weight for event in events]==[6.0,8.0]
+    trigger.cancel()
+    assert engine.triggers==[]
+
+
+def test_failing_callback_is_counted():
+    engine=TriggerEngine(_Scale())
+    def callback(event):
+        raise ValueError()
+    trigger=engine.add(callback,target=1.0)
+    _pour(engine,[2.0])
+    assert trigger.errors==1
+    assert trigger.fired==1
+
+
+def test_needs_a_target_or_a_predicate():
+    engine=TriggerEngine(_Scale())
+    with pytest.raises(Exception):
+        engine.add(print)
+    with pytest.raises(Exception):
+        engine.add(print,target=1.0,predicate=lambda weight,flow: True)
+
+
+@pytest.mark.parametrize('end',[_STOP,_RESET])
+def test_once_trigger_expires_with_its_shot(end):
+    engine=TriggerEngine(_Scale())
+    events=[]
+    trigger=engine.add(events.append,target=36.0)
+    # Before its shot, the buttons of no shot do not matter
+    engine(end,time.monotonic())
+    assert engine.triggers==[trigger]
+    engine(_START,time.monotonic())
+    _pour(engine,[10.0,20.0])
+    engine(end,time.monotonic())
+    assert trigger.expired
+    assert trigger.stats()['expired']
+    assert engine.triggers==[]
+    # Not fired in the next shot
+    engine(_START,time.monotonic())
+    _pour(engine,[40.0])
+    assert events==[]
+
+
+def test_trigger_added_during_a_shot_expires_at_its_end():
+    engine=TriggerEngine(_Scale(timer_running=True))
+    trigger=engine.add(print,target=36.0)
+    engine(_STOP,time.monotonic())
+    assert trigger.expired
+
+
+def test_fired_and_repeating_triggers_do_not_expire():
+    engine=TriggerEngine(_Scale(timer_running=True))
+    repeating=engine.add(print,target=36.0,once=False)
+    fired=engine.add(lambda event: None,target=5.0,lead=0)
+    _pour(engine,[4.0,5.0])
+    engine(_STOP,time.monotonic())
+    assert not repeating.expired
+    assert not fired.expired
+    assert engine.triggers==[repeating]
+
+
+def test_when_weight_on_a_pouring_scale():
+    scale=AcaiaScale('00:00:00:00:00:01',backend='sim',
+                     sim_options={'rate':50,'weight':0.0})
+    fired=threading.Event()
+    events=[]
+    def callback(event):
+        events.append(event)
+        fired.set()
+    scale.connect()
+    try:
+        scale.when_weight(3.0,callback)
+        scale.device.scale.flow=10.0
+        assert fired.wait(5)
+        assert events[0].predicted>=3.0
+        assert scale.triggers.triggers==[] or scale.triggers.triggers[0].done
+    finally:
+        scale.disconnect()